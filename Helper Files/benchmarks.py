@@ -0,0 +1,275 @@
+import logging
+import copy
+import gc
+import sys
+import time
+import random
+import tempfile
+import os
+import datetime
+from utils import split_sku, get_country_code, get_order_quantity, get_inner_qty_sku, sort_by_quantity
+from utils import get_raw_orders
+from order_plan import ChannelPlan
+from sku_symbols import SKUQuantities
+from sku_mapping import SKUMappingIndex
+from log_setup import setup_logging
+from parallel_parse import parse_in_chunks
+from output_sinks import InventoryServiceSink
+from inventory_service import InventoryServiceStandIn
+from database import get_db_session, get_day_key, SKU, SKUDailySales, ORDERS_ARCHIVE_DAYS
+from sales_velocity import get_velocity_report
+from sample_data import generate_orders, get_sample_skus, write_export
+from constants import SALES_CHANNEL_PROXY_KEYS, QUANTITY_PATTERN
+
+
+# GLOBAL VARIABLES
+BENCHMARK_REPEATS = 3
+PARALLEL_WORKERS = [1, 2, 4, 8]
+
+
+def best_time(func, make_args, repeats:int=BENCHMARK_REPEATS) -> tuple:
+    '''returns (best wall time in seconds, last return value) of func(*make_args()) over repeats. make_args is not timed'''
+    best, result = None, None
+    for _ in range(repeats):
+        args = make_args()
+        # same as timeit: garbage collector pauses would dominate differences
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = func(*args)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def print_results(title:str, rows:list):
+    '''prints benchmark results: rows - list of (label, seconds, items count)'''
+    print(f'\n{title}')
+    baseline = rows[0][1]
+    for label, seconds, items in rows:
+        rate = items / seconds if seconds else 0
+        print(f'  {label:<28} {seconds * 1000:>10.1f} ms {rate:>14,.0f} rows/s  x{baseline / seconds if seconds else 0:.2f}')
+
+
+def three_pass_parse(orders:list, sales_channel:str, proxy_keys:dict, sku_mapping:dict) -> dict:
+    '''reference implementation of previous clean_orders -> _parse_<channel>_orders -> get_export_obj path. Returns export_obj'''
+    quantity_pattern = QUANTITY_PATTERN[sales_channel]
+    for order in orders:
+        order[proxy_keys['sku']] = split_sku(order[proxy_keys['sku']], sales_channel)
+        if sales_channel == 'Etsy':
+            order[proxy_keys['ship-country']] = get_country_code(order[proxy_keys['ship-country']])
+
+    valid_orders = []
+    for order in orders:
+        qty_purchased = get_order_quantity(order, proxy_keys)
+        skus = order[proxy_keys['sku']]
+        if sales_channel == 'Etsy':
+            if len(skus) > 1 and qty_purchased > 1 and qty_purchased != len(skus):
+                continue
+            if len(skus) == qty_purchased:
+                qty_purchased = 1
+        sku_qties = {}
+        for sku in skus:
+            if sales_channel != 'Etsy' and sku in sku_mapping:
+                sku = sku_mapping[sku]
+            inner_qty, inner_sku = get_inner_qty_sku(sku, quantity_pattern)
+            sku_qties[inner_sku] = inner_qty * qty_purchased
+        order['sku_quantities'] = sku_qties
+        valid_orders.append(order)
+
+    export_obj = {}
+    for order in valid_orders:
+        sku_qties = order['sku_quantities']
+        for sku in sku_qties:
+            if sku not in export_obj:
+                export_obj[sku] = sku_qties[sku]
+            else:
+                export_obj[sku] += sku_qties[sku]
+    return export_obj
+
+def fused_plan_parse(orders:list, sales_channel:str, proxy_keys:dict, sku_mapping:SKUMappingIndex) -> dict:
+    '''ChannelPlan path. sku_mapping is compiled once per workbook in production (see sku_mapping.get_sku_mapping),
+    pass precompiled SKUMappingIndex to time parsing only. Returns export_obj'''
+    return ChannelPlan(sales_channel, proxy_keys, sku_mapping).run(orders).export_obj
+
+def get_sample_mapping(sku_pool:list, mapped_count:int) -> dict:
+    '''returns {amazon_sku: custom_label} mapping for first mapped_count skus of sku_pool'''
+    return {sku: f'({2 if i % 3 else 1} vnt.) {sku}' for i, sku in enumerate(sku_pool[:mapped_count])}
+
+def benchmark_plan(orders_count:int=100000):
+    '''compares three pass parsing path with fused ChannelPlan for every sales channel. Asserts identical export objects'''
+    sku_pool = get_sample_skus(5000)
+    for sales_channel, proxy_keys in SALES_CHANNEL_PROXY_KEYS.items():
+        orders = generate_orders(sales_channel, orders_count, sku_pool)
+        sku_mapping = {} if sales_channel == 'Etsy' else get_sample_mapping(sku_pool, 1000)
+        mapping_index = SKUMappingIndex(sku_mapping)
+        make_args = lambda: (copy.deepcopy(orders), sales_channel, proxy_keys, sku_mapping)
+        three_pass_time, three_pass_obj = best_time(three_pass_parse, make_args)
+        plan_time, plan_obj = best_time(fused_plan_parse, lambda: (copy.deepcopy(orders), sales_channel, proxy_keys, mapping_index))
+        assert three_pass_obj == plan_obj, f'{sales_channel} export objects of three pass and fused plan paths differ'
+        print_results(f'{sales_channel}: clean / parse / aggregate {orders_count:,} orders',
+                    [('three pass', three_pass_time, orders_count), ('fused plan', plan_time, orders_count)])
+
+def dict_aggregate(order_lines:list, inner_skus:dict) -> list:
+    '''previous aggregation: parsed sku strings summed in dict, sorted by quantity'''
+    export_obj = {}
+    for raw_sku, quantity in order_lines:
+        sku = inner_skus[raw_sku]
+        if sku not in export_obj:
+            export_obj[sku] = quantity
+        else:
+            export_obj[sku] += quantity
+    return sort_by_quantity(export_obj)
+
+def array_aggregate(order_lines:list, inner_skus:dict) -> list:
+    '''ChannelPlan aggregation: sku interned once per distinct raw sku, quantities summed in int64 buffer, argsorted'''
+    sku_totals = SKUQuantities()
+    sku_ids = {}
+    totals = sku_totals.quantities
+    for raw_sku, quantity in order_lines:
+        sku_id = sku_ids.get(raw_sku)
+        if sku_id is None:
+            sku_id = sku_ids[raw_sku] = sku_totals.reserve_sku(inner_skus[raw_sku])
+        totals[sku_id] += quantity
+    return sku_totals.sorted_items()
+
+def benchmark_aggregation(lines_count:int=1000000, skus_count:int=20000):
+    '''compares dict and interned array sku quantities aggregation on lines_count (raw sku, qty) order lines'''
+    rnd = random.Random(0)
+    sku_pool = get_sample_skus(skus_count)
+    # parsing result of every distinct raw sku (cached in both paths)
+    inner_skus = {f'(2 vnt.) {sku}': sku for sku in sku_pool}
+    raw_skus = list(inner_skus)
+    order_lines = [(rnd.choice(raw_skus), rnd.randint(1, 10)) for _ in range(lines_count)]
+    make_args = lambda: (order_lines, inner_skus)
+    dict_time, dict_sorted = best_time(dict_aggregate, make_args)
+    array_time, array_sorted = best_time(array_aggregate, make_args)
+    assert sorted(dict_sorted) == sorted(array_sorted), 'dict and array aggregation results differ'
+    assert [qty for _, qty in dict_sorted] == [qty for _, qty in array_sorted], 'dict and array aggregation sort order differs'
+    print_results(f'Aggregate and sort {lines_count:,} order lines, {skus_count:,} skus',
+                [('dict', dict_time, lines_count), ('interned array', array_time, lines_count)])
+def benchmark_logging(orders_count:int=100000):
+    '''measures ChannelPlan throughput with logging disabled vs. log_setup configuration (INFO, queue thread, rotating file).
+    Etsy sample contains ambiguous orders, logged per row (repeated messages aggregated)'''
+    proxy_keys = SALES_CHANNEL_PROXY_KEYS['Etsy']
+    orders = generate_orders('Etsy', orders_count)
+    make_args = lambda: (copy.deepcopy(orders), 'Etsy', proxy_keys, SKUMappingIndex())
+    disabled_time, _ = best_time(fused_plan_parse, make_args)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logging.disable(logging.NOTSET)
+        stop_logging = setup_logging(os.path.join(tmp_dir, 'benchmark.log'), level=logging.INFO)
+        try:
+            enabled_time, _ = best_time(fused_plan_parse, make_args)
+        finally:
+            stop_logging()
+            logging.getLogger().handlers.clear()
+            logging.disable(logging.CRITICAL)
+    print_results(f'Etsy plan {orders_count:,} orders, logging overhead',
+                [('logging disabled', disabled_time, orders_count), ('log_setup INFO', enabled_time, orders_count)])
+
+def single_process_parse(fpath:str, sales_channel:str, sku_mapping:dict) -> dict:
+    '''current small file path: whole file read by csv.DictReader, parsed by ChannelPlan. Returns export_obj'''
+    orders = get_raw_orders(fpath, 'utf-8', '\t')
+    return ChannelPlan(sales_channel, SALES_CHANNEL_PROXY_KEYS[sales_channel], sku_mapping).run(orders).export_obj
+
+def chunked_parse(fpath:str, sales_channel:str, sku_mapping:dict, workers:int) -> dict:
+    '''parallel_parse path (worker start up included). Returns export_obj'''
+    chunked = parse_in_chunks(fpath, 'utf-8', '\t', sales_channel, sku_mapping, workers)
+    return chunked.get_plan_result(chunked.orders).export_obj
+
+def benchmark_parallel_parse(orders_count:int=500000):
+    '''compares single process read + parse of Amazon export with chunked process pool parsing on PARALLEL_WORKERS workers.
+    Asserts identical export objects. Speed up is bounded by cpu count (printed)'''
+    sku_pool = get_sample_skus(5000)
+    sku_mapping = get_sample_mapping(sku_pool, 1000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = os.path.join(tmp_dir, 'amazon export.txt')
+        write_export(fpath, generate_orders('Amazon', orders_count, sku_pool), 'Amazon')
+        make_args = lambda: (fpath, 'Amazon', sku_mapping)
+        single_time, single_obj = best_time(single_process_parse, make_args)
+        rows = [('single process', single_time, orders_count)]
+        for workers in PARALLEL_WORKERS:
+            chunked_time, chunked_obj = best_time(chunked_parse, lambda: (fpath, 'Amazon', sku_mapping, workers))
+            assert single_obj == chunked_obj, f'export objects of single process and {workers} workers chunked parsing differ'
+            rows.append((f'{workers} worker(s)', chunked_time, orders_count))
+        print_results(f'Amazon export {os.path.getsize(fpath) / 2**20:.0f} MB, {orders_count:,} orders, cpu count: {os.cpu_count()}', rows)
+
+def per_sku_push(service_url:str, export_obj:dict, run_key:str) -> int:
+    '''previous manual scripts approach: one request (cell update) per sku. Returns requests count'''
+    sink = InventoryServiceSink(service_url)
+    for sku, quantity in export_obj.items():
+        sink.write({sku: quantity}, f'{run_key}-{sku}', 'Amazon')
+    return len(export_obj)
+
+def batched_push(service_url:str, export_obj:dict, run_key:str) -> int:
+    '''InventoryServiceSink: single batched idempotent request per run. Returns requests count'''
+    InventoryServiceSink(service_url).write(export_obj, run_key, 'Amazon')
+    return 1
+
+def benchmark_service_sink(skus_count:int=2000):
+    '''compares per sku requests with single batched delta request against local inventory service stand-in.
+    Asserts identical service inventory'''
+    export_obj = {sku: random.Random(i).randint(1, 5) for i, sku in enumerate(get_sample_skus(skus_count))}
+    run_keys = iter(range(10**6))
+    with InventoryServiceStandIn() as per_sku_service, InventoryServiceStandIn() as batched_service:
+        per_sku_time, _ = best_time(per_sku_push, lambda: (per_sku_service.url, export_obj, f'run-{next(run_keys)}'), repeats=1)
+        batched_time, _ = best_time(batched_push, lambda: (batched_service.url, export_obj, f'run-{next(run_keys)}'), repeats=1)
+        assert per_sku_service.inventory == batched_service.inventory, 'per sku and batched pushes resulted in different inventory'
+    print_results(f'Push {skus_count:,} sku deltas to inventory service stand-in',
+                [('request per sku', per_sku_time, skus_count), ('single batched request', batched_time, skus_count)])
+
+def fill_daily_sales(output_dir:str, skus_count:int, sale_days:int, today:datetime.date) -> int:
+    '''writes sku table and sku_daily_sales buckets: each sku sells on sale_days random days of archive window
+    in random sales channel. Returns buckets count'''
+    rnd = random.Random(0)
+    session = get_db_session(output_dir)
+    session.execute(SKU.__table__.insert(), [{'id': i, 'code': sku} for i, sku in enumerate(get_sample_skus(skus_count), 1)])
+    buckets = {}
+    for sku_id in range(1, skus_count + 1):
+        for day in rnd.sample(range(ORDERS_ARCHIVE_DAYS), sale_days):
+            key = (get_day_key(today - datetime.timedelta(days=day)), rnd.choice(list(SALES_CHANNEL_PROXY_KEYS)), sku_id)
+            buckets[key] = rnd.randint(1, 4)
+    session.execute(SKUDailySales.__table__.insert(), [{'day': day, 'sales_channel': sales_channel, 'sku_id': sku_id,
+                    'quantity': quantity, 'orders_count': 1} for (day, sales_channel, sku_id), quantity in buckets.items()])
+    session.commit()
+    session.close()
+    return len(buckets)
+
+def benchmark_velocity_report(skus_count:int=30000, sale_days:int=20):
+    '''measures sales velocity report (grouped query over daily buckets, days of cover) on skus_count skus'''
+    today = datetime.date.today()
+    with tempfile.TemporaryDirectory() as output_dir:
+        buckets_count = fill_daily_sales(output_dir, skus_count, sale_days, today)
+        report_time, rows = best_time(get_velocity_report, lambda: (output_dir, today))
+        assert len(rows) == skus_count, f'velocity report returned {len(rows)} rows for {skus_count} skus'
+    print_results(f'Sales velocity report of {skus_count:,} skus ({buckets_count:,} daily buckets)',
+                [('velocity report', report_time, skus_count)])
+
+
+def benchmark_budgets():
+    '''per stage performance budgets check (perf_budgets.py). Exits with code 1 if any stage is over budget'''
+    # perf_budgets imports helpers of this module
+    from perf_budgets import check_budgets
+    if check_budgets():
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    'plan': benchmark_plan,
+    'aggregation': benchmark_aggregation,
+    'logging': benchmark_logging,
+    'parallel': benchmark_parallel_parse,
+    'sink': benchmark_service_sink,
+    'velocity': benchmark_velocity_report,
+    # last: exits on exceeded budget
+    'budgets': benchmark_budgets,
+    }
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    selected = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+    for benchmark_name in selected:
+        BENCHMARKS[benchmark_name]()
@@ -0,0 +1,154 @@
+import operator
+import logging
+import csv
+from datetime import datetime, date
+from utils import get_country_code
+from exceptions import SourceHeadersError
+from constants import SALES_CHANNEL_PROXY_KEYS, QUANTITY_PATTERN
+
+
+# GLOBAL VARIABLES
+# columns every export has to contain: orders are identified, parsed and stored in database by them
+REQUIRED_KEYS = ['order-id', 'sku', 'purchase-date', 'buyer-name']
+# headers identifying export of sales channel (see detect_channel)
+SIGNATURE_KEYS = ['order-id', 'purchase-date', 'buyer-name', 'sku', 'quantity-purchased', 'ship-country']
+
+# {sales channel: ChannelAdapter}, filled by register_channel
+CHANNELS = {}
+
+
+def split_etsy_sku(sku_field:str) -> list:
+    '''splits etsy sku string on ' + ' and ',' (see utils.split_sku)'''
+    return [sku for sku_sublist in sku_field.split(' + ') for sku in sku_sublist.split(',')]
+
+def split_amazon_sku(sku_field:str) -> list:
+    '''splits amazon, amazon warehouse multilisting sku string on ' + ' (see utils.split_sku)'''
+    return sku_field.split(' + ')
+
+
+class ChannelColumns():
+    '''Source file header compiled against channel proxy keys.
+
+    - headers:list - source file header row
+    - indexes:dict - {universal key: column position} of proxy keys present in header (duplicate headers: last column, as csv.DictReader)
+
+    Rows (lists of values as read by csv.reader) are accessed positionally: columns.get(row, 'sku') or getter(*keys)(row)'''
+
+    def __init__(self, proxy_keys:dict, headers:list):
+        self.headers = headers
+        positions = {header: position for position, header in enumerate(headers)}
+        self.indexes = {key: positions[column] for key, column in proxy_keys.items() if column in positions}
+
+    def get(self, row:list, key:str):
+        '''returns row value of universal key column, None if column or value is missing'''
+        index = self.indexes.get(key)
+        return row[index] if index is not None and index < len(row) else None
+
+    def getter(self, *keys) -> callable:
+        '''returns callable(row) -> tuple of keys column values (operator.itemgetter over positions). Keys missing in header are skipped'''
+        indexes = [self.indexes[key] for key in keys if key in self.indexes]
+        if not indexes:
+            return lambda row: ()
+        if len(indexes) == 1:
+            index = indexes[0]
+            return lambda row: (row[index],)
+        return operator.itemgetter(*indexes)
+
+
+class ChannelAdapter():
+    '''Everything channel specific about source exports. Core loops (ChannelPlan, parallel_parse, database)
+    only call adapter attributes, new channel is added by register_channel(ChannelAdapter(...)).
+
+    Args:
+    - name:str - sales channel name passed from VBA side ('Amazon', 'Amazon Warehouse', 'Etsy')
+    - proxy_keys:dict - {universal key: export column} (see constants.SALES_CHANNEL_PROXY_KEYS)
+    - quantity_pattern:str - regex of inner quantity prefix in sku code (see constants.QUANTITY_PATTERN)
+    - split_sku:callable - splits sku field into list of skus
+    - clean_country:callable - optional, cleans 'ship-country' value (ship-country column becomes required)
+    - uses_sku_mapping:bool - skus are mapped by sku mapping workbook before parsing
+    - skus_counted_in_quantity:bool - quantity column may count listed skus instead of items per sku (Etsy)
+    - purchase_date_format:str - optional strptime format of purchase date column. None: ISO format (2020-04-16T10:07:16+00:00)
+
+    Main method:
+    - compile(headers) - validates header once, returns ChannelColumns. Raises SourceHeadersError listing all missing columns'''
+
+    def __init__(self, name:str, proxy_keys:dict, quantity_pattern:str, split_sku:callable, clean_country:callable=None,
+                uses_sku_mapping:bool=True, skus_counted_in_quantity:bool=False, purchase_date_format:str=None):
+        self.name = name
+        self.proxy_keys = proxy_keys
+        self.quantity_pattern = quantity_pattern
+        self.split_sku = split_sku
+        self.clean_country = clean_country
+        self.uses_sku_mapping = uses_sku_mapping
+        self.skus_counted_in_quantity = skus_counted_in_quantity
+        self.purchase_date_format = purchase_date_format
+        self.required_keys = REQUIRED_KEYS + [key for key in ['secondary-order-id'] if key in proxy_keys]
+        if clean_country:
+            self.required_keys.append('ship-country')
+
+    def get_missing_columns(self, headers:list) -> list:
+        '''returns export columns of required keys absent in headers'''
+        headers = set(headers)
+        return [self.proxy_keys[key] for key in self.required_keys if self.proxy_keys[key] not in headers]
+
+    def compile(self, headers:list) -> ChannelColumns:
+        '''returns ChannelColumns of headers. Raises SourceHeadersError if required column is missing'''
+        missing_columns = self.get_missing_columns(headers)
+        if missing_columns:
+            logging.critical(f'Source file is not {self.name} export. Missing columns: {missing_columns}. Source file columns: {list(headers)}')
+            raise SourceHeadersError(f'Missing {self.name} columns: {missing_columns}')
+        return ChannelColumns(self.proxy_keys, headers)
+
+    def get_sale_day(self, purchase_date:str):
+        '''returns date of purchase date column value, None if value can not be parsed'''
+        try:
+            if self.purchase_date_format:
+                return datetime.strptime(purchase_date, self.purchase_date_format).date()
+            return date.fromisoformat(purchase_date[:10])
+        except (TypeError, ValueError):
+            return None
+
+    def __repr__(self) -> str:
+        return f'<ChannelAdapter {self.name}>'
+
+
+def register_channel(adapter:ChannelAdapter):
+    '''adds (replaces) adapter in CHANNELS registry'''
+    CHANNELS[adapter.name] = adapter
+
+def get_channel(sales_channel:str) -> ChannelAdapter:
+    '''returns registered adapter of sales_channel. Raises KeyError for unknown channel'''
+    return CHANNELS[sales_channel]
+
+def read_headers(fpath:str, encoding:str, delimiter:str) -> list:
+    '''returns source file header row (same as csv.DictReader fieldnames), reads first line only'''
+    with open(fpath, 'r', encoding=encoding, newline='') as f:
+        return next(csv.reader(f, delimiter=delimiter), [])
+
+def validate_source_headers(fpath:str, encoding:str, delimiter:str, sales_channel:str) -> ChannelColumns:
+    '''checks source file header before orders are read. Raises SourceHeadersError if required column is missing'''
+    return get_channel(sales_channel).compile(read_headers(fpath, encoding, delimiter))
+
+def detect_channel(headers:list):
+    '''returns registered sales channel whose SIGNATURE_KEYS headers are all present in headers.
+    If several match, channel with most matching headers overall. None if no channel matches'''
+    headers = set(headers)
+    candidates = []
+    for sales_channel, adapter in CHANNELS.items():
+        proxy_keys = adapter.proxy_keys
+        if all(key in proxy_keys and proxy_keys[key] in headers for key in SIGNATURE_KEYS):
+            candidates.append((len(headers & set(proxy_keys.values())), sales_channel))
+    return max(candidates)[1] if candidates else None
+
+
+register_channel(ChannelAdapter('Amazon', SALES_CHANNEL_PROXY_KEYS['Amazon'], QUANTITY_PATTERN['Amazon'], split_amazon_sku))
+register_channel(ChannelAdapter('Amazon Warehouse', SALES_CHANNEL_PROXY_KEYS['Amazon Warehouse'], QUANTITY_PATTERN['Amazon Warehouse'],
+                                split_amazon_sku))
+# transform etsy country (Lithuania) to country code (LT). Etsy skus are not mapped
+register_channel(ChannelAdapter('Etsy', SALES_CHANNEL_PROXY_KEYS['Etsy'], QUANTITY_PATTERN['Etsy'], split_etsy_sku,
+                                clean_country=get_country_code, uses_sku_mapping=False, skus_counted_in_quantity=True,
+                                purchase_date_format='%m/%d/%y'))
+
+
+if __name__ == "__main__":
+    pass
@@ -15,6 +15,10 @@ VBA_OK = 'EXPORTED_SUCCESSFULLY'
 # WORKBOOKS
 EXPORT_FILE = 'Inventory Reduction.xlsx'
 SKU_MAPPING_WB_NAME = 'Amazon SKU Mapping.xlsx'
+# per sales channel report of last run skus not found in sku mapping, next to mapping workbook
+UNMAPPED_SKUS_NAME = '{} unmapped skus.csv'
+# per sales channel ambiguous orders compositions (skus, number of items) to be resolved manually, next to helper file
+LISTING_COMPOSITIONS_NAME = '{} listing compositions.csv'
 SHEET_NAME = 'SKU codes'
 HEADERS = ['sku', 'quantity']
 
@@ -58,6 +62,7 @@ AMAZON_WAREHOUSE_KEYS = {
     # universal key : csv / txt key
     'order-id' : 'Shipment Item ID',
     'secondary-order-id' : 'Amazon Order Id',
+    'same-buyer-order-id' : 'Amazon Order Id',
     'purchase-date' : 'Purchase Date',
     'payments-date' : 'Payments Date',
     'buyer-email' : 'Buyer E-mail',
@@ -1,14 +1,24 @@
+import functools
 import datetime
 import logging
+import pathlib
+import sqlite3
 import os
+import re
 import shutil
-from sqlalchemy import create_engine, Column, String, Integer
+from sqlalchemy import create_engine, inspect, Column, String, Integer, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.sql.schema import ForeignKey
 from sqlalchemy.exc import IntegrityError
-from utils import get_output_dir, create_src_file_backup, delete_file
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from utils import get_output_dir, get_src_files_folder, create_src_file_backup, delete_file
+from exceptions import DatabaseError
+from order_index import OrderIDIndex
+from order_archive import OrderArchive
+from channels import get_channel
+from progress import ProgressReporter
 
 
 # GLOBAL VARIABLES
@@ -16,7 +26,14 @@ ORDERS_ARCHIVE_DAYS = 120
 DATABASE_NAME = 'inventory.db'
 BACKUP_DB_BEFORE_NAME = 'inventory_b4lrun.db'
 BACKUP_DB_AFTER_NAME = 'inventory_lrun.db'
-VBA_ERROR_ALERT = 'ERROR_CALL_DADDY'
+SQL_IN_CHUNK_SIZE = 500
+# orders and order items are kept in monthly database files (partition month = month of program run)
+ORDER_PARTITIONS_DIR = 'order partitions'
+PARTITION_MONTH_FORMAT = '%Y-%m'
+PARTITION_FNAME_PATTERN = re.compile(r'^orders (\d{4}-\d{2})\.db$')
+
+# {(db_path, read_only): engine}. One engine (connection pool) per database file for process lifetime, stays warm in watcher mode
+ENGINES = {}
 
 Base = declarative_base()
 
@@ -35,25 +52,24 @@ class ProgramRun(Base):
     fpath = Column(String, nullable=False)
     sales_channel = Column(String, nullable=False)      # Amazon /Amazon Warehouse /Etsy
     timestamp = Column(TIMESTAMP(timezone=False), default=datetime.datetime.now())
-    orders = relationship('Order', cascade='all, delete', cascade_backrefs=True,
-                passive_deletes=False, passive_updates=False, backref='run_obj')
+    sku_deltas = relationship('RunSKUDelta', cascade='all, delete', passive_deletes=False, backref='run_obj')
 
     def __repr__(self) -> str:
         return f'<ProgramRun id: {self.id}, sales_channel: {self.sales_channel}, timestamp: {self.timestamp}, fpath: {self.fpath}>'
     
 
 class Order(Base):
-    '''database table model representing Order
+    '''database table model representing Order. Stored in monthly partition database of its run (see OrderPartitions)
     
     NOTE: unique primary key is:
         order['order-item-id'] for Amazon;
         order['Shipment Item ID'] for Amazon Warehouse;
         order['Order ID'] for Etsy;
 
-        order_id_secondary:
+        order_id_secondary (indexed, groups orders by buyer cart - same-buyer-order-id):
         order['order-id'] for Amazon;
         order['Amazon Order Id'] for Amazon Warehouse;
-        null for Etsy'''
+        order['Order ID'] for Etsy (null for orders added by earlier versions)'''
     __tablename__ = 'order'
 
     def __init__(self, order_id, purchase_date, buyer_name, run, **kwargs):
@@ -64,15 +80,384 @@ class Order(Base):
         self.run = run
 
     order_id = Column(String, primary_key=True, nullable=False)
-    order_id_secondary = Column(String)
+    order_id_secondary = Column(String, index=True)
     purchase_date = Column(String)
     buyer_name = Column(String)
     run = Column(Integer, ForeignKey('program_run.id', ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
+    items = relationship('OrderItem', cascade='all, delete', passive_deletes=False, backref='order_obj')
 
     def __repr__(self) -> str:
         return f'<Order order_id: {self.order_id}, added on run: {self.run}>'
 
 
+class SKU(Base):
+    '''database table model interning sku codes (as written to helper file) to integer ids'''
+    __tablename__ = 'sku'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    code = Column(String, nullable=False, unique=True)
+
+    def __repr__(self) -> str:
+        return f'<SKU id: {self.id}, code: {self.code}>'
+
+
+class OrderItem(Base):
+    '''database table model representing parsed sku quantity of an order (order['sku_quantities'] entry)'''
+    __tablename__ = 'order_item'
+
+    order_id = Column(String, ForeignKey('order.order_id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True, nullable=False)
+    sku_id = Column(Integer, ForeignKey('sku.id'), primary_key=True, nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'<OrderItem order_id: {self.order_id}, sku_id: {self.sku_id}, quantity: {self.quantity}>'
+
+
+class RunSKUDelta(Base):
+    '''database table model representing quantity of sku added to helper file by program run (export_obj entry).
+    Used to reverse single run (see run_rollback.py)'''
+    __tablename__ = 'run_sku_delta'
+
+    run = Column(Integer, ForeignKey('program_run.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True, nullable=False)
+    sku_id = Column(Integer, ForeignKey('sku.id'), primary_key=True, nullable=False)
+    quantity = Column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'<RunSKUDelta run: {self.run}, sku_id: {self.sku_id}, quantity: {self.quantity}>'
+
+
+class SKUDailySales(Base):
+    '''database table model representing units of sku sold per day (purchase date, run day if unparseable) per sales channel.
+    Day is YYYYMMDD integer (see get_day_key). Maintained incrementally when orders are added / runs reversed, pruned to ORDERS_ARCHIVE_DAYS window (see sales_velocity.py)'''
+    __tablename__ = 'sku_daily_sales'
+    # rows clustered by primary key (sku_id first): per sku aggregation reads table in order, no temp b-tree for GROUP BY
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    sku_id = Column(Integer, ForeignKey('sku.id'), primary_key=True, nullable=False)
+    day = Column(Integer, primary_key=True, nullable=False)
+    sales_channel = Column(String, primary_key=True, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    orders_count = Column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'<SKUDailySales day: {self.day}, sales_channel: {self.sales_channel}, sku_id: {self.sku_id}, quantity: {self.quantity}>'
+
+
+class ListingComposition(Base):
+    '''database table model representing resolved listing composition: per sku multipliers of order with several skus,
+    which number of items does not tell sku quantities (Etsy). Learned from manual corrections (see listing_compositions.py)'''
+    __tablename__ = 'listing_composition'
+
+    sales_channel = Column(String, primary_key=True, nullable=False)
+    skus = Column(String, primary_key=True, nullable=False)
+    items = Column(Integer, primary_key=True, nullable=False)
+    multipliers = Column(String, nullable=False)
+    timestamp = Column(TIMESTAMP, nullable=False, default=datetime.datetime.now)
+
+    def __repr__(self) -> str:
+        return f'<ListingComposition {self.sales_channel} skus: {self.skus}, items: {self.items}, multipliers: {self.multipliers}>'
+
+
+# tables of main database / of each monthly partition database
+MAIN_TABLES = [ProgramRun.__table__, SKU.__table__, RunSKUDelta.__table__, SKUDailySales.__table__, ListingComposition.__table__]
+PARTITION_TABLES = [Order.__table__, OrderItem.__table__]
+
+
+def get_db_path(output_dir:str=None) -> str:
+    '''returns database abs path inside output_dir (defaults to get_output_dir(client_file=False))'''
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    return os.path.join(output_dir, DATABASE_NAME)
+
+def get_engine(db_path:str, read_only:bool=False):
+    '''returns cached engine for sqlite database at db_path. read_only engine opens database with mode=ro uri (no writes, no file creation)'''
+    key = (db_path, read_only)
+    if key not in ENGINES:
+        if read_only:
+            db_uri = f'{pathlib.Path(db_path).absolute().as_uri()}?mode=ro'
+            ENGINES[key] = create_engine('sqlite://', creator=lambda: sqlite3.connect(db_uri, uri=True), echo=False)
+        else:
+            ENGINES[key] = create_engine(f'sqlite:///{db_path}', echo=False)
+    return ENGINES[key]
+
+def dispose_engine(db_path:str):
+    '''disposes and forgets cached engines of database at db_path (before file is deleted)'''
+    for read_only in (False, True):
+        engine = ENGINES.pop((db_path, read_only), None)
+        if engine is not None:
+            engine.dispose()
+
+def get_db_session(output_dir:str=None):
+    '''returns session to main database without SQLAlchemyOrdersDB overhead (backups, orders). Creates missing tables.
+    Meant for queries / maintenance commands (orders are queried via OrderPartitions)'''
+    engine = get_engine(get_db_path(output_dir))
+    Base.metadata.create_all(bind=engine, tables=MAIN_TABLES)
+    Session = sessionmaker(bind=engine)
+    return Session()
+
+def get_sku_sales_history(session, sku_code:str, output_dir:str=None) -> list:
+    '''returns list of dicts for each program run, that sold sku_code, ordered by run timestamp:
+    [{'run': id, 'timestamp': datetime, 'sales_channel': str, 'fpath': str, 'orders': int, 'quantity': int}, ...]'''
+    sku_id = session.query(SKU.id).filter(SKU.code == sku_code).scalar()
+    if sku_id is None:
+        return []
+    partitions = OrderPartitions(output_dir, read_only=True, main_engine=session.get_bind())
+    run_totals = partitions.get_sku_run_totals(sku_id)
+    partitions.close()
+    runs = session.query(ProgramRun.id, ProgramRun.timestamp, ProgramRun.sales_channel, ProgramRun.fpath).\
+                    filter(ProgramRun.id.in_(list(run_totals))).order_by(ProgramRun.timestamp).all()
+    keys = ['run', 'timestamp', 'sales_channel', 'fpath', 'orders', 'quantity']
+    return [dict(zip(keys, (*run, *run_totals[run.id]))) for run in runs]
+
+def get_day_key(day:datetime.date) -> int:
+    '''returns YYYYMMDD integer of date / datetime: sku_daily_sales day (ordered, compared as integers)'''
+    return day.year * 10000 + day.month * 100 + day.day
+
+def get_day_from_key(day_key:int) -> datetime.date:
+    '''returns date of YYYYMMDD integer (see get_day_key)'''
+    return datetime.date(day_key // 10000, day_key // 100 % 100, day_key % 100)
+
+def get_partition_month(timestamp:datetime.datetime) -> str:
+    '''returns partition month ('2022-08') of program run timestamp'''
+    return timestamp.strftime(PARTITION_MONTH_FORMAT)
+
+
+class OrderPartitions():
+    '''Router of order / order_item tables split into monthly SQLite files: 'order partitions/orders 2022-08.db'.
+
+    Orders of program run are stored in partition of run month. Archiving old runs drops whole partition files
+    (no row by row deletes, database files do not fragment or need VACUUM), backups copy only changed partitions.
+    Queries run against every partition and, until migrated (see migrate_legacy), against unpartitioned
+    'order' / 'order_item' tables of main database created by previous versions.
+
+    Partitions do not know sales channel of orders: callers pass program run ids of channel.
+
+    Args:
+    - output_dir:str - optional directory containing partitions folder. Defaults to get_output_dir(client_file=False)
+    - read_only:bool - partitions opened read-only, no files or folders are created
+    - main_engine - optional main database engine, checked for legacy unpartitioned orders'''
+
+    def __init__(self, output_dir:str=None, read_only:bool=False, main_engine=None):
+        output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+        self.folder = os.path.join(output_dir, ORDER_PARTITIONS_DIR)
+        self.read_only = read_only
+        self.sessions = {}
+        self.legacy_session = None
+        if main_engine is not None and inspect(main_engine).has_table(Order.__tablename__):
+            self.legacy_session = sessionmaker(bind=main_engine)()
+
+    def get_path(self, month:str) -> str:
+        return os.path.join(self.folder, f'orders {month}.db')
+
+    def months(self) -> list:
+        '''returns sorted months of existing partition files'''
+        if not os.path.exists(self.folder):
+            return []
+        matches = (PARTITION_FNAME_PATTERN.match(entry.name) for entry in os.scandir(self.folder))
+        return sorted(match.group(1) for match in matches if match)
+
+    def get_session(self, month:str, create:bool=False):
+        '''returns (cached) session of month partition. Missing partition: created if create, else None'''
+        if month not in self.sessions:
+            db_path = self.get_path(month)
+            if not os.path.exists(db_path):
+                if not create or self.read_only:
+                    return None
+                os.makedirs(self.folder, exist_ok=True)
+                logging.info(f'Order partition database created at {db_path}')
+            engine = get_engine(db_path, self.read_only)
+            if create and not self.read_only:
+                # partitions only read from were created with tables, schema is checked for written partition only
+                Base.metadata.create_all(bind=engine, tables=PARTITION_TABLES)
+                # indexes added in later versions are created on existing partitions too
+                for index in Order.__table__.indexes:
+                    index.create(bind=engine, checkfirst=True)
+            self.sessions[month] = sessionmaker(bind=engine)()
+        return self.sessions[month]
+
+    def _get_all_sessions(self) -> list:
+        '''returns sessions of all partitions and legacy unpartitioned tables'''
+        sessions = [self.get_session(month) for month in self.months()]
+        return sessions + [self.legacy_session] if self.legacy_session else sessions
+
+    def get_existing_order_ids(self, order_ids:list, run_ids:set) -> set:
+        '''returns order_ids present in partitions as orders of run_ids'''
+        order_ids = list(set(order_ids))
+        existing = set()
+        for session in self._get_all_sessions():
+            for i in range(0, len(order_ids), SQL_IN_CHUNK_SIZE):
+                chunk = order_ids[i:i + SQL_IN_CHUNK_SIZE]
+                matches = session.query(Order.order_id, Order.run).filter(Order.order_id.in_(chunk)).all()
+                existing.update(order_id for order_id, run in matches if run in run_ids)
+        return existing
+
+    def get_cart_rows(self, cart_ids:list) -> list:
+        '''returns (cart id, order id, run id) rows of orders, whose order_id_secondary is in cart_ids (indexed lookup)'''
+        cart_ids = list(set(cart_ids))
+        rows = []
+        for session in self._get_all_sessions():
+            for i in range(0, len(cart_ids), SQL_IN_CHUNK_SIZE):
+                chunk = cart_ids[i:i + SQL_IN_CHUNK_SIZE]
+                rows.extend(session.query(Order.order_id_secondary, Order.order_id, Order.run).\
+                                filter(Order.order_id_secondary.in_(chunk)).all())
+        return rows
+
+    def get_cart_item_rows(self, cart_ids:list) -> list:
+        '''returns (cart id, run id, sku id, quantity) rows of order items of orders in cart_ids'''
+        cart_ids = list(set(cart_ids))
+        rows = []
+        for session in self._get_all_sessions():
+            for i in range(0, len(cart_ids), SQL_IN_CHUNK_SIZE):
+                chunk = cart_ids[i:i + SQL_IN_CHUNK_SIZE]
+                rows.extend(session.query(Order.order_id_secondary, Order.run, OrderItem.sku_id, OrderItem.quantity).\
+                                join(Order, Order.order_id == OrderItem.order_id).\
+                                filter(Order.order_id_secondary.in_(chunk)).all())
+        return rows
+
+    def get_run_order_ids(self, run_ids:set) -> list:
+        '''returns order ids of orders added by run_ids'''
+        order_ids = []
+        for session in self._get_all_sessions():
+            order_ids.extend(order_id for order_id, run in session.query(Order.order_id, Order.run).all() if run in run_ids)
+        return order_ids
+
+    def get_sku_run_totals(self, sku_id:int) -> dict:
+        '''returns {run id: [orders count, quantity]} of sku_id order items'''
+        totals = {}
+        for session in self._get_all_sessions():
+            rows = session.query(Order.run, func.count(OrderItem.order_id), func.sum(OrderItem.quantity)).\
+                        join(Order, Order.order_id == OrderItem.order_id).\
+                        filter(OrderItem.sku_id == sku_id).group_by(Order.run).all()
+            for run, orders_count, quantity in rows:
+                entry = totals.setdefault(run, [0, 0])
+                entry[0] += orders_count
+                entry[1] += quantity
+        return totals
+
+    def get_item_sale_rows(self, run_id:int=None, month:str=None) -> list:
+        '''returns (run id, purchase date, sku id, quantity) rows of order items. Optionally of run_id / month partition only'''
+        sessions = [self.get_session(month)] if month else self._get_all_sessions()
+        rows = []
+        for session in sessions:
+            if session is None:
+                continue
+            query = session.query(Order.run, Order.purchase_date, OrderItem.sku_id, OrderItem.quantity).\
+                        join(Order, Order.order_id == OrderItem.order_id)
+            rows.extend(query.filter(Order.run == run_id).all() if run_id is not None else query.all())
+        return rows
+
+    def count_rows(self) -> tuple:
+        '''returns (orders, order items) counts across partitions'''
+        orders_count, items_count = 0, 0
+        for session in self._get_all_sessions():
+            orders_count += session.query(Order).count()
+            items_count += session.query(OrderItem).count()
+        return orders_count, items_count
+
+    def delete_run(self, run_id:int, month:str) -> list:
+        '''deletes orders and order items of run_id from month partition, returns deleted order ids'''
+        session = self.get_session(month)
+        if session is None:
+            return []
+        order_ids = [order_id for order_id, in session.query(Order.order_id).filter(Order.run == run_id).all()]
+        for i in range(0, len(order_ids), SQL_IN_CHUNK_SIZE):
+            chunk = order_ids[i:i + SQL_IN_CHUNK_SIZE]
+            session.query(OrderItem).filter(OrderItem.order_id.in_(chunk)).delete(synchronize_session=False)
+        session.query(Order).filter(Order.run == run_id).delete(synchronize_session=False)
+        session.commit()
+        return order_ids
+
+    def drop_before(self, month:str, archive=None) -> dict:
+        '''deletes partition files of months before month. Returns {dropped month: {run id: [order ids]}} of dropped orders.
+        archive - optional callable(month, orders, order_items) (lists of row tuples) called before partition is deleted.
+        Partition is kept (retried on next run, month not returned) if it is locked or archive raises'''
+        dropped = {}
+        for old_month in [partition_month for partition_month in self.months() if partition_month < month]:
+            session = self.get_session(old_month)
+            rows = session.query(Order.order_id, Order.order_id_secondary, Order.purchase_date, Order.buyer_name, Order.run).all()
+            items = session.query(OrderItem.order_id, OrderItem.sku_id, OrderItem.quantity).all() if archive else []
+            session.close()
+            del self.sessions[old_month]
+            db_path = self.get_path(old_month)
+            dispose_engine(db_path)
+            expired_path = f'{db_path}.expired'
+            try:
+                # fails if partition is still open (Windows), before anything is archived
+                os.replace(db_path, expired_path)
+            except OSError as e:
+                logging.warning(f'Failed to drop order partition {db_path}, retrying on next run. Err: {e}')
+                continue
+            try:
+                if archive:
+                    archive(old_month, rows, items)
+            except Exception as e:
+                logging.warning(f'Failed to archive order partition {old_month}, partition kept. Err: {e}')
+                os.replace(expired_path, db_path)
+                continue
+            delete_file(expired_path)
+            run_order_ids = dropped[old_month] = {}
+            for order_id, _, _, _, run in rows:
+                run_order_ids.setdefault(run, []).append(order_id)
+            logging.info(f'Order partition {old_month} with {len(rows)} orders dropped')
+        return dropped
+
+    def backup(self, backup_dir:str) -> int:
+        '''copies partitions changed since last backup (size, modification time) to backup_dir,
+        removes backups of dropped partitions. Returns count of copied partitions'''
+        os.makedirs(backup_dir, exist_ok=True)
+        months = self.months()
+        copied = 0
+        for month in months:
+            src_path = self.get_path(month)
+            dst_path = os.path.join(backup_dir, os.path.basename(src_path))
+            src_stat = os.stat(src_path)
+            if os.path.exists(dst_path):
+                dst_stat = os.stat(dst_path)
+                if (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns):
+                    continue
+            # copy2 keeps modification time, unchanged partition is recognized on next backup
+            shutil.copy2(src_path, dst_path)
+            copied += 1
+        for entry in os.scandir(backup_dir):
+            match = PARTITION_FNAME_PATTERN.match(entry.name)
+            if match and match.group(1) not in months:
+                os.remove(entry.path)
+        return copied
+
+    def migrate_legacy(self, run_months:dict):
+        '''moves orders and order items from unpartitioned main database tables to partitions of their run month
+        (run_months: {run id: month}), drops legacy tables. Orders of runs no longer in database are discarded'''
+        legacy = self.legacy_session
+        orders_by_month, items_by_month = {}, {}
+        for order in legacy.query(Order.order_id, Order.order_id_secondary, Order.purchase_date, Order.buyer_name, Order.run).all():
+            if order.run in run_months:
+                orders_by_month.setdefault(run_months[order.run], []).append(dict(order._mapping))
+        for order_id, sku_id, quantity, run in legacy.query(OrderItem.order_id, OrderItem.sku_id, OrderItem.quantity, Order.run).\
+                                                join(Order, Order.order_id == OrderItem.order_id).all():
+            if run in run_months:
+                items_by_month.setdefault(run_months[run], []).append({'order_id': order_id, 'sku_id': sku_id, 'quantity': quantity})
+        for month, orders in orders_by_month.items():
+            session = self.get_session(month, create=True)
+            session.execute(Order.__table__.insert(), orders)
+            if items_by_month.get(month):
+                session.execute(OrderItem.__table__.insert(), items_by_month[month])
+            session.commit()
+        engine = legacy.get_bind()
+        legacy.close()
+        self.legacy_session = None
+        OrderItem.__table__.drop(bind=engine)
+        Order.__table__.drop(bind=engine)
+        with engine.connect() as connection:
+            # once: give space of dropped tables back to file system
+            connection.exec_driver_sql('VACUUM')
+        logging.info(f'{sum(map(len, orders_by_month.values()))} orders migrated from main database to partitions: {sorted(orders_by_month)}')
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        if self.legacy_session:
+            self.legacy_session.close()
+
+
 class SQLAlchemyOrdersDB:
     '''Orders Database management. Two main methods:
 
@@ -80,10 +465,18 @@ class SQLAlchemyOrdersDB:
     Expected to be called outside of this cls to get self.new_orders var.
 
     add_orders_to_db() - pushes new orders (returned list from get_new_orders_only() method)
-    selected data to database, performs backups before and after each run, periodic flushing of old entries 
+    selected data to database, performs backups before and after each run, periodic flushing of old entries.
+    Parsed order['sku_quantities'] (if present) are bulk inserted to order_item table
     
     IMPORTANT NOTE: Amazon has unique order-item-id's (same order-id for different items in buyer's cart).
     Order model saves order['order-item-id'] for Amazon orders and for Etsy: order['Order ID']
+
+    Orders and order items are stored in monthly partitions (see OrderPartitions), runs, skus and sku deltas in main database.
+    Orders stored by previous versions in main database are moved to partitions on first (not read_only) use.
+
+    Order ids in db are mirrored per sales channel in OrderIDIndex (bloom filter + sorted hashes file).
+    Index keeps channel order count updated with added / deleted orders, it is rebuilt from db when missing or left by
+    interrupted update. Index is compared with db by check_order_index only
     
     Arguments:
 
@@ -96,65 +489,258 @@ class SQLAlchemyOrdersDB:
     proxy_keys - dict mapper of internal (based on amazon) order keys vs external sales_channel keys 
 
     testing - optional flag for testing (suspending backup, save add source_file_path to program_run table instead)
+
+    output_dir - optional directory for database, backups, source file backups and order indexes. Defaults to get_output_dir(client_file=False)
+
+    clock - optional callable returning current datetime (run timestamps, source backup names, archive cutoff). Used by simulations (db_growth.py)
+
+    read_only - optional flag for preview: database opened read-only (safe in parallel with real run), no backups,
+    no order id index (new orders are checked directly in db). Only get_new_orders_only() is meant to be called
+
+    progress - optional ProgressReporter updated while new orders are added (see progress.py)
+
+    close() - closes main and partition sessions, order id index
     '''
 
-    def __init__(self, orders:list, source_file_path:str, sales_channel:str, proxy_keys:dict, testing=False):
+    def __init__(self, orders:list, source_file_path:str, sales_channel:str, proxy_keys:dict, testing=False,
+                output_dir:str=None, clock=datetime.datetime.now, read_only:bool=False, progress:ProgressReporter=None):
         self.orders = orders
         self.source_file_path = source_file_path
         self.sales_channel = sales_channel
         self.proxy_keys = proxy_keys
         self.testing = testing
+        self.output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+        self.clock = clock
+        self.read_only = read_only
+        self.progress = progress if progress else ProgressReporter()
         self.__setup_db()
+        self.partitions = OrderPartitions(self.output_dir, read_only, main_engine=self.engine if self.db_exists else None)
+        if self.read_only:
+            self.session = self.get_session()
+            self.order_index = None
+            return
         self._backup_db(self.db_backup_b4_path)
         self.session = self.get_session()
+        if self.partitions.legacy_session:
+            self._migrate_unpartitioned_orders()
+        self.order_index = OrderIDIndex(self.sales_channel, self.output_dir)
+        if self.daily_sales_created:
+            self.rebuild_daily_sales()
 
     def __setup_db(self):
         self.__get_db_paths()
-        if not os.path.exists(self.db_path):
-            self.__get_engine()
-            Base.metadata.create_all(bind=self.engine)
+        db_exists = self.db_exists = os.path.exists(self.db_path)
+        self.__get_engine()
+        self.daily_sales_created = False
+        if self.read_only:
+            return
+        # daily sales buckets of existing database are backfilled from stored order items once
+        self.daily_sales_created = db_exists and not inspect(self.engine).has_table(SKUDailySales.__tablename__)
+        # creates only missing tables, so tables added in later versions appear in existing databases
+        Base.metadata.create_all(bind=self.engine, tables=MAIN_TABLES)
+        if not db_exists:
             logging.info(f'Database has been created at {self.db_path}')
 
     def __get_db_paths(self):
-        output_dir = get_output_dir(client_file=False)
-        self.db_path = os.path.join(output_dir, DATABASE_NAME)
-        self.db_backup_b4_path = os.path.join(output_dir, BACKUP_DB_BEFORE_NAME)
-        self.db_backup_after_path = os.path.join(output_dir, BACKUP_DB_AFTER_NAME)
+        self.db_path = get_db_path(self.output_dir)
+        self.db_backup_b4_path = os.path.join(self.output_dir, BACKUP_DB_BEFORE_NAME)
+        self.db_backup_after_path = os.path.join(self.output_dir, BACKUP_DB_AFTER_NAME)
 
     def __get_engine(self):
-        engine_path = f'sqlite:///{self.db_path}'
-        self.engine = create_engine(engine_path, echo=False)
+        self.engine = get_engine(self.db_path, self.read_only)
     
+    @property
+    def db_missing(self) -> bool:
+        '''read_only client opened before database was created (read-only connection can not create it).
+        Queries of such client return empty results. db_exists is set once at setup (before write mode creates database)'''
+        return self.read_only and not self.db_exists
+
     def get_session(self):
         '''returns database session object to work outside the scope of class. For example querying'''
         self.__get_engine()
         Session = sessionmaker(bind=self.engine)
         return Session()
 
-    def add_orders_to_db(self):
+    def close(self):
+        '''closes main database, partitions sessions and order id index'''
+        self.session.close()
+        self.partitions.close()
+        if self.order_index:
+            self.order_index.close()
+
+    def _migrate_unpartitioned_orders(self):
+        '''moves orders stored in main database by previous versions to monthly partitions of their runs'''
+        run_months = {run_id: get_partition_month(timestamp) for run_id, timestamp in self.session.query(ProgramRun.id, ProgramRun.timestamp).all()}
+        self.session.close()
+        self.partitions.migrate_legacy(run_months)
+
+    def add_orders_to_db(self, export_obj:dict=None):
         '''filters passed orders to cls to only those, whose order_id
         (db table unique constraint) is not present in db yet adds them to db
-        assumes get_new_orders_only was called outside of this cls before to get self.new_orders'''
+        assumes get_new_orders_only was called outside of this cls before to get self.new_orders
+
+        export_obj - optional {sku: qty} dict added to helper file in this run, saved as run sku deltas'''
         try:
             if self.new_orders:
                 self._add_new_orders_to_db(self.new_orders)
+                self._add_run_sku_deltas(export_obj if export_obj else {})
                 self.flush_old_records()
                 self._backup_db(self.db_backup_after_path)
             logging.debug(f'{len(self.new_orders)} (order count) new orders added, flushing old records complete, backup after created at: {self.db_backup_after_path}')
             return len(self.new_orders)
         except Exception as e:
-            logging.critical(f'Unexpected err {e} trying to add orders to db. Alerting VBA, terminating program immediately via exit().')
-            print(VBA_ERROR_ALERT)
-            exit()
+            logging.critical(f'Unexpected err {e} trying to add orders to db. Alerting VBA, terminating program.')
+            raise DatabaseError(f'Failed to add orders to db: {e}') from e
 
     def _add_new_orders_to_db(self, new_orders:list):
-        '''create new entry in program_runs table, add new orders'''
+        '''create new entry in program_runs table, add new orders to partition of run month'''
         self.new_run = self._add_new_run()
-        self.added_to_db_counter = 0
-        for order in new_orders:
+        self.orders_session = self.partitions.get_session(get_partition_month(self.new_run.timestamp), create=True)
+        self.added_order_ids = []
+        for order in self.progress.iterate(new_orders):
             self._add_single_order(order)
-        logging.debug(f'{self.added_to_db_counter} new orders added to db (actual counter of commits)')
-            
+        self.order_index.add(self.added_order_ids)
+        logging.debug(f'{len(self.added_order_ids)} new orders added to db (actual counter of commits)')
+        self._add_order_items(new_orders)
+
+    def _add_order_items(self, new_orders:list):
+        '''bulk inserts parsed sku quantities of orders added in this run to order_item table'''
+        order_id_key = self.proxy_keys['order-id']
+        added_order_ids = set(self.added_order_ids)
+        parsed_orders = []
+        for order in new_orders:
+            # first occurrence of order id is the one added to db (rest were rejected by IntegrityError)
+            if order[order_id_key] in added_order_ids and 'sku_quantities' in order:
+                added_order_ids.discard(order[order_id_key])
+                parsed_orders.append(order)
+        sku_ids = self.get_sku_ids(set(sku for order in parsed_orders for sku in order['sku_quantities']))
+        order_items = [{'order_id': order[order_id_key], 'sku_id': sku_ids[sku], 'quantity': quantity}
+                        for order in parsed_orders for sku, quantity in order['sku_quantities'].items()]
+        if order_items:
+            self.orders_session.execute(OrderItem.__table__.insert(), order_items)
+            self.orders_session.commit()
+        logging.debug(f'{len(order_items)} order items of {len(parsed_orders)} parsed orders added to db')
+        purchase_date_key = self.proxy_keys['purchase-date']
+        self._update_daily_sales(self.sales_channel, self.new_run.timestamp,
+                                ((order[purchase_date_key], sku_ids[sku], quantity) for order in parsed_orders
+                                for sku, quantity in order['sku_quantities'].items()))
+
+    def _update_daily_sales(self, sales_channel:str, run_timestamp:datetime.datetime, item_sales, sign:int=1):
+        '''adds (sign=-1: subtracts) item_sales - iterable of (purchase date, sku id, quantity) - to sku_daily_sales buckets
+        of sales_channel in single upsert. Sales older than daily sales window are skipped'''
+        adapter = get_channel(sales_channel)
+        run_day = get_day_key(run_timestamp)
+        window_start = self.__get_daily_sales_cutoff()
+        buckets = {}
+        for purchase_date, sku_id, quantity in item_sales:
+            sale_day = adapter.get_sale_day(purchase_date)
+            day = get_day_key(sale_day) if sale_day else run_day
+            if day < window_start:
+                continue
+            bucket = buckets.setdefault((day, sku_id), [0, 0])
+            bucket[0] += quantity
+            bucket[1] += 1
+        if not buckets:
+            return
+        rows = [{'day': day, 'sales_channel': sales_channel, 'sku_id': sku_id, 'quantity': sign * quantity, 'orders_count': sign * orders_count}
+                for (day, sku_id), (quantity, orders_count) in buckets.items()]
+        insert = sqlite_insert(SKUDailySales.__table__)
+        upsert = insert.on_conflict_do_update(index_elements=['sku_id', 'day', 'sales_channel'],
+                    set_={'quantity': SKUDailySales.__table__.c.quantity + insert.excluded.quantity,
+                        'orders_count': SKUDailySales.__table__.c.orders_count + insert.excluded.orders_count})
+        for i in range(0, len(rows), SQL_IN_CHUNK_SIZE):
+            self.session.execute(upsert, rows[i:i + SQL_IN_CHUNK_SIZE])
+        if sign < 0:
+            self.session.query(SKUDailySales).filter(SKUDailySales.orders_count <= 0).delete(synchronize_session=False)
+        self.session.commit()
+        logging.debug(f'{len(rows)} {sales_channel} daily sales buckets updated (sign: {sign})')
+
+    def rebuild_daily_sales(self):
+        '''recreates sku_daily_sales buckets of daily sales window from order items in partitions
+        (first run after upgrade, database restored from backup)'''
+        runs = {run_id: (sales_channel, timestamp) for run_id, sales_channel, timestamp in
+                self.session.query(ProgramRun.id, ProgramRun.sales_channel, ProgramRun.timestamp).all()}
+        run_sales = {}
+        for run_id, purchase_date, sku_id, quantity in self.partitions.get_item_sale_rows():
+            if run_id in runs:
+                run_sales.setdefault(run_id, []).append((purchase_date, sku_id, quantity))
+        self.session.query(SKUDailySales).delete(synchronize_session=False)
+        for run_id, item_sales in run_sales.items():
+            self._update_daily_sales(*runs[run_id], item_sales)
+        self.session.commit()
+        logging.info(f'Daily sales buckets rebuilt from order items of {len(run_sales)} runs')
+
+    def _add_run_sku_deltas(self, export_obj:dict):
+        '''bulk inserts export_obj quantities associated with current run to run_sku_delta table'''
+        sku_ids = self.get_sku_ids(set(export_obj))
+        run_sku_deltas = [{'run': self.new_run.id, 'sku_id': sku_ids[sku], 'quantity': quantity} for sku, quantity in export_obj.items()]
+        if run_sku_deltas:
+            self.session.execute(RunSKUDelta.__table__.insert(), run_sku_deltas)
+            self.session.commit()
+        logging.debug(f'{len(run_sku_deltas)} sku deltas saved for run {self.new_run.id}')
+
+    def get_listing_compositions(self, sales_channel:str) -> dict:
+        '''returns {(skus, items): [multipliers]} learned listing compositions of sales_channel (see listing_compositions.py)'''
+        if self.db_missing or (self.read_only and not inspect(self.engine).has_table(ListingComposition.__tablename__)):
+            return {}
+        rows = self.session.query(ListingComposition.skus, ListingComposition.items, ListingComposition.multipliers).\
+                    filter(ListingComposition.sales_channel == sales_channel).all()
+        return {(skus, items): [int(value) for value in multipliers.split(',')] for skus, items, multipliers in rows}
+
+    def add_listing_compositions(self, sales_channel:str, compositions:dict):
+        '''inserts / updates {(skus, items): [multipliers]} listing compositions of sales_channel'''
+        if not compositions:
+            return
+        rows = [{'sales_channel': sales_channel, 'skus': skus, 'items': items, 'multipliers': ','.join(map(str, multipliers)),
+                'timestamp': self.clock()} for (skus, items), multipliers in compositions.items()]
+        insert = sqlite_insert(ListingComposition.__table__)
+        upsert = insert.on_conflict_do_update(index_elements=['sales_channel', 'skus', 'items'],
+                    set_={'multipliers': insert.excluded.multipliers, 'timestamp': insert.excluded.timestamp})
+        self.session.execute(upsert, rows)
+        self.session.commit()
+        logging.debug(f'{len(rows)} {sales_channel} listing compositions saved')
+
+    def get_run_sku_deltas(self, run_id:int) -> dict:
+        '''returns {sku: qty} dict of quantities added to helper file by program run run_id'''
+        deltas = self.session.query(SKU.code, RunSKUDelta.quantity).join(RunSKUDelta, RunSKUDelta.sku_id == SKU.id).\
+                    filter(RunSKUDelta.run == run_id).all()
+        return dict(deltas)
+
+    def delete_run(self, run_id:int) -> int:
+        '''deletes program run run_id, its orders, order items and sku deltas (cascade), removes orders from order id index,
+        deletes source file backup and backs up db afterwards. Returns count of deleted orders'''
+        run = self.session.query(ProgramRun).filter_by(id=run_id).one()
+        run_month = get_partition_month(run.timestamp)
+        run_sales = [(purchase_date, sku_id, quantity) for _, purchase_date, sku_id, quantity in self.partitions.get_item_sale_rows(run_id, run_month)]
+        self._update_daily_sales(run.sales_channel, run.timestamp, run_sales, sign=-1)
+        deleted_order_ids = self.partitions.delete_run(run_id, run_month)
+        logging.info(f'Deleting {run} with {len(deleted_order_ids)} orders')
+        if os.path.dirname(os.path.abspath(run.fpath)) == get_src_files_folder(self.output_dir):
+            delete_file(run.fpath)
+        self.session.delete(run)
+        self.session.commit()
+        self._remove_from_order_indexes({run.sales_channel: deleted_order_ids})
+        self._backup_db(self.db_backup_after_path)
+        return len(deleted_order_ids)
+
+    def get_sku_ids(self, sku_codes:set) -> dict:
+        '''returns {sku_code: sku_id} for passed sku_codes, interning codes not yet present in sku table'''
+        sku_codes = list(sku_codes)
+        sku_ids = self._query_sku_ids(sku_codes)
+        missing_codes = [sku for sku in sku_codes if sku not in sku_ids]
+        if missing_codes:
+            self.session.execute(SKU.__table__.insert(), [{'code': sku} for sku in missing_codes])
+            self.session.commit()
+            sku_ids.update(self._query_sku_ids(missing_codes))
+        return sku_ids
+
+    def _query_sku_ids(self, sku_codes:list) -> dict:
+        '''returns {sku_code: sku_id} for sku_codes already in sku table'''
+        sku_ids = {}
+        for i in range(0, len(sku_codes), SQL_IN_CHUNK_SIZE):
+            chunk = sku_codes[i:i + SQL_IN_CHUNK_SIZE]
+            sku_ids.update(self.session.query(SKU.code, SKU.id).filter(SKU.code.in_(chunk)).all())
+        return sku_ids
 
     def _add_single_order(self, order_dict:dict):
         '''adds single order to database (via session.add(new_order))'''
@@ -163,25 +749,26 @@ class SQLAlchemyOrdersDB:
                             purchase_date = order_dict[self.proxy_keys['purchase-date']],
                             buyer_name = order_dict[self.proxy_keys['buyer-name']],
                             run = self.new_run.id)
-            if self.new_run.sales_channel != 'Etsy':
-                # Additionally add original order-id (may have duplicates for multiple items in shopping cart) for AmazonCOM, AmazonEU
-                # Both Amazon and Amazon Warehouse have 'secondary-order-id' secondary key
-                new_order.order_id_secondary = order_dict[self.proxy_keys['secondary-order-id']]
+            # Additionally add buyer cart id: original order-id for Amazon (duplicates for multiple items in shopping cart),
+            # Amazon Order Id for Amazon Warehouse, Order ID for Etsy
+            new_order.order_id_secondary = order_dict[self.proxy_keys['same-buyer-order-id']]
             
-            self.session.add(new_order)
-            self.session.commit()
-            self.added_to_db_counter += 1
+            self.orders_session.add(new_order)
+            self.orders_session.commit()
+            self.added_order_ids.append(new_order.order_id)
         except IntegrityError as e:
-            logging.warning(f'Order from channel: {self.sales_channel} w/ proxy order-id: {order_dict[self.proxy_keys["order-id"]]} \
-                already in database. Integrity error {e}. Skipping addition of said order, rolling back db session')
-            self.session.rollback()
+            logging.warning('Order from channel: %s w/ proxy order-id: %s already in database. Integrity error %s. '
+                            'Skipping addition of said order, rolling back db session', self.sales_channel, order_dict[self.proxy_keys['order-id']], e.orig)
+            self.orders_session.rollback()
 
     def _add_new_run(self) -> object:
         '''adds new row in program_run table, returns new run object (attributes: id, sales_channel, fpath, timestamp),
         creates source file backup, saves its path. On testing - save original file path'''        
-        backup_path = self.source_file_path if self.testing else create_src_file_backup(self.source_file_path, self.sales_channel)
+        run_timestamp = self.clock()
+        backup_path = self.source_file_path if self.testing else \
+                    create_src_file_backup(self.source_file_path, self.sales_channel, self.output_dir, run_timestamp)
         logging.debug(f'This is backup path being saved to program_run fpath column: {backup_path}')
-        new_run = ProgramRun(fpath=backup_path, sales_channel=self.sales_channel)
+        new_run = ProgramRun(fpath=backup_path, sales_channel=self.sales_channel, timestamp=run_timestamp)
         self.session.add(new_run)
         self.session.commit()
         logging.debug(f'Added new run: {new_run}, created backup')
@@ -189,48 +776,192 @@ class SQLAlchemyOrdersDB:
 
     def get_new_orders_only(self) -> list:
         '''From passed orders to cls, returns only orders NOT YET in database.
-        Called from main.py to filter old, parsed orders'''
-        orders_in_db = self._get_channel_order_ids_in_db()
-        self.new_orders = [order_data for order_data in self.orders if order_data[self.proxy_keys['order-id']] not in orders_in_db]
-        logging.info(f'Returning {len(self.new_orders)}/{len(self.orders)} new/loaded orders for further processing')
+        Called from main.py to filter old, parsed orders.
+
+        Order ids are first checked against in-memory (mapped) OrderIDIndex, only possible positives are queried in db.
+        In read_only mode all order ids are queried in db (index is neither read nor rebuilt)'''
+        order_id_key = self.proxy_keys['order-id']
+        if self.read_only:
+            possible_duplicates = [order_data[order_id_key] for order_data in self.orders] if self.db_exists else []
+        else:
+            self._sync_order_index()
+            possible_duplicates = self.order_index.get_possible_members(order_data[order_id_key] for order_data in self.orders)
+        orders_in_db = self._get_channel_order_ids_in_db(possible_duplicates)
+        self.new_orders = [order_data for order_data in self.orders if order_data[order_id_key] not in orders_in_db]
+        logging.info(f'Returning {len(self.new_orders)}/{len(self.orders)} new/loaded orders for further processing. '
+                    f'Possible duplicates checked in db: {len(possible_duplicates)}')
         return self.new_orders
 
-    def _get_channel_order_ids_in_db(self) -> list:
-        '''returns a list of order ids currently present in 'orders' database table for current run self.sales_channel'''
-        db_orders_of_sales_channel = self.session.query(Order).join(ProgramRun).filter(ProgramRun.sales_channel==self.sales_channel).all()
+    def get_cart_orders(self, cart_ids:list) -> dict:
+        '''returns {cart id: [(order id, run id), ...]} of current sales channel orders in db, grouped by buyer cart'''
+        if self.db_missing:
+            return {}
+        run_ids = self._get_channel_run_ids(self.sales_channel)
+        carts = {}
+        for cart_id, order_id, run_id in self.partitions.get_cart_rows(cart_ids):
+            if run_id in run_ids:
+                carts.setdefault(cart_id, []).append((order_id, run_id))
+        return carts
+
+    def get_cart_sku_totals(self, cart_ids:list) -> dict:
+        '''returns {cart id: {sku code: quantity}} summed over current sales channel order items in db'''
+        if self.db_missing:
+            return {}
+        run_ids = self._get_channel_run_ids(self.sales_channel)
+        rows = [(cart_id, sku_id, quantity) for cart_id, run_id, sku_id, quantity in self.partitions.get_cart_item_rows(cart_ids)
+                if run_id in run_ids]
+        sku_ids = list({sku_id for _, sku_id, _ in rows})
+        sku_codes = {}
+        for i in range(0, len(sku_ids), SQL_IN_CHUNK_SIZE):
+            sku_codes.update(self.session.query(SKU.id, SKU.code).filter(SKU.id.in_(sku_ids[i:i + SQL_IN_CHUNK_SIZE])).all())
+        totals = {}
+        for cart_id, sku_id, quantity in rows:
+            cart_totals = totals.setdefault(cart_id, {})
+            sku_code = sku_codes[sku_id]
+            cart_totals[sku_code] = cart_totals.get(sku_code, 0) + quantity
+        return totals
+
+    def get_split_carts(self, orders:list) -> dict:
+        '''returns {cart id: sorted earlier run ids} of orders' buyer carts, partially added to db by earlier runs
+        (cart items shipped / exported in several reports). Empty for channels, where cart id is order id (Etsy)'''
+        cart_key = self.proxy_keys.get('same-buyer-order-id')
+        if not cart_key or cart_key == self.proxy_keys['order-id'] or self.db_missing:
+            return {}
+        cart_ids = {order[cart_key] for order in orders if order.get(cart_key)}
+        split_carts = {cart_id: sorted({run_id for _, run_id in cart_orders})
+                        for cart_id, cart_orders in self.get_cart_orders(cart_ids).items()}
+        if split_carts:
+            logging.info(f'{len(split_carts)} buyer carts of new orders were partially added by earlier runs')
+        return split_carts
+
+    def _get_channel_order_ids_in_db(self, order_ids:list) -> set:
+        '''returns a set of order_ids that are present in orders partitions for current run self.sales_channel.
+        Empty if database is missing in read_only mode (see db_missing)'''
+        if self.db_missing:
+            return set()
         # Unlikely conflict: Etsy / Amazon EU having same order-(item-)id as AmazonCOM or similar permutations between sales channels and id's
-        order_id_lst_in_db = [order_obj.order_id for order_obj in db_orders_of_sales_channel]
-        logging.debug(f'Before inserting new orders, orders table contains {len(order_id_lst_in_db)} entries associated with {self.sales_channel} channel')
-        return order_id_lst_in_db
+        order_ids_in_db = self.partitions.get_existing_order_ids(order_ids, self._get_channel_run_ids(self.sales_channel))
+        logging.debug(f'{len(order_ids_in_db)}/{len(set(order_ids))} possible duplicates confirmed in db for {self.sales_channel} channel')
+        return order_ids_in_db
+
+    def _get_channel_run_ids(self, sales_channel:str) -> set:
+        '''returns ids of program runs of sales_channel'''
+        return {run_id for run_id, in self.session.query(ProgramRun.id).filter(ProgramRun.sales_channel==sales_channel).all()}
+
+    def _get_all_channel_order_ids(self, sales_channel:str) -> list:
+        '''returns list of all order ids in db associated with sales_channel'''
+        return self.partitions.get_run_order_ids(self._get_channel_run_ids(sales_channel))
+
+    def _sync_order_index(self):
+        '''rebuilds order index from db if it is missing, corrupted or was left by interrupted update. Db orders are not counted
+        on every run: index count is kept up to date by add / remove, manual db edits require check_order_index'''
+        if self.order_index.needs_rebuild():
+            logging.warning(f'Order id index for {self.sales_channel} missing or out of sync with db (index: {self.order_index.db_order_count}). '
+                            f'Rebuilding index from db')
+            self.check_order_index()
+
+    def check_order_index(self, sales_channel:str=None) -> bool:
+        '''consistency checker. Compares order id index of sales_channel (defaults to current channel) with db contents
+        and rebuilds index from db. Returns True if index was consistent with db before rebuild'''
+        sales_channel = sales_channel if sales_channel else self.sales_channel
+        order_index = self.order_index if sales_channel == self.sales_channel else OrderIDIndex(sales_channel, self.output_dir)
+        db_order_ids = self._get_all_channel_order_ids(sales_channel)
+        consistent = order_index.is_synced(len(db_order_ids)) and order_index.matches(db_order_ids)
+        order_index.rebuild(db_order_ids)
+        logging.info(f'Order id index for {sales_channel} rebuilt from {len(db_order_ids)} db orders. Was consistent: {consistent}')
+        if order_index is not self.order_index:
+            order_index.close()
+        return consistent
 
     def flush_old_records(self):
-        '''deletes old runs, associated backup files and orders (deleting runs delete cascade associated orders)'''
+        '''drops partitions holding orders and order items of old runs (see _get_old_runs), dropped orders are written to OrderArchive.
+        Deletes old runs, associated backup files and sku deltas (cascade) only if their partition month was dropped
+        (or has no partition): runs of kept (locked, failed archive) partitions stay until partition is dropped on later run'''
+        partition_month = get_partition_month(self.__get_archive_cutoff())
         old_runs = self._get_old_runs()
         try:
+            run_channels = {run.id: run.sales_channel for run in old_runs}
+            archive = functools.partial(self._archive_partition, OrderArchive(self.output_dir))
+            deleted_order_ids = {}
+            for run_order_ids in self.partitions.drop_before(partition_month, archive).values():
+                for run_id, order_ids in run_order_ids.items():
+                    if run_id in run_channels:
+                        deleted_order_ids.setdefault(run_channels[run_id], []).extend(order_ids)
+            kept_months = set(get_partition_month(run.timestamp) for run in old_runs) & set(self.partitions.months())
+            if kept_months:
+                logging.warning(f'Keeping old runs of not dropped partition months {sorted(kept_months)} until next run')
             for run in old_runs:
-                orders_in_run = self.session.query(Order).filter_by(run_obj=run).all()
-                logging.info(f'Deleting {len(orders_in_run)} orders associated with old {run} and backup file: {run.fpath}')
-                delete_file(run.fpath)   
+                if get_partition_month(run.timestamp) in kept_months:
+                    continue
+                logging.info(f'Deleting old {run} and backup file: {run.fpath}')
+                delete_file(run.fpath)
                 self.session.delete(run)
+            deleted_buckets = self.session.query(SKUDailySales).filter(SKUDailySales.day < self.__get_daily_sales_cutoff()).\
+                                    delete(synchronize_session=False)
             self.session.commit()
+            logging.debug(f'{deleted_buckets} daily sales buckets older than {ORDERS_ARCHIVE_DAYS} days deleted')
+            self._remove_from_order_indexes(deleted_order_ids)
         except Exception as e:
-            logging.warning(f'Unexpected err while flushing old records from db inside flush_old_records. Err: {e}. Last recorded run {run}')
+            logging.warning(f'Unexpected err while flushing old records from db inside flush_old_records. Err: {e}. Old runs: {old_runs}')
+
+    def _archive_partition(self, archive:OrderArchive, month:str, orders:list, order_items:list):
+        '''writes orders of dropped partition month with their sku quantities and run details to archive.
+        Run details are read from database: runs are deleted only after their partition is dropped (see flush_old_records)'''
+        runs = {}
+        run_ids = list(set(run_id for *_, run_id in orders))
+        for i in range(0, len(run_ids), SQL_IN_CHUNK_SIZE):
+            runs.update((run.id, run) for run in self.session.query(ProgramRun).filter(ProgramRun.id.in_(run_ids[i:i + SQL_IN_CHUNK_SIZE])))
+        sku_codes = {}
+        sku_ids = list(set(sku_id for _, sku_id, _ in order_items))
+        for i in range(0, len(sku_ids), SQL_IN_CHUNK_SIZE):
+            sku_codes.update(self.session.query(SKU.id, SKU.code).filter(SKU.id.in_(sku_ids[i:i + SQL_IN_CHUNK_SIZE])).all())
+        order_skus = {}
+        for order_id, sku_id, quantity in order_items:
+            order_skus.setdefault(order_id, {})[sku_codes.get(sku_id, sku_id)] = quantity
+        records = []
+        for order_id, order_id_secondary, purchase_date, buyer_name, run_id in orders:
+            run = runs.get(run_id)
+            records.append({'order_id': order_id, 'order_id_secondary': order_id_secondary, 'purchase_date': purchase_date,
+                            'buyer_name': buyer_name, 'sku_quantities': order_skus.get(order_id, {}), 'run': run_id,
+                            'sales_channel': run.sales_channel if run else None,
+                            'run_timestamp': run.timestamp.isoformat(sep=' ') if run else None,
+                            'source_file': os.path.basename(run.fpath) if run else None})
+        archive.add(month, records)
+
+    def _remove_from_order_indexes(self, deleted_order_ids:dict):
+        '''removes deleted orders from order id indexes of each affected sales channel. deleted_order_ids: {channel: [order_id, ...]}'''
+        for sales_channel, order_ids in deleted_order_ids.items():
+            order_index = self.order_index if sales_channel == self.sales_channel else OrderIDIndex(sales_channel, self.output_dir)
+            order_index.remove(order_ids)
+            if order_index is not self.order_index:
+                order_index.close()
+
+    def __get_archive_cutoff(self) -> datetime.datetime:
+        return self.clock() - datetime.timedelta(days=ORDERS_ARCHIVE_DAYS)
+
+    def __get_daily_sales_cutoff(self) -> int:
+        '''returns first day key kept in sku_daily_sales: ORDERS_ARCHIVE_DAYS window'''
+        return get_day_key(self.__get_archive_cutoff())
 
     def _get_old_runs(self):
-        '''returns runs that were added ORDERS_ARCHIVE_DAYS (global var) or more days ago'''
-        delete_before_this_timestamp = datetime.datetime.now() - datetime.timedelta(days=ORDERS_ARCHIVE_DAYS)        
+        '''returns runs of whole partition months added ORDERS_ARCHIVE_DAYS (global var) or more days ago
+        (runs are kept ORDERS_ARCHIVE_DAYS up to ORDERS_ARCHIVE_DAYS + 1 month)'''
+        cutoff = self.__get_archive_cutoff()
+        delete_before_this_timestamp = datetime.datetime(cutoff.year, cutoff.month, 1)
         runs = self.session.query(ProgramRun).filter(ProgramRun.timestamp < delete_before_this_timestamp).all()
         return runs
 
     def _backup_db(self, backup_db_path):
-        '''creates database backup file at backup_db_path in production (testing = False)'''
+        '''creates database backup file at backup_db_path in production (testing = False).
+        Changed order partitions are copied to '<backup_db_path name> partitions' folder'''
         if self.testing:
             logging.debug(f'Backup for {os.path.basename(backup_db_path)} suspended due to testing: {self.testing}')
             return
         try:
             shutil.copy(src=self.db_path, dst=backup_db_path)
+            partitions_copied = self.partitions.backup(f'{os.path.splitext(backup_db_path)[0]} partitions')
             logging.info(f"New database backup {os.path.basename(backup_db_path)} created on: "
-                        f"{datetime.datetime.today().strftime('%Y-%m-%d %H:%M')} location: {backup_db_path}")
+                        f"{datetime.datetime.today().strftime('%Y-%m-%d %H:%M')} location: {backup_db_path}. Changed partitions copied: {partitions_copied}")
         except Exception as e:
             logging.warning(f'Failed to create database backup for {os.path.basename(backup_db_path)}. Err: {e}')
 
@@ -0,0 +1,247 @@
+import statistics
+import argparse
+import logging
+import tempfile
+import shutil
+import time
+import csv
+import os
+from datetime import datetime, timedelta
+from database import SQLAlchemyOrdersDB, ProgramRun, ORDERS_ARCHIVE_DAYS, ORDER_PARTITIONS_DIR
+from order_index import get_order_index_folder
+from order_plan import ChannelPlan
+from sample_data import generate_orders, get_sample_skus, write_export
+from utils import get_src_files_folder
+from constants import SALES_CHANNEL_PROXY_KEYS
+
+
+# GLOBAL VARIABLES
+SIM_DAYS = ORDERS_ARCHIVE_DAYS + 30
+ORDERS_PER_DAY = 100
+# each daily export also contains orders of previous days (duplicates filtered by db)
+EXPORT_DAYS = 3
+BUCKET_DAYS = 10
+# order ids of sales channels are generated in separate ranges (order.order_id is unique across channels)
+CHANNEL_ID_RANGE = 10**10
+SIM_START = datetime(2022, 1, 3, 9, 0)
+# timed SQLAlchemyOrdersDB methods (in call order of single program run)
+TIMED_OPERATIONS = ['get_new_orders_only', '_add_new_orders_to_db', '_add_run_sku_deltas', 'flush_old_records', '_backup_db']
+CSV_COLUMNS = ['day', 'timestamp', 'sales_channel', 'loaded_orders', 'new_orders', 'db_runs', 'db_orders', 'db_order_items',
+            'open_ms', 'plan_ms'] + [f'{operation}_ms' for operation in TIMED_OPERATIONS] + \
+            ['run_ms', 'db_size_kb', 'index_size_kb', 'src_files_kb']
+
+
+class SimulatedClock():
+    '''callable returning simulated current datetime. Passed to SQLAlchemyOrdersDB as clock'''
+
+    def __init__(self, start:datetime=SIM_START):
+        self.now = start
+
+    def __call__(self) -> datetime:
+        return self.now
+
+    def set(self, now:datetime):
+        self.now = now
+
+
+class DBGrowthSimulation():
+    '''Simulates daily program runs per sales channel against fresh database in scratch directory with controllable clock.
+    Runs longer than ORDERS_ARCHIVE_DAYS reach steady state, where each run also flushes runs and orders older than archive window.
+
+    Records per run latency of every timed database operation (TIMED_OPERATIONS), db size and row counts.
+
+    Args:
+    - scratch_dir:str - directory for database, backups, source files and exports
+    - days:int - simulated days
+    - orders_per_day:int - new orders per day per channel
+    - export_days:int - days covered by each daily export (export_days - 1 days of duplicates)
+    - sales_channels:list - simulated sales channels, run once a day each
+
+    Main method:
+    - run(on_run=None) - simulates all days, returns list of result rows (dicts, CSV_COLUMNS keys)'''
+
+    def __init__(self, scratch_dir:str, days:int=SIM_DAYS, orders_per_day:int=ORDERS_PER_DAY, export_days:int=EXPORT_DAYS,
+                sales_channels:list=None):
+        self.scratch_dir = scratch_dir
+        self.days = days
+        self.orders_per_day = orders_per_day
+        self.export_days = export_days
+        self.sales_channels = sales_channels if sales_channels else list(SALES_CHANNEL_PROXY_KEYS)
+        self.clock = SimulatedClock()
+        self.sku_pool = get_sample_skus(3000)
+        self.exports_dir = os.path.join(scratch_dir, 'exports')
+        os.makedirs(self.exports_dir, exist_ok=True)
+        self.__daily_orders = {}
+
+    def run(self, on_run=None) -> list:
+        '''simulates self.days days of runs. Optional on_run(row) is called after each run'''
+        rows = []
+        for day in range(self.days):
+            for channel_no, sales_channel in enumerate(self.sales_channels):
+                self.clock.set(SIM_START + timedelta(days=day, minutes=channel_no))
+                row = self.simulate_run(day, sales_channel)
+                rows.append(row)
+                if on_run:
+                    on_run(row)
+        return rows
+
+    def simulate_run(self, day:int, sales_channel:str) -> dict:
+        '''mirrors main_inventory.main db usage for single daily export. Returns result row'''
+        proxy_keys = SALES_CHANNEL_PROXY_KEYS[sales_channel]
+        orders = self._get_export_orders(day, sales_channel)
+        source_fpath = os.path.join(self.exports_dir, f'{sales_channel} day {day}.txt')
+        write_export(source_fpath, orders, sales_channel)
+        timings = {}
+        run_start = time.perf_counter()
+
+        start = time.perf_counter()
+        db_client = SQLAlchemyOrdersDB(orders, source_fpath, sales_channel, proxy_keys, output_dir=self.scratch_dir, clock=self.clock)
+        timings['open'] = time.perf_counter() - start
+        self._time_operations(db_client, timings)
+
+        new_orders = db_client.get_new_orders_only()
+        start = time.perf_counter()
+        plan_result = ChannelPlan(sales_channel, proxy_keys).run(new_orders)
+        timings['plan'] = time.perf_counter() - start
+        if new_orders:
+            db_client.add_orders_to_db(plan_result.sku_totals)
+        timings['run'] = time.perf_counter() - run_start
+
+        row = {'day': day, 'timestamp': self.clock().isoformat(sep=' '), 'sales_channel': sales_channel,
+            'loaded_orders': len(orders), 'new_orders': len(new_orders)}
+        row.update(self._get_db_counts(db_client))
+        db_client.close()
+        db_client.engine.dispose()
+        row.update({f'{name}_ms': round(timings.get(name, 0) * 1000, 2) for name in ['open', 'plan', 'run'] + TIMED_OPERATIONS})
+        row.update(self._get_sizes())
+        os.remove(source_fpath)
+        return row
+
+    @staticmethod
+    def _time_operations(db_client:SQLAlchemyOrdersDB, timings:dict):
+        '''wraps TIMED_OPERATIONS methods of db_client instance, accumulating their wall time into timings'''
+        for operation in TIMED_OPERATIONS:
+            method = getattr(db_client, operation)
+            def timed(*args, _method=method, _operation=operation, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return _method(*args, **kwargs)
+                finally:
+                    timings[_operation] = timings.get(_operation, 0) + time.perf_counter() - start
+            setattr(db_client, operation, timed)
+
+    def _get_export_orders(self, day:int, sales_channel:str) -> list:
+        '''returns raw orders of export downloaded on day: orders purchased during last export_days days'''
+        orders = []
+        for export_day in range(max(day - self.export_days + 1, 0), day + 1):
+            orders.extend(dict(order) for order in self._get_daily_orders(export_day, sales_channel))
+        return orders
+
+    def _get_daily_orders(self, day:int, sales_channel:str) -> list:
+        '''returns (cached) orders purchased on day. Order ids are unique per day and sales channel'''
+        key = (day, sales_channel)
+        if key not in self.__daily_orders:
+            id_offset = self.sales_channels.index(sales_channel) * CHANNEL_ID_RANGE + day * self.orders_per_day
+            self.__daily_orders[key] = generate_orders(sales_channel, self.orders_per_day, self.sku_pool,
+                    start=SIM_START + timedelta(days=day - 1), seed=day, id_offset=id_offset)
+            self.__daily_orders.pop((day - self.export_days, sales_channel), None)
+        return self.__daily_orders[key]
+
+    @staticmethod
+    def _get_db_counts(db_client:SQLAlchemyOrdersDB) -> dict:
+        orders_count, order_items_count = db_client.partitions.count_rows()
+        return {'db_runs': db_client.session.query(ProgramRun).count(),
+                'db_orders': orders_count,
+                'db_order_items': order_items_count}
+
+    def _get_sizes(self) -> dict:
+        '''db_size_kb: main database and order partitions'''
+        partitions_dir = os.path.join(self.scratch_dir, ORDER_PARTITIONS_DIR)
+        partitions_size = get_folder_size(partitions_dir) if os.path.exists(partitions_dir) else 0
+        return {'db_size_kb': round((os.path.getsize(os.path.join(self.scratch_dir, 'inventory.db')) + partitions_size) / 1024, 1),
+                'index_size_kb': round(get_folder_size(get_order_index_folder(self.scratch_dir)) / 1024, 1),
+                'src_files_kb': round(get_folder_size(get_src_files_folder(self.scratch_dir)) / 1024, 1)}
+
+
+def get_folder_size(folder:str) -> int:
+    '''returns total size of files in folder (not recursive) in bytes'''
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+def write_rows(csv_path:str, rows:list):
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def read_rows(csv_path:str) -> list:
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+def get_scaling_curve(rows:list, bucket_days:int=BUCKET_DAYS) -> list:
+    '''returns list of dicts per bucket_days period: median latency of each timed column, db size and orders at bucket end'''
+    buckets = {}
+    for row in rows:
+        buckets.setdefault(int(row['day']) // bucket_days, []).append(row)
+    curve = []
+    for bucket, bucket_rows in sorted(buckets.items()):
+        point = {'days': f'{bucket * bucket_days}-{(bucket + 1) * bucket_days - 1}',
+                'db_orders': int(bucket_rows[-1]['db_orders']), 'db_size_kb': float(bucket_rows[-1]['db_size_kb'])}
+        for column in CSV_COLUMNS:
+            if column.endswith('_ms'):
+                point[column] = statistics.median(float(row[column]) for row in bucket_rows)
+        curve.append(point)
+    return curve
+
+def print_scaling_curve(rows:list, bucket_days:int=BUCKET_DAYS):
+    '''prints median per run latencies (ms) and db size per bucket_days period'''
+    curve = get_scaling_curve(rows, bucket_days)
+    ms_columns = [column for column in CSV_COLUMNS if column.endswith('_ms')]
+    print(f'{"days":>9} {"orders":>8} {"db KB":>9} ' + ' '.join(f'{column[:-3].strip("_")[:12]:>12}' for column in ms_columns))
+    for point in curve:
+        print(f'{point["days"]:>9} {point["db_orders"]:>8} {point["db_size_kb"]:>9.0f} ' + ' '.join(f'{point[column]:>12.1f}' for column in ms_columns))
+
+def print_comparison(old_rows:list, new_rows:list, bucket_days:int=BUCKET_DAYS):
+    '''prints new / old median latency ratio per bucket_days period for two simulation results (e.g. two versions)'''
+    old_curve, new_curve = get_scaling_curve(old_rows, bucket_days), get_scaling_curve(new_rows, bucket_days)
+    ms_columns = [column for column in CSV_COLUMNS if column.endswith('_ms')]
+    print('new / old median latency ratio (< 1.00 is faster)')
+    print(f'{"days":>9} {"db KB":>9} ' + ' '.join(f'{column[:-3].strip("_")[:12]:>12}' for column in ms_columns))
+    for old_point, new_point in zip(old_curve, new_curve):
+        ratios = [new_point[column] / old_point[column] if old_point[column] else 0 for column in ms_columns]
+        size_ratio = new_point['db_size_kb'] / old_point['db_size_kb'] if old_point['db_size_kb'] else 0
+        print(f'{new_point["days"]:>9} {size_ratio:>9.2f} ' + ' '.join(f'{ratio:>12.2f}' for ratio in ratios))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Simulates daily program runs against fresh database, records db operation latencies and size')
+    parser.add_argument('--days', type=int, default=SIM_DAYS, help=f'simulated days (archive window: {ORDERS_ARCHIVE_DAYS})')
+    parser.add_argument('--orders-per-day', type=int, default=ORDERS_PER_DAY, help='new orders per day per channel')
+    parser.add_argument('--export-days', type=int, default=EXPORT_DAYS, help='days covered by each daily export')
+    parser.add_argument('--channels', nargs='+', default=list(SALES_CHANNEL_PROXY_KEYS), choices=list(SALES_CHANNEL_PROXY_KEYS))
+    parser.add_argument('--csv', default=f'db_growth {datetime.now().strftime("%Y.%m.%d %H.%M")}.csv', help='result rows output path')
+    parser.add_argument('--scratch-dir', help='keep simulated database and files in this directory (default: temporary, deleted)')
+    parser.add_argument('--bucket-days', type=int, default=BUCKET_DAYS)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD_CSV', 'NEW_CSV'), help='compare two saved results instead of simulating')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.compare:
+        print_comparison(read_rows(args.compare[0]), read_rows(args.compare[1]), args.bucket_days)
+        return
+    scratch_dir = args.scratch_dir if args.scratch_dir else tempfile.mkdtemp(prefix='db_growth ')
+    try:
+        simulation = DBGrowthSimulation(scratch_dir, args.days, args.orders_per_day, args.export_days, args.channels)
+        report_day = lambda row: print(f'day {row["day"]:>4} {row["sales_channel"]:<17} orders in db: {row["db_orders"]:>7} '
+                                    f'run: {row["run_ms"]:>8.1f} ms') if row['day'] % args.bucket_days == 0 else None
+        rows = simulation.run(on_run=report_day)
+    finally:
+        if not args.scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    write_rows(args.csv, rows)
+    print(f'\nResults saved to {args.csv}\n')
+    print_scaling_curve(rows, args.bucket_days)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
@@ -0,0 +1,120 @@
+import itertools
+import logging
+import json
+import time
+import os
+from utils import get_output_dir
+
+
+# GLOBAL VARIABLES
+# turns capture on without editing TESTING: INVENTORY_CAPTURE=1 (all records) or comma separated options,
+# e.g. INVENTORY_CAPTURE=first=100,every=10,invalid (see parse_capture_spec)
+CAPTURE_ENV_VAR = 'INVENTORY_CAPTURE'
+# captured stages in pipeline order, written to DEBUG_<stream>.jsonl in systemic output dir
+CAPTURE_STREAMS = ['raw_orders', 'new_unparsed', 'valid_parsed', 'invalid_orders']
+CAPTURE_FNAME = 'DEBUG_{}.jsonl'
+
+
+def parse_capture_spec(spec:str) -> dict:
+    '''returns DebugCapture kwargs of INVENTORY_CAPTURE value: '0' / '' - off, '1' / 'all' - all streams, all records.
+    Options: 'first=N' - first N records per stream, 'every=K' - every K-th record, 'invalid' - invalid orders only,
+    stream names (CAPTURE_STREAMS) - only listed streams'''
+    spec = spec.strip()
+    if spec in ('', '0'):
+        return {'streams': []}
+    kwargs = {'streams': list(CAPTURE_STREAMS)}
+    selected_streams = []
+    for option in spec.replace(' ', '').split(','):
+        key, _, value = option.partition('=')
+        try:
+            if key in ('first', 'every'):
+                kwargs[key] = int(value)
+            elif key == 'invalid':
+                selected_streams.append('invalid_orders')
+            elif key in CAPTURE_STREAMS:
+                selected_streams.append(key)
+            elif key not in ('1', 'all'):
+                raise ValueError(f'unknown option {option}')
+        except ValueError as e:
+            logging.warning(f'Ignoring {CAPTURE_ENV_VAR} option {option!r}: {e}')
+    if selected_streams:
+        kwargs['streams'] = selected_streams
+    return kwargs
+
+
+class DebugCapture():
+    '''Streams pipeline stage records (orders) to DEBUG_<stream>.jsonl files, one json object per line.
+    Replaces indented json dumps of whole order lists in testing mode: records are serialized one by one while written,
+    sampled records only.
+
+    Args:
+    - streams:list - captured streams (CAPTURE_STREAMS subset). Empty: capture is off, capture() returns at once
+    - first:int - optional, max records written per stream
+    - every:int - optional, only every K-th record of stream is written (first record included)
+    - output_dir:str - files location (default: systemic output dir)
+
+    self.timings - {'capture <stream>': seconds} spent writing, kept out of stage timings'''
+
+    def __init__(self, streams:list=None, first:int=None, every:int=None, output_dir:str=None):
+        self.streams = set(streams) if streams else set()
+        self.first = first if first and first > 0 else None
+        self.every = every if every and every > 1 else None
+        self.output_dir = output_dir
+        self.timings = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.streams)
+
+    def get_fpath(self, stream:str) -> str:
+        output_dir = self.output_dir if self.output_dir else get_output_dir(client_file=False)
+        return os.path.join(output_dir, CAPTURE_FNAME.format(stream))
+
+    def reset(self):
+        '''deletes capture files of previous run (all streams, so stale files of streams not captured now do not mislead)'''
+        if not self.enabled:
+            return
+        for stream in CAPTURE_STREAMS:
+            fpath = self.get_fpath(stream)
+            if os.path.exists(fpath):
+                os.remove(fpath)
+
+    def capture(self, stream:str, records) -> int:
+        '''writes sampled records of stream as JSONL (file replaced). Returns count of written records'''
+        if stream not in self.streams:
+            return 0
+        start = time.perf_counter()
+        sampled = itertools.islice(records, 0, None, self.every) if self.every else iter(records)
+        if self.first:
+            sampled = itertools.islice(sampled, self.first)
+        written = 0
+        fpath = self.get_fpath(stream)
+        with open(fpath, 'w', encoding='utf-8') as f:
+            for record in sampled:
+                f.write(json.dumps(record, ensure_ascii=False, default=str))
+                f.write('\n')
+                written += 1
+        elapsed = time.perf_counter() - start
+        self.timings[f'capture {stream}'] = self.timings.get(f'capture {stream}', 0.0) + elapsed
+        logging.debug(f'Captured {written} {stream} records to {fpath} in {elapsed:.3f}s')
+        return written
+
+    def __repr__(self) -> str:
+        return f'<DebugCapture streams: {sorted(self.streams)}, first: {self.first}, every: {self.every}>'
+
+
+def get_debug_capture(testing:bool=False, output_dir:str=None) -> DebugCapture:
+    '''returns DebugCapture configured by CAPTURE_ENV_VAR. Unset variable: all streams in testing mode, off otherwise'''
+    spec = os.environ.get(CAPTURE_ENV_VAR)
+    if spec is None:
+        kwargs = {'streams': CAPTURE_STREAMS if testing else []}
+    else:
+        kwargs = parse_capture_spec(spec)
+    capture = DebugCapture(output_dir=output_dir, **kwargs)
+    if capture.enabled:
+        logging.info(f'Debug capture on: {capture}')
+    return capture
+
+
+if __name__ == "__main__":
+    pass
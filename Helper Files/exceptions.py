@@ -0,0 +1,41 @@
+from constants import VBA_ERROR_ALERT, VBA_KEYERROR_ALERT, VBA_ALREADY_OPEN_ERROR
+
+
+class InventoryError(Exception):
+    '''Base of errors ending pipeline run (see pipeline.run_pipeline).
+    vba_messages - protocol strings printed to VBA by main_inventory adapter'''
+    vba_messages = (VBA_ERROR_ALERT,)
+
+
+class SourceHeadersError(InventoryError):
+    '''source file is missing column expected by sales channel proxy keys'''
+    vba_messages = (VBA_KEYERROR_ALERT,)
+
+
+class SourceDataError(InventoryError):
+    '''source file value could not be interpreted (country, date)'''
+
+
+class HelperFileOpenError(InventoryError):
+    '''helper file is open in Excel, can not be saved'''
+    vba_messages = (VBA_ALREADY_OPEN_ERROR, VBA_ERROR_ALERT)
+
+
+class HelperFileError(InventoryError):
+    '''unexpected error creating / updating helper file'''
+
+
+class OutputSinkError(InventoryError):
+    '''run sku deltas could not be delivered to output sink (file, inventory service)'''
+
+
+class DatabaseError(InventoryError):
+    '''unexpected error adding orders to database'''
+
+
+class RunNotFoundError(InventoryError):
+    '''program run to reverse does not exist in database'''
+
+
+if __name__ == "__main__":
+    pass
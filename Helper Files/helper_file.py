@@ -2,26 +2,90 @@ import logging
 import openpyxl
 import os
 from shutil import copy
+from openpyxl.formatting.formatting import ConditionalFormattingList
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.utils import get_column_letter
 from utils import get_output_dir, get_last_used_row_col, sort_by_quantity
 from utils import update_col_widths, adjust_col_widths
-from constants import VBA_ALREADY_OPEN_ERROR, SHEET_NAME, HEADERS
+from sku_symbols import SKUQuantities
+from exceptions import HelperFileOpenError, HelperFileError
+from constants import SHEET_NAME, HEADERS
 
 
 # GLOBAL VARIABLES
 BOLD_STYLE = openpyxl.styles.Font(bold=True, name='Calibri')
-FILL_NONE = openpyxl.styles.PatternFill(fill_type=None)
-FILL_HIGHLIGHT = openpyxl.styles.PatternFill(fill_type='solid', fgColor='FAFA73')
+# conditional formatting (differential) fill: solid fill color is read from bgColor
+FILL_HIGHLIGHT = openpyxl.styles.PatternFill(fill_type='solid', fgColor='FAFA73', bgColor='FAFA73')
+# highlight rule formula (rule applies to its whole range), identifies program's own rule among user's rules
+HIGHLIGHT_FORMULA = 'TRUE'
+
+
+def get_row_ranges(rows:list, last_col:int=len(HEADERS)) -> str:
+    '''returns space separated cell ranges (sqref) covering columns A:last_col of rows, consecutive rows merged:
+    [2, 3, 4, 9] -> 'A2:B4 A9:B9' '''
+    if not rows:
+        return ''
+    last_col_letter = get_column_letter(last_col)
+    rows = sorted(rows)
+    ranges = []
+    start = prev = rows[0]
+    for r in rows[1:]:
+        if r != prev + 1:
+            ranges.append(f'A{start}:{last_col_letter}{prev}')
+            start = r
+        prev = r
+    ranges.append(f'A{start}:{last_col_letter}{prev}')
+    return ' '.join(ranges)
+
+def is_highlight_rule(rule) -> bool:
+    '''returns True for FILL_HIGHLIGHT rule added by highlight_rows (always true formula, highlight fill color)'''
+    fill = rule.dxf.fill if rule.dxf else None
+    if rule.type != 'expression' or list(rule.formula or []) != [HIGHLIGHT_FORMULA] or fill is None or fill.bgColor is None:
+        return False
+    return str(fill.bgColor.rgb)[-6:] == FILL_HIGHLIGHT.bgColor.rgb[-6:]
+
+def highlight_rows(ws, rows:list):
+    '''replaces FILL_HIGHLIGHT rule of previous run with single rule applied to rows (skus changed by last run).
+    Other (user's) conditional formatting rules are kept with their ranges and priorities.
+    No per cell styles: workbook style table does not grow, rule ranges size is O(changed rows)'''
+    kept = ConditionalFormattingList()
+    for cf in ws.conditional_formatting:
+        for rule in cf.rules:
+            if not is_highlight_rule(rule):
+                kept.add(str(cf.sqref), rule)
+    kept.max_priority = max([rule.priority for cf in kept for rule in cf.rules if rule.priority] + [0])
+    ws.conditional_formatting = kept
+    if rows:
+        ws.conditional_formatting.add(get_row_ranges(rows), FormulaRule(formula=[HIGHLIGHT_FORMULA], fill=FILL_HIGHLIGHT))
+    logging.debug(f'Highlighted {len(rows)} rows changed by last run')
+
+
+def read_helper_file_quantities(inventory_file:str) -> dict:
+    '''returns {sku: quantity} summed over helper file rows without modifying workbook. Text quantities are kept as read'''
+    wb = openpyxl.load_workbook(inventory_file, read_only=True, data_only=True)
+    try:
+        sku_quantities = {}
+        for sku, quantity, *_ in wb[SHEET_NAME].iter_rows(min_row=2, max_col=len(HEADERS), values_only=True):
+            if sku is None:
+                continue
+            if isinstance(quantity, (int, float)) and isinstance(sku_quantities.get(sku, 0), int):
+                sku_quantities[sku] = sku_quantities.get(sku, 0) + int(quantity)
+            else:
+                sku_quantities[sku] = quantity
+        return sku_quantities
+    finally:
+        wb.close()
 
 
 class HelperFileCreate():
     '''accepts export data, sku-custom label mapping dictionaries as args, creates formatted xlsx file.
     Class does not include error handling and that should be carried out outside of this class scope
 
-    Args: export_obj:dict - sku (key) and quantity (value int) pairs
+    Args: export_obj:dict - sku (key) and quantity (value int) pairs or SKUQuantities
 
     Main method:
     - export() - takes argument of target workbook name (path) and pushes
-    sorted_export_obj accepted by class to single sheet'''
+    sorted_export_obj accepted by class to single sheet. All rows are highlighted (added by last run)'''
     
     def __init__(self, export_obj:dict):
         self.sorted_export_obj = sort_by_quantity(export_obj)
@@ -42,6 +106,7 @@ class HelperFileCreate():
         self.row_cursor = 1
         self.__fill_headers()
         self.push_data()
+        highlight_rows(self.ws, list(range(2, self.row_cursor)))
         adjust_col_widths(self.ws, self.col_widths)
 
     def __fill_headers(self):
@@ -70,14 +135,19 @@ class HelperFileUpdate():
     Class includes error handling, but raises Exception to hit outside error handler to close db connection and alert VBA.
 
     Args:
-    - export_obj:dict - sku (key) and quantity (value int) pairs
+    - export_obj:dict - sku (key) and quantity (value int) pairs or SKUQuantities. Negative quantities are subtracted
+    - drop_empty:bool - optional. Removes rows of export_obj skus left with zero or negative quantity (used when reversing runs)
+    - backup_dir:str - optional directory of workbook backup before edits. Default: get_output_dir(client_file=False)
 
     Main method:
     update_workbook() - takes argument of workbook path, reads contents, cleans sheet,
-    merges current contents with incoming data in export_obj and pushes updated values'''
+    merges current contents with incoming data in export_obj and pushes updated values.
+    Rows of export_obj skus are highlighted (see highlight_rows), highlight of previous run is replaced'''
     
-    def __init__(self, export_obj:dict):
+    def __init__(self, export_obj:dict, drop_empty=False, backup_dir:str=None):
         self.export_obj = export_obj
+        self.drop_empty = drop_empty
+        self.backup_dir = backup_dir
         self.col_widths = {}
 
     def update_workbook(self, inventory_file:str):
@@ -86,14 +156,14 @@ class HelperFileUpdate():
             # Backup and set workbook, worksheet objs
             wb = openpyxl.load_workbook(inventory_file)
             self.ws = wb[SHEET_NAME]
-            self.backup_wb(inventory_file)
+            self.backup_wb(inventory_file, self.backup_dir)
             
             # Read contents to dict
             current_skus = self.read_map_ws_data_to_list()
             updated_skus = self.update_sku_data(current_skus, self.export_obj)    
 
-            # Sort by quantity and push updated values back to ws
-            sorted_updated_skus = sort_by_quantity(updated_skus)
+            # Sort by quantity (skus with text quantities go last) and push updated values back to ws
+            sorted_updated_skus = sort_by_quantity(updated_skus) + list(self.text_quantities.items())
             self.write_updated_to_ws(sorted_updated_skus)
             adjust_col_widths(self.ws, self.col_widths)
 
@@ -102,17 +172,16 @@ class HelperFileUpdate():
             wb.close()
         except PermissionError as e:
             logging.critical(f'Workbook {inventory_file} already open. Err: {e}')
-            print(VBA_ALREADY_OPEN_ERROR)
-            raise Exception('Transition from HelperFileUpdate.updateworkbook error handling to ParseOrders.export_update_inventory_helper_file error handling')
+            raise HelperFileOpenError(f'Workbook {inventory_file} already open') from e
         except Exception as e:
             logging.critical(f'Errors inside HelperFileUpdate.updateworkbook Errr: {e}. Closing wb without saving')
             wb.close()
-            raise Exception('Transition from HelperFileUpdate.updateworkbook error handling to ParseOrders.export_update_inventory_helper_file error handling')
+            raise HelperFileError(f'Failed to update helper file {inventory_file}: {e}') from e
 
     @staticmethod
-    def backup_wb(inventory_file:str):
+    def backup_wb(inventory_file:str, backup_dir:str=None):
         '''Creates a backup of workbook before new edits'''
-        backup_dir = get_output_dir(client_file=False)
+        backup_dir = backup_dir if backup_dir else get_output_dir(client_file=False)
         backup_path = os.path.join(backup_dir, 'Inventory Reduction b4lastrun.xlsx')
         copy(inventory_file, backup_path)
         logging.info(f'Backup created at: {backup_path}, before touching {inventory_file}')
@@ -120,17 +189,14 @@ class HelperFileUpdate():
     def read_map_ws_data_to_list(self) -> dict:
         ws_limits = get_last_used_row_col(self.ws)
         assert ws_limits['max_col'] == len(HEADERS), f'Template of helper file changed! Maximum column used in ws {ws_limits["max_col"]}; expected: {len(HEADERS)}'
-        return self.get_ws_data_reset_highlight(ws_limits)
+        return self.get_ws_data(ws_limits)
 
-    def get_ws_data_reset_highlight(self, ws_limits:dict) -> dict:
+    def get_ws_data(self, ws_limits:dict) -> dict:
         '''iterates though data rows [2:ws.max_row] in self.ws and collects sku data to dict object:
         {sku1 : qty1, sku2 : qty2, ...}
         Also deletes worksheet contents (excl headers in 1:1 row)'''
         current_sku_codes = {}
         for r in range(2, ws_limits['max_row'] + 1):
-            # Reset color formatting
-            self.__apply_row_highlight(r, FILL_NONE)
-            # Get data
             sku, quantity = self._get_ws_row_data(r)
             self._clean_ws_row_data(r, ws_limits)
             if sku not in current_sku_codes.keys():
@@ -146,7 +212,7 @@ class HelperFileUpdate():
         try:
             quantity = int(self.ws.cell(r, 2).value)
         except ValueError as e:
-            logging.warning(f'Error converting quantity to integer, data found in wb cell: {self.ws.cell(r, 2).value}. Proceeding with string value')
+            logging.warning('Error converting quantity to integer, data found in wb cell: %s. Proceeding with string value', self.ws.cell(r, 2).value)
             quantity = self.ws.cell(r, 2).value
         return sku, quantity
 
@@ -155,35 +221,50 @@ class HelperFileUpdate():
         for col in range(1, ws_limits['max_col'] + 1):
             self.ws.cell(r, col).value = None
 
-    def update_sku_data(self, current_skus:dict, export_obj:dict) -> dict:
-        '''updates current_skus dict with values from loaded data (export_obj), returns same form obj:
-        {sku1 : qty1, sku2 : qty2, ...}'''
-        for sku in export_obj:
-            if sku not in current_skus:
-                logging.debug(f'Adding a new sku code: {sku}. Q-ty: {export_obj[sku]}')
-                current_skus[sku] = export_obj[sku]
+    def update_sku_data(self, current_skus:dict, export_obj) -> SKUQuantities:
+        '''merges current_skus dict (read from ws) with values from loaded data (export_obj dict / SKUQuantities).
+        Returns SKUQuantities of integer quantities (sharing run symbol table of export_obj SKUQuantities).
+        Skus having string quantity in workbook are kept in self.text_quantities'''
+        updated_skus = SKUQuantities(export_obj.symbols if isinstance(export_obj, SKUQuantities) else None)
+        self.text_quantities = {}
+        for sku, quantity in current_skus.items():
+            if isinstance(quantity, int):
+                updated_skus.add_sku(sku, quantity)
             else:
-                logging.debug(f'Updating quantity for code: {sku}. Previous quantity: {current_skus[sku]}, adding: {export_obj[sku]}')
-                try:
-                    current_skus[sku] += export_obj[sku]
-                except TypeError as e:
-                    logging.warning(f'Could not update SKU: {sku} quantity. String read from workbook. Concatenating string instead')
-                    current_skus[sku] += f'+{export_obj[sku]}'
-        return current_skus
+                self.text_quantities[sku] = quantity
+        new_skus_count = 0
+        for sku, quantity in export_obj.items():
+            if sku in self.text_quantities:
+                logging.warning('Could not update SKU: %s quantity. String read from workbook. Concatenating string instead', sku)
+                self.text_quantities[sku] += f'+{quantity}'
+                continue
+            new_skus_count += sku not in current_skus
+            updated_skus.add_sku(sku, quantity)
+        logging.info(f'Skus updated: {len(export_obj) - new_skus_count}, new skus added: {new_skus_count}')
+        if self.drop_empty:
+            self._drop_empty_skus(updated_skus, export_obj)
+        return updated_skus
+
+    @staticmethod
+    def _drop_empty_skus(updated_skus:SKUQuantities, export_obj:dict):
+        '''removes export_obj skus left with zero or negative quantity from updated_skus'''
+        for sku in export_obj:
+            if updated_skus.get(sku, 1) <= 0:
+                logging.debug('Dropping sku code: %s left with quantity: %s', sku, updated_skus[sku])
+                updated_skus.discard(sku)
 
     def write_updated_to_ws(self, sorted_updated_skus:list):
-        '''write sorted_updated_skus list of tuples to rows below header'''
+        '''write sorted_updated_skus list of tuples to rows below header, highlights rows of export_obj skus'''
+        changed_rows = []
         for row_cursor, sku_data in enumerate(sorted_updated_skus, start=2):
             self.ws.cell(row_cursor, 1).number_format = '@'    
             self.ws.cell(row_cursor, 1).value = sku_data[0]
             self.ws.cell(row_cursor, 2).value = sku_data[1]
             self.col_widths = update_col_widths(self.col_widths, 1, sku_data[0], zero_indexed=False)
             self.col_widths = update_col_widths(self.col_widths, 2, str(sku_data[1]), zero_indexed=False)
-
-    def __apply_row_highlight(self, r:int, highlight_style=FILL_HIGHLIGHT):
-        '''applies passed formatting style on self.ws r row, hardcoded 4 columns fill'''
-        for c in range(1, 4):
-            self.ws.cell(r, c).fill = highlight_style
+            if sku_data[0] in self.export_obj:
+                changed_rows.append(row_cursor)
+        highlight_rows(self.ws, changed_rows)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import argparse
+import logging
+import json
+
+
+# GLOBAL VARIABLES
+DELTAS_PATH = '/deltas'
+INVENTORY_PATH = '/inventory'
+DEFAULT_PORT = 8765
+
+
+class InventoryServiceStandIn():
+    '''Local stand-in of remote inventory service (see output_sinks.InventoryServiceSink) for tests and benchmarks.
+
+    POST DELTAS_PATH - json {'run_key', 'sales_channel', 'deltas': [[sku, qty], ...]}, 'Idempotency-Key' header.
+    Deltas are applied once per key: repeated key returns 409 (sink treats it as already applied). GET INVENTORY_PATH - {sku: qty}
+
+    Args:
+    - host:str, port:int - bind address (port 0: any free port, see self.url)
+    - fail_first:int - first fail_first POST requests answer 503 with Retry-After: 0 (retry testing)
+
+    Attributes: inventory:dict, applied_keys:list, requests_count:int'''
+
+    def __init__(self, host:str='127.0.0.1', port:int=0, fail_first:int=0):
+        self.inventory = {}
+        self.applied_keys = []
+        self.requests_count = 0
+        self.fail_first = fail_first
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.__get_handler())
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{DELTAS_PATH}'
+
+    def __get_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != DELTAS_PATH:
+                    return self._respond(404, {'error': 'not found'})
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, response, headers = service.handle_deltas(self.headers.get('Idempotency-Key'), body)
+                self._respond(status, response, headers)
+
+            def do_GET(self):
+                if self.path != INVENTORY_PATH:
+                    return self._respond(404, {'error': 'not found'})
+                with service.lock:
+                    self._respond(200, dict(service.inventory))
+
+            def _respond(self, status:int, response:dict, headers:dict=None):
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                for header, value in (headers or {}).items():
+                    self.send_header(header, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logging.debug('inventory service stand-in: ' + format, *args)
+
+        return Handler
+
+    def handle_deltas(self, key:str, body:bytes) -> tuple:
+        '''returns (status, response dict, headers) of deltas request, applies deltas of new key'''
+        with self.lock:
+            self.requests_count += 1
+            if self.requests_count <= self.fail_first:
+                return 503, {'error': 'unavailable'}, {'Retry-After': '0'}
+            try:
+                payload = json.loads(body)
+                deltas = payload['deltas']
+            except (ValueError, KeyError, TypeError):
+                return 400, {'error': 'malformed deltas'}, {}
+            if not key or key != payload.get('run_key'):
+                return 400, {'error': 'Idempotency-Key header has to match run_key'}, {}
+            if key in self.applied_keys:
+                return 409, {'error': 'deltas with this Idempotency-Key already applied'}, {}
+            for sku, quantity in deltas:
+                self.inventory[sku] = self.inventory.get(sku, 0) + quantity
+            self.applied_keys.append(key)
+            return 200, {'applied': len(deltas)}, {}
+
+    def start(self):
+        '''serves requests on background thread'''
+        self.thread = threading.Thread(target=self.server.serve_forever, name='inventory-service', daemon=True)
+        self.thread.start()
+        logging.info(f'Inventory service stand-in listening on {self.url}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local stand-in of inventory service for output_sinks.InventoryServiceSink')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--fail-first', type=int, default=0, help='answer first N delta requests with 503')
+    return parser.parse_args()
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    service = InventoryServiceStandIn(port=args.port, fail_first=args.fail_first)
+    print(f'Serving deltas at {service.url}, inventory at GET {INVENTORY_PATH}. Ctrl+C to stop')
+    try:
+        service.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import logging
+import csv
+import os
+import re
+
+
+# GLOBAL VARIABLES
+COMPOSITIONS_HEADERS = ['skus', 'number of items', 'multipliers', 'order id']
+SKUS_SEPARATOR = ' + '
+
+
+def get_composition_key(skus:list, items:int) -> tuple:
+    '''returns listing composition key: (sorted raw skus joined by SKUS_SEPARATOR, number of items)'''
+    return SKUS_SEPARATOR.join(sorted(sku.strip() for sku in skus)), items
+
+def get_key_skus(key:tuple) -> list:
+    '''returns sorted raw skus of composition key'''
+    return key[0].split(SKUS_SEPARATOR)
+
+def parse_multipliers(multipliers:str, skus_count:int) -> list:
+    '''returns list of integer multipliers of '2 + 1' / '2,1' / '2 1' string. Raises ValueError if count does not match skus_count
+    or no sku is sold'''
+    values = [int(value) for value in re.findall(r'\d+', str(multipliers))]
+    if len(values) != skus_count or not any(values):
+        raise ValueError(f'expected {skus_count} multipliers (at least one above 0), got: {multipliers!r}')
+    return values
+
+def get_multipliers_map(key:tuple, multipliers:list) -> dict:
+    '''returns {raw sku: multiplier} of composition key (as applied by ChannelPlan)'''
+    return dict(zip(get_key_skus(key), multipliers))
+
+
+def read_compositions_file(fpath:str) -> tuple:
+    '''reads listing compositions corrections csv. Returns ({composition key: [multipliers]} of filled rows, set of all listed keys).
+    Missing file: empty results. Rows with unreadable multipliers are skipped with warning'''
+    resolved, listed = {}, set()
+    if not os.path.exists(fpath):
+        return resolved, listed
+    with open(fpath, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                key = get_composition_key(row['skus'].split(SKUS_SEPARATOR), int(row['number of items']))
+                listed.add(key)
+                if (row.get('multipliers') or '').strip():
+                    resolved[key] = parse_multipliers(row['multipliers'], len(get_key_skus(key)))
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                logging.warning(f'Skipping listing compositions row {row}. Err: {e}')
+    logging.info(f'Listing compositions file {os.path.basename(fpath)}: {len(resolved)} resolved of {len(listed)} listed compositions')
+    return resolved, listed
+
+def add_pending_compositions(fpath:str, unresolved:dict, listed:set) -> int:
+    '''appends rows with empty multipliers for unresolved {composition key: example order id} not yet listed in file.
+    User fills multipliers (quantity of each sku per order, in skus order), next run learns them. Returns count of added rows'''
+    new_keys = [key for key in unresolved if key not in listed]
+    if not new_keys:
+        return 0
+    write_header = not os.path.exists(fpath)
+    with open(fpath, 'a', encoding='utf-8-sig' if write_header else 'utf-8', newline='') as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(COMPOSITIONS_HEADERS)
+        for key in sorted(new_keys):
+            writer.writerow([key[0], key[1], '', unresolved[key]])
+    logging.info(f'{len(new_keys)} unresolved listing compositions added to {fpath} for manual resolution')
+    return len(new_keys)
+
+
+if __name__ == "__main__":
+    pass
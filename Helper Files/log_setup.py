@@ -0,0 +1,83 @@
+import logging
+import functools
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+# GLOBAL VARIABLES
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+REPEATED_MESSAGE_LIMIT = 20
+
+
+class RepeatedMessageFilter(logging.Filter):
+    '''Lets through first `limit` records sharing same logger, level and message template (unformatted %-style msg),
+    counts the rest. Counts of suppressed records are written as summary when logging is stopped.
+
+    Only %-style calls: logging.info('Mapped %s', sku) share template, f-string messages are all distinct'''
+
+    def __init__(self, limit:int=REPEATED_MESSAGE_LIMIT):
+        super().__init__()
+        self.limit = limit
+        self.counts = {}
+
+    def filter(self, record) -> bool:
+        key = (record.name, record.levelno, getattr(record, 'template', record.msg))
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        return count <= self.limit
+
+    def get_summary_records(self) -> list:
+        '''returns log records summarizing suppressed repeated messages'''
+        summary_records = []
+        for (name, levelno, template), count in self.counts.items():
+            if count > self.limit:
+                summary_records.append(logging.LogRecord(name, levelno, __file__, 0,
+                    'Previous message repeated %d more times (%d total): %s', (count - self.limit, count, template), None))
+        return summary_records
+
+
+class TemplateQueueHandler(QueueHandler):
+    '''QueueHandler keeping unformatted message template on record for RepeatedMessageFilter.
+    Records below logger level are never formatted, file writing happens in QueueListener thread'''
+
+    def prepare(self, record):
+        record.template = record.msg
+        return super().prepare(record)
+
+
+def setup_logging(log_path:str, level=logging.INFO):
+    '''configures root logger to write to size rotated log_path file via background thread.
+    Returns function stopping logging (flushes queue). Called automatically on interpreter exit'''
+    file_handler = RotatingFileHandler(log_path, 'a', maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    repeated_filter = RepeatedMessageFilter()
+    file_handler.addFilter(repeated_filter)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(TemplateQueueHandler(log_queue))
+    root_logger.setLevel(level)
+    listener.start()
+    stop = functools.partial(stop_logging, listener, file_handler, repeated_filter)
+    atexit.register(stop)
+    return stop
+
+def stop_logging(listener:QueueListener, file_handler:logging.Handler, repeated_filter:RepeatedMessageFilter):
+    '''flushes queued records, writes repeated messages summary, closes log file. Safe to call more than once'''
+    if getattr(listener, 'stopped', False):
+        return
+    listener.stopped = True
+    listener.stop()
+    for record in repeated_filter.get_summary_records():
+        file_handler.handle(record)
+    repeated_filter.counts.clear()
+    file_handler.close()
+
+
+if __name__ == "__main__":
+    pass
@@ -1,21 +1,25 @@
+import multiprocessing
 import logging
+import json
 import sys
-import csv
 import os
 from datetime import datetime
 import sqlalchemy.sql.default_comparator    #neccessary for executable packing
-from database import SQLAlchemyOrdersDB
-from parse_orders import ParseOrders
-from constants import SALES_CHANNEL_PROXY_KEYS
-from constants import VBA_ERROR_ALERT, VBA_KEYERROR_ALERT, VBA_OK
-from utils import get_output_dir, split_sku, get_country_code
-from utils import dump_to_json, delete_file, get_file_encoding_delimiter
+from log_setup import setup_logging
+from database import get_db_session, get_sku_sales_history
+from pipeline import run_pipeline, PipelineOptions
+from run_rollback import undo_run
+from profiling import profiling_requested, run_profiled, print_profile_diff
+from progress import progress_requested, get_progress_reporter
+from watcher import watch
+from order_archive import print_archive_lookup
+from sales_velocity import print_velocity_report
+from replay import print_replay
+from channels import CHANNELS
+from constants import VBA_ERROR_ALERT
+from utils import get_output_dir
 
 
-# Logging config:
-log_path = os.path.join(get_output_dir(client_file=False), 'inventory.log')
-logging.basicConfig(handlers=[logging.FileHandler(log_path, 'a', 'utf-8')], level=logging.INFO)
-
 # GLOBAL VARIABLES
 TEST_CASES = [
     {'channel': 'Amazon', 'file': r'C:\Coding\Ebay\Working\Backups\Amazon exports\EU 2022.07.07.txt'},
@@ -31,86 +35,99 @@ ORDERS_SOURCE_FILE = TEST_CASE['file']
 EXPECTED_SYS_ARGS = 3
 
 
-def get_cleaned_orders(source_file:str, sales_channel:str, proxy_keys:dict) -> list:
-    '''returns cleaned orders (as cleaned in clean_orders func) from source_file arg path'''
-    encoding, delimiter = get_file_encoding_delimiter(source_file)
-    logging.info(f'{os.path.basename(source_file)} detected encoding: {encoding}, delimiter <{delimiter}>')
-    raw_orders = get_raw_orders(source_file, encoding, delimiter)
-    if TESTING:
-        replace_old_testing_json(raw_orders, 'DEBUG_raw_orders.json')
-    cleaned_orders = clean_orders(raw_orders, sales_channel, proxy_keys)
-    return cleaned_orders
-
-def get_raw_orders(source_file:str, encoding:str, delimiter:str) -> list:
-    '''returns raw orders as list of dicts for each order in txt source_file'''
-    with open(source_file, 'r', encoding=encoding) as f:
-        source_contents = csv.DictReader(f, delimiter=delimiter)
-        raw_orders = [{header : value for header, value in row.items()} for row in source_contents]
-    return raw_orders
-
-def replace_old_testing_json(raw_orders, json_fname:str):
-    '''deletes old json, exports raw orders to json file'''
-    output_dir = get_output_dir(client_file=False)
-    json_path = os.path.join(output_dir, json_fname)
-    delete_file(json_path)
-    dump_to_json(raw_orders, json_fname)
-
-def clean_orders(orders:list, sales_channel:str, proxy_keys:dict) -> list:
-    '''performs universal data cleaning for amazon and etsy raw orders data'''
-    for order in orders:
-        try:
-            # split sku for each order without replacing original keys. sku str value replaced by list of skus
-            order[proxy_keys['sku']] = split_sku(order[proxy_keys['sku']], sales_channel)
-            if sales_channel == 'Etsy':
-                # transform etsy country (Lithuania) to country code (LT)
-                country = order[proxy_keys['ship-country']]
-                order[proxy_keys['ship-country']] = get_country_code(country)
-        except KeyError as e:
-            logging.critical(f'Failed while cleaning loaded orders. Last order: {order} Err: {e}')
-            print(VBA_KEYERROR_ALERT)
-            sys.exit()
-    return orders
-
-
 def parse_args():
     '''returns arguments passed from VBA or hardcoded test environment'''
     if TESTING:
         print(f'--- RUNNING IN TESTING MODE. Using hardcoded args ch: {SALES_CHANNEL}, f: {os.path.basename(ORDERS_SOURCE_FILE)}---')
         logging.warning('--- RUNNING IN TESTING MODE. Using hardcoded args---')
-        assert SALES_CHANNEL in SALES_CHANNEL_PROXY_KEYS.keys(), f'Unexpected sales_channel value passed from VBA side: {SALES_CHANNEL}'
+        assert SALES_CHANNEL in CHANNELS, f'Unexpected sales_channel value passed from VBA side: {SALES_CHANNEL}'
         return ORDERS_SOURCE_FILE, SALES_CHANNEL
     try:
         assert len(sys.argv) == EXPECTED_SYS_ARGS, 'Unexpected number of sys.args passed. Check TESTING mode'
         source_fpath = sys.argv[1]
         sales_channel = sys.argv[2]
         logging.info(f'Accepted sys args on launch: source_fpath: {source_fpath}; sales_channel: {sales_channel}. Whole sys.argv: {list(sys.argv)}')
-        assert sales_channel in SALES_CHANNEL_PROXY_KEYS.keys(), f'Unexpected sales_channel value passed from VBA side: {sales_channel}'
+        assert sales_channel in CHANNELS, f'Unexpected sales_channel value passed from VBA side: {sales_channel}'
         return source_fpath, sales_channel
     except Exception as e:
         print(VBA_ERROR_ALERT)
         logging.critical(f'Error parsing arguments on script initialization in cmd. Arguments provided: {list(sys.argv)} Number Expected: {EXPECTED_SYS_ARGS}. Err: {e}')
         sys.exit()
 
+def print_sku_history(sku_code:str):
+    '''prints tab separated sales history (one line per program run) for sku_code'''
+    session = get_db_session()
+    history = get_sku_sales_history(session, sku_code)
+    session.close()
+    logging.info(f'SKU {sku_code} sales history requested. Found in {len(history)} runs')
+    print('run\ttimestamp\tsales_channel\torders\tquantity\tsource backup')
+    for run in history:
+        print(f'{run["run"]}\t{run["timestamp"]:%Y-%m-%d %H:%M}\t{run["sales_channel"]}\t{run["orders"]}\t{run["quantity"]}\t{run["fpath"]}')
+
+def print_preview(source_fpath:str, sales_channel:str):
+    '''prints json of sku totals and invalid orders source file would add. Database is opened read-only,
+    no backups, database or helper file writes'''
+    if sales_channel not in CHANNELS:
+        logging.critical(f'Unexpected sales_channel value passed for preview: {sales_channel}')
+        print(VBA_ERROR_ALERT)
+        sys.exit()
+    result = run_pipeline(source_fpath, sales_channel, PipelineOptions(preview=True))
+    print(json.dumps(result.to_dict(), indent=2, ensure_ascii=False))
+
+# Maintenance commands: first sys arg flag -> (function, expected number of arguments after flag)
+COMMANDS = {
+    '--sku-history': (print_sku_history, 1),
+    '--undo-run': (undo_run, 1),
+    '--profile-diff': (print_profile_diff, 2),
+    '--watch': (watch, 0),
+    '--preview': (print_preview, 2),
+    '--archive-lookup': (print_archive_lookup, 1),
+    '--velocity-report': (print_velocity_report, 0),
+    '--replay': (print_replay, 2),
+    }
+
+def run_command() -> bool:
+    '''executes maintenance command if sys.argv[1] is one of COMMANDS flags. Returns True if command was executed'''
+    if TESTING or len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        return False
+    command, args_count = COMMANDS[sys.argv[1]]
+    command_args = sys.argv[2:]
+    if len(command_args) != args_count:
+        logging.critical(f'Command {sys.argv[1]} expects {args_count} argument(s), got: {command_args}')
+        print(VBA_ERROR_ALERT)
+        sys.exit()
+    logging.info(f'Running command {sys.argv[1]} with args: {command_args}')
+    command(*command_args)
+    return True
+
 def main():
     '''Main function executing parsing of provided txt file and exporting labels summary file'''
     logging.info(f'\n NEW RUN STARTING: {datetime.today().strftime("%Y.%m.%d %H:%M")}')        
+    # removes --progress flag before arguments are counted
+    progress_target = progress_requested()
+    if run_command():
+        return
     source_fpath, sales_channel = parse_args()
-    proxy_keys = SALES_CHANNEL_PROXY_KEYS[sales_channel]
-    logging.debug(f'Loading file: {os.path.basename(source_fpath)}. Using proxy keys matching key: {sales_channel} in SALES_CHANNEL_PROXY_KEYS')
-    
-    # Get cleaned source orders
-    cleaned_source_orders = get_cleaned_orders(source_fpath, sales_channel, proxy_keys)
-    
-    db_client = SQLAlchemyOrdersDB(cleaned_source_orders, source_fpath, sales_channel, proxy_keys, testing=TESTING)
-    new_orders = db_client.get_new_orders_only()
-    logging.info(f'Loaded file contains: {len(cleaned_source_orders)}. Further processing: {len(new_orders)} orders')
-
-    # Parse orders, export target files
-    ParseOrders(new_orders, db_client, sales_channel, proxy_keys).export_orders(TESTING)
+    logging.debug(f'Loading file: {os.path.basename(source_fpath)}. Using channel adapter: {sales_channel}')
 
-    print(VBA_OK)
+    # VBA protocol: optional PROGRESS lines (see progress.py), then alerts, error / NO NEW JOB / EXPORTED_SUCCESSFULLY strings
+    progress = get_progress_reporter(progress_target)
+    try:
+        result = run_pipeline(source_fpath, sales_channel, PipelineOptions(testing=TESTING, progress=progress))
+    finally:
+        progress.close()
+    for message in result.vba_messages:
+        print(message)
     logging.info(f'\nRUN ENDED: {datetime.today().strftime("%Y.%m.%d %H:%M")}\n\n')
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # frozen exe parse workers (see parallel_parse) start here, not in main()
+    multiprocessing.freeze_support()
+    # Logging config (not at import: spawned worker processes import this module too)
+    log_path = os.path.join(get_output_dir(client_file=False), 'inventory.log')
+    setup_logging(log_path, level=logging.INFO)
+    if profiling_requested():
+        run_profiled(main)
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,179 @@
+import logging
+import struct
+import bisect
+import array
+import lzma
+import mmap
+import json
+import os
+import re
+from order_index import order_id_hash
+from utils import get_output_dir
+
+
+# GLOBAL VARIABLES
+ORDER_ARCHIVE_DIR = 'order archive'
+ARCHIVE_INDEX_MAGIC = b'ORDARC01'
+# magic, entries count
+ARCHIVE_HEADER_STRUCT = struct.Struct('<8sQ')
+# orders per independently compressed xz stream (lookup decompresses single stream)
+ARCHIVE_BLOCK_ORDERS = 500
+ARCHIVE_XZ_PRESET = 6
+# entry location: compressed stream offset << LINE_BITS | line number in stream
+LINE_BITS = 16
+ARCHIVE_FNAME_PATTERN = re.compile(r'^orders (\d{4}-\d{2})\.jsonl\.xz$')
+
+
+def get_order_archive_folder(output_dir:str=None, create:bool=True) -> str:
+    '''returns abspath of folder keeping archived orders, creates one if missing (and create)'''
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    target_dir = os.path.join(output_dir, ORDER_ARCHIVE_DIR)
+    if create and not os.path.exists(target_dir):
+        os.mkdir(target_dir)
+        logging.debug(f'order archive directory has been created: {target_dir}')
+    return target_dir
+
+
+class OrderArchive():
+    '''Cold, append-only archive of orders dropped from database (see SQLAlchemyOrdersDB.flush_old_records).
+
+    Per partition month two files in 'order archive' folder:
+    - 'orders 2022-03.jsonl.xz' - json line per order, written as concatenated xz streams of ARCHIVE_BLOCK_ORDERS lines
+    - 'orders 2022-03.idx' - header | sorted 64 bit order id hashes | matching locations (stream offset, line in stream)
+
+    Lookup is a binary search in memory mapped index, then only one xz stream is decompressed.
+
+    Args:
+    - output_dir:str - optional directory containing 'order archive' folder. Defaults to get_output_dir(client_file=False)'''
+
+    def __init__(self, output_dir:str=None):
+        self.folder = get_order_archive_folder(output_dir, create=False)
+
+    def get_paths(self, month:str) -> tuple:
+        '''returns (archive, index) paths of month'''
+        base_path = os.path.join(self.folder, f'orders {month}')
+        return f'{base_path}.jsonl.xz', f'{base_path}.idx'
+
+    def months(self) -> list:
+        '''returns sorted months present in archive'''
+        if not os.path.exists(self.folder):
+            return []
+        matches = (ARCHIVE_FNAME_PATTERN.match(entry.name) for entry in os.scandir(self.folder))
+        return sorted(match.group(1) for match in matches if match)
+
+    def add(self, month:str, records:list):
+        '''appends order records (dicts with 'order_id' key) to month archive, merges them into month index'''
+        if not records:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        archive_path, index_path = self.get_paths(month)
+        offset = os.path.getsize(archive_path) if os.path.exists(archive_path) else 0
+        hashes, locations = self._read_index(index_path)
+        entries = list(zip(hashes, locations))
+        streams = []
+        for i in range(0, len(records), ARCHIVE_BLOCK_ORDERS):
+            block = records[i:i + ARCHIVE_BLOCK_ORDERS]
+            lines = [json.dumps(record, ensure_ascii=False, default=str) for record in block]
+            for line_no, record in enumerate(block):
+                entries.append((order_id_hash(record['order_id']), offset << LINE_BITS | line_no))
+            stream = lzma.compress('\n'.join(lines).encode('utf-8'), preset=ARCHIVE_XZ_PRESET)
+            streams.append(stream)
+            offset += len(stream)
+        entries.sort()
+        # index is replaced only after streams are appended: crash leaves unindexed streams, never dangling index entries
+        tmp_path = f'{index_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(ARCHIVE_HEADER_STRUCT.pack(ARCHIVE_INDEX_MAGIC, len(entries)))
+            f.write(array.array('Q', [id_hash for id_hash, _ in entries]).tobytes())
+            f.write(array.array('Q', [location for _, location in entries]).tobytes())
+        with open(archive_path, 'ab') as f:
+            for stream in streams:
+                f.write(stream)
+        os.replace(tmp_path, index_path)
+        logging.info(f'{len(records)} orders archived to {os.path.basename(archive_path)} ({len(streams)} streams, {offset / 1024:.1f} KB)')
+
+    @staticmethod
+    def _read_index(index_path:str) -> tuple:
+        '''returns (hashes, locations) arrays of index file, empty arrays if file is missing or corrupted'''
+        hashes, locations = array.array('Q'), array.array('Q')
+        if not os.path.exists(index_path):
+            return hashes, locations
+        with open(index_path, 'rb') as f:
+            contents = f.read()
+        if len(contents) < ARCHIVE_HEADER_STRUCT.size:
+            return hashes, locations
+        magic, count = ARCHIVE_HEADER_STRUCT.unpack_from(contents, 0)
+        if magic != ARCHIVE_INDEX_MAGIC or len(contents) != ARCHIVE_HEADER_STRUCT.size + count * 16:
+            logging.warning(f'Order archive index {index_path} is corrupted or of unexpected version')
+            return hashes, locations
+        hashes.frombytes(contents[ARCHIVE_HEADER_STRUCT.size:ARCHIVE_HEADER_STRUCT.size + count * 8])
+        locations.frombytes(contents[ARCHIVE_HEADER_STRUCT.size + count * 8:])
+        return hashes, locations
+
+    def lookup(self, order_id:str) -> list:
+        '''returns archived records of order_id, newest month first'''
+        found = []
+        for month in reversed(self.months()):
+            found.extend(self.lookup_month(month, order_id))
+        return found
+
+    def lookup_month(self, month:str, order_id:str) -> list:
+        '''returns archived records of order_id in month archive (binary search in index, single stream decompressed)'''
+        archive_path, index_path = self.get_paths(month)
+        if not os.path.exists(index_path) or os.path.getsize(index_path) <= ARCHIVE_HEADER_STRUCT.size:
+            return []
+        id_hash = order_id_hash(order_id)
+        records = []
+        with open(index_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index_map:
+            magic, count = ARCHIVE_HEADER_STRUCT.unpack_from(index_map, 0)
+            if magic != ARCHIVE_INDEX_MAGIC or len(index_map) != ARCHIVE_HEADER_STRUCT.size + count * 16:
+                logging.warning(f'Order archive index {index_path} is corrupted or of unexpected version')
+                return []
+            view = memoryview(index_map)
+            hashes = view[ARCHIVE_HEADER_STRUCT.size:ARCHIVE_HEADER_STRUCT.size + count * 8].cast('Q')
+            locations = view[ARCHIVE_HEADER_STRUCT.size + count * 8:].cast('Q')
+            pos = bisect.bisect_left(hashes, id_hash)
+            matches = []
+            while pos < count and hashes[pos] == id_hash:
+                matches.append(locations[pos])
+                pos += 1
+            # memoryviews have to be released before closing mmap
+            hashes.release()
+            locations.release()
+            view.release()
+        streams = {}
+        for location in matches:
+            offset, line_no = location >> LINE_BITS, location & ((1 << LINE_BITS) - 1)
+            if offset not in streams:
+                streams[offset] = self._read_stream(archive_path, offset)
+            record = json.loads(streams[offset][line_no])
+            # hash match is only a possible match
+            if record['order_id'] == order_id:
+                records.append(record)
+        return records
+
+    @staticmethod
+    def _read_stream(archive_path:str, offset:int) -> list:
+        '''returns lines of single xz stream starting at offset of archive file'''
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        data = []
+        with open(archive_path, 'rb') as f:
+            f.seek(offset)
+            while not decompressor.eof:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                data.append(decompressor.decompress(chunk))
+        return b''.join(data).decode('utf-8').split('\n')
+
+
+def print_archive_lookup(order_id:str):
+    '''prints json line for each archived record of order_id (orders dropped from database)'''
+    records = OrderArchive().lookup(order_id)
+    logging.info(f'Archive lookup of order {order_id}: {len(records)} record(s) found')
+    for record in records:
+        print(json.dumps(record, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    pass
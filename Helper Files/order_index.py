@@ -0,0 +1,296 @@
+import logging
+import hashlib
+import struct
+import bisect
+import heapq
+import array
+import mmap
+import sys
+import os
+from utils import get_output_dir
+
+
+# GLOBAL VARIABLES
+ORDER_INDEX_DIR = 'order index'
+INDEX_MAGIC = b'ORDIDX02'
+# magic, bloom filter size in bits, bloom hash functions, bloom filter set bits, hashes count, channel order count in db
+HEADER_STRUCT = struct.Struct('<8sQQQQQ')
+# index files are little-endian (header and hashes array): hashes array is mapped without conversion on little-endian machines
+NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+BLOOM_BITS_PER_ID = 16
+BLOOM_HASH_FUNCTIONS = 7
+MIN_BLOOM_BITS = 1 << 14
+# saved (rebuilt) bloom filter is sized for hashes count * headroom, later runs add hashes in place up to capacity
+BLOOM_CAPACITY_HEADROOM = 2
+# estimated bloom filter false positive rate (bits of removed hashes stay set) triggering rebuild. ~0.0007 at capacity
+MAX_BLOOM_FP_RATE = 0.001
+# header db order count of index file being updated in place: interrupted update leaves index out of sync (rebuilt from db)
+UNSYNCED_ORDER_COUNT = (1 << 64) - 1
+# db order count of missing / corrupted index
+MISSING_ORDER_COUNT = -1
+
+
+def get_order_index_folder(output_dir:str=None) -> str:
+    '''returns abspath of folder keeping order id index files, creates one if missing'''
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    target_dir = os.path.join(output_dir, ORDER_INDEX_DIR)
+    if not os.path.exists(target_dir):
+        os.mkdir(target_dir)
+        logging.debug(f'order index directory has been created: {target_dir}')
+    return target_dir
+
+def order_id_hash(order_id:str) -> int:
+    '''returns stable (across runs and processes) 64 bit unsigned hash of order_id'''
+    return int.from_bytes(hashlib.blake2b(str(order_id).encode('utf-8'), digest_size=8).digest(), 'little')
+
+def get_bloom_bits_count(ids_count:int) -> int:
+    '''returns bloom filter size in bits for ids_count members. Always multiple of 64 to keep hashes array 8 byte aligned'''
+    bits = max(MIN_BLOOM_BITS, ids_count * BLOOM_BITS_PER_ID)
+    return (bits + 63) // 64 * 64
+
+def count_set_bits(data:bytes) -> int:
+    '''returns number of set bits in data'''
+    value = int.from_bytes(data, 'little')
+    # int.bit_count is available since Python 3.10
+    return value.bit_count() if hasattr(value, 'bit_count') else bin(value).count('1')
+
+def to_little_endian(hashes:array.array) -> bytes:
+    '''returns bytes of 64 bit hashes array in index file byte order (little-endian)'''
+    if NATIVE_LITTLE_ENDIAN:
+        return hashes.tobytes()
+    hashes = array.array('Q', hashes)
+    hashes.byteswap()
+    return hashes.tobytes()
+
+
+class OrderIDIndex():
+    '''Compact on-disk membership structure of order ids present in database for single sales channel.
+
+    File layout (little-endian): header | bloom filter bits | sorted array of 64 bit order id hashes.
+    Bloom filter bit n is bit n % 8 of byte n // 8. Hashes array is memory mapped as is on little-endian machines
+    (copied and byteswapped on big-endian ones)
+
+    File is memory mapped for lookups. Bloom filter rejects most new order ids without touching sorted array,
+    rest are checked via binary search in hashes array. Hash match is only a POSSIBLE positive (hash collision),
+    caller is expected to confirm those against database.
+
+    Bloom filter bits are derived from stored 64 bit hash (double hashing), therefore whole index
+    can be rebuilt or resized from hashes array alone, without reading database. Added / removed hashes are written
+    in place (see add, remove), whole file is rewritten only when bloom filter capacity or false positive rate is exceeded.
+
+    Header keeps channel order count in db, updated by add / remove with counts of orders added to / deleted from db,
+    so runs do not count db orders. Missing index or index left by interrupted update requires rebuild (needs_rebuild),
+    count is compared with db by check_order_index only. Number of set bloom filter bits is kept in header too
+    (false positive rate estimate without scanning filter).
+
+    Args:
+    - sales_channel:str - channel name, used for index file naming
+    - output_dir:str - optional directory containing 'order index' folder. Defaults to get_output_dir(client_file=False)'''
+
+    def __init__(self, sales_channel:str, output_dir:str=None):
+        self.sales_channel = sales_channel
+        self.index_path = os.path.join(get_order_index_folder(output_dir), f'{sales_channel}.idx')
+        self.__mmap = None
+        self._load()
+
+    def _load(self):
+        '''memory maps index file if present and valid, otherwise initiates empty index'''
+        self.close()
+        self.bloom_bits, self.hash_functions, self.bloom_set_bits, self.db_order_count = 0, BLOOM_HASH_FUNCTIONS, 0, MISSING_ORDER_COUNT
+        self.bloom, self.hashes = b'', array.array('Q')
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) < HEADER_STRUCT.size:
+            logging.info(f'Order id index for {self.sales_channel} not found at {self.index_path}. Index requires rebuild')
+            return
+        with open(self.index_path, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bloom_bits, hash_functions, bloom_set_bits, hashes_count, db_order_count = HEADER_STRUCT.unpack_from(self.__mmap, 0)
+        bloom_end = HEADER_STRUCT.size + bloom_bits // 8
+        if magic != INDEX_MAGIC or len(self.__mmap) != bloom_end + hashes_count * 8:
+            logging.warning(f'Order id index file {self.index_path} is corrupted or of unexpected version. Index requires rebuild')
+            self.close()
+            return
+        view = memoryview(self.__mmap)
+        self.bloom = view[HEADER_STRUCT.size:bloom_end]
+        if NATIVE_LITTLE_ENDIAN:
+            self.hashes = view[bloom_end:].cast('Q')
+        else:
+            self.hashes = array.array('Q', view[bloom_end:].tobytes())
+            self.hashes.byteswap()
+        self.bloom_bits, self.hash_functions, self.bloom_set_bits, self.db_order_count = bloom_bits, hash_functions, bloom_set_bits, db_order_count
+
+    def close(self):
+        '''releases memory map of index file'''
+        if self.__mmap is None:
+            return
+        # memoryviews have to be released before closing mmap
+        for view in (self.hashes, self.bloom):
+            if isinstance(view, memoryview):
+                view.release()
+        self.bloom, self.hashes = b'', array.array('Q')
+        self.__mmap.close()
+        self.__mmap = None
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def _bloom_positions(self, id_hash:int, bloom_bits:int, hash_functions:int):
+        '''yields bloom filter bit positions for 64 bit id_hash'''
+        h1 = id_hash & 0xFFFFFFFF
+        h2 = (id_hash >> 32) | 1
+        for i in range(hash_functions):
+            yield (h1 + i * h2) % bloom_bits
+
+    def _in_bloom(self, id_hash:int) -> bool:
+        bloom = self.bloom
+        for pos in self._bloom_positions(id_hash, self.bloom_bits, self.hash_functions):
+            if not bloom[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _in_hashes(self, id_hash:int) -> bool:
+        hashes = self.hashes
+        pos = bisect.bisect_left(hashes, id_hash)
+        return pos < len(hashes) and hashes[pos] == id_hash
+
+    def might_contain(self, order_id:str) -> bool:
+        '''returns False if order_id is certainly not in index, True if it possibly is'''
+        if not self.bloom_bits:
+            return False
+        id_hash = order_id_hash(order_id)
+        return self._in_bloom(id_hash) and self._in_hashes(id_hash)
+
+    def get_possible_members(self, order_ids) -> list:
+        '''returns list of order_ids that possibly are in index. Expected to be confirmed against database'''
+        possible_members = [order_id for order_id in order_ids if self.might_contain(order_id)]
+        logging.debug(f'Order id index {self.sales_channel}: {len(possible_members)} possible members out of checked ids')
+        return possible_members
+
+    def is_synced(self, db_order_count:int) -> bool:
+        '''index holds same channel order count as passed db_order_count (see check_order_index in database.py)'''
+        return self.db_order_count == db_order_count
+
+    def needs_rebuild(self) -> bool:
+        '''index file is missing, corrupted or left by interrupted in place update'''
+        return not self.bloom_bits or self.db_order_count in (MISSING_ORDER_COUNT, UNSYNCED_ORDER_COUNT)
+
+    @property
+    def capacity(self) -> int:
+        '''hashes count bloom filter is sized for'''
+        return self.bloom_bits // BLOOM_BITS_PER_ID
+
+    def get_false_positive_rate(self) -> float:
+        '''returns estimated bloom filter false positive rate: (share of set bits) ^ hash functions'''
+        if not self.bloom_bits:
+            return 1.0
+        return (self.bloom_set_bits / self.bloom_bits) ** self.hash_functions
+
+    def add(self, order_ids:list):
+        '''merges order_ids (just added to db) hashes into index file in place, adds their count to header db order count:
+        bloom bits are set for new hashes only, sorted new hashes are merged into hashes array from first insert position.
+        Index is rebuilt if new hashes exceed bloom filter capacity or its false positive rate limit'''
+        if not order_ids:
+            return
+        if self.needs_rebuild():
+            logging.warning(f'Order id index for {self.sales_channel} requires rebuild, {len(order_ids)} added orders not indexed')
+            return
+        db_order_count = self.db_order_count + len(order_ids)
+        new_hashes = sorted(set(order_id_hash(order_id) for order_id in order_ids))
+        new_hashes = [id_hash for id_hash in new_hashes if not self._in_hashes(id_hash)]
+        if len(self.hashes) + len(new_hashes) > self.capacity:
+            self._save(list(heapq.merge(self.hashes, new_hashes)), db_order_count)
+            return
+        start = bisect.bisect_left(self.hashes, new_hashes[0]) if new_hashes else len(self.hashes)
+        tail, prev = array.array('Q'), start
+        for id_hash in new_hashes:
+            pos = bisect.bisect_left(self.hashes, id_hash, prev)
+            self._copy_hashes(tail, prev, pos)
+            tail.append(id_hash)
+            prev = pos
+        self._copy_hashes(tail, prev, len(self.hashes))
+        self._update(start, tail, new_hashes, db_order_count)
+
+    def remove(self, order_ids:list):
+        '''removes order_ids (just deleted from db) hashes from hashes array in place, subtracts their count from header
+        db order count. Bloom filter keeps bits of removed hashes (rejected by hashes array lookup),
+        index is rebuilt once its false positive rate limit is exceeded. Index requiring rebuild is left untouched'''
+        if not order_ids or self.needs_rebuild():
+            return
+        db_order_count = max(0, self.db_order_count - len(order_ids))
+        drop_hashes = set(order_id_hash(order_id) for order_id in order_ids)
+        positions = sorted(bisect.bisect_left(self.hashes, id_hash) for id_hash in drop_hashes if self._in_hashes(id_hash))
+        start = positions[0] if positions else len(self.hashes)
+        tail, prev = array.array('Q'), start
+        for pos in positions:
+            self._copy_hashes(tail, prev, pos)
+            prev = pos + 1
+        self._copy_hashes(tail, prev, len(self.hashes))
+        self._update(start, tail, [], db_order_count)
+
+    def _copy_hashes(self, tail:array.array, start:int, end:int):
+        '''appends hashes[start:end] to tail (bulk copy of mapped memoryview or byteswapped array)'''
+        with memoryview(self.hashes) as view:
+            tail.frombytes(view[start:end].cast('B'))
+
+    def rebuild(self, order_ids:list):
+        '''replaces index contents with order_ids (all channel orders in db)'''
+        self._save(sorted(set(order_id_hash(order_id) for order_id in order_ids)), len(order_ids))
+
+    def matches(self, order_ids) -> bool:
+        '''returns True if index contains exactly passed order_ids (compared by hash)'''
+        return list(self.hashes) == sorted(set(order_id_hash(order_id) for order_id in order_ids))
+
+    def _update(self, start:int, tail:array.array, new_hashes:list, db_order_count:int):
+        '''rewrites hashes array of index file from position start with sorted tail (file is resized), sets bloom bits
+        of new_hashes, remaps file. Header holds UNSYNCED_ORDER_COUNT until update is written. Index is rebuilt if
+        false positive rate limit is exceeded afterwards'''
+        bloom_bits, hash_functions, bloom_set_bits = self.bloom_bits, self.hash_functions, self.bloom_set_bits
+        hashes_count = start + len(tail)
+        bloom_end = HEADER_STRUCT.size + bloom_bits // 8
+        # mapped file can not be resized on Windows
+        self.close()
+        with open(self.index_path, 'r+b') as f:
+            f.write(HEADER_STRUCT.pack(INDEX_MAGIC, bloom_bits, hash_functions, bloom_set_bits, hashes_count, UNSYNCED_ORDER_COUNT))
+            f.flush()
+            if new_hashes:
+                with mmap.mmap(f.fileno(), bloom_end) as bloom_map:
+                    for id_hash in new_hashes:
+                        for pos in self._bloom_positions(id_hash, bloom_bits, hash_functions):
+                            offset, bit = HEADER_STRUCT.size + (pos >> 3), 1 << (pos & 7)
+                            if not bloom_map[offset] & bit:
+                                bloom_map[offset] |= bit
+                                bloom_set_bits += 1
+            f.seek(bloom_end + start * 8)
+            f.write(to_little_endian(tail))
+            f.truncate()
+            f.seek(0)
+            f.write(HEADER_STRUCT.pack(INDEX_MAGIC, bloom_bits, hash_functions, bloom_set_bits, hashes_count, db_order_count))
+        self._load()
+        logging.debug(f'Order id index {self.sales_channel} updated: {len(new_hashes)} new hashes, {len(tail)} hashes rewritten, '
+                    f'{hashes_count} hashes, db order count: {db_order_count}')
+        if self.get_false_positive_rate() > MAX_BLOOM_FP_RATE:
+            logging.info(f'Order id index {self.sales_channel} bloom filter false positive rate limit exceeded. Rebuilding index')
+            self._save(list(self.hashes), db_order_count)
+
+    def _save(self, sorted_hashes:list, db_order_count:int):
+        '''writes index file from sorted hashes (bloom filter recalculated for BLOOM_CAPACITY_HEADROOM times hashes count)
+        to temp file, replaces index file, remaps it'''
+        bloom_bits = get_bloom_bits_count(len(sorted_hashes) * BLOOM_CAPACITY_HEADROOM)
+        bloom = bytearray(bloom_bits // 8)
+        for id_hash in sorted_hashes:
+            for pos in self._bloom_positions(id_hash, bloom_bits, BLOOM_HASH_FUNCTIONS):
+                bloom[pos >> 3] |= 1 << (pos & 7)
+        header = HEADER_STRUCT.pack(INDEX_MAGIC, bloom_bits, BLOOM_HASH_FUNCTIONS, count_set_bits(bloom), len(sorted_hashes), db_order_count)
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(bloom)
+            f.write(to_little_endian(array.array('Q', sorted_hashes)))
+        # mapped file can not be replaced on Windows
+        self.close()
+        os.replace(tmp_path, self.index_path)
+        self._load()
+        logging.debug(f'Order id index {self.sales_channel} saved: {len(sorted_hashes)} hashes, {bloom_bits} bloom bits, db order count: {db_order_count}')
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,268 @@
+import logging
+import re
+from utils import get_order_quantity
+from sku_symbols import SKUQuantities, SKUSymbolTable
+from channels import get_channel, ChannelColumns
+from sku_mapping import SKUMappingIndex, strip_quantity_prefix
+from listing_compositions import get_composition_key, get_multipliers_map
+from exceptions import SourceHeadersError
+from constants import VBA_KEYERROR_ALERT, VBA_ERROR_ALERT
+
+
+# GLOBAL VARIABLES
+DIGITS_REGEX = re.compile(r'\d+')
+
+
+class PlanResult():
+    '''Output of ChannelPlan.run():
+
+    - valid_orders:list - cleaned orders with added 'sku_quantities' key
+    - invalid_orders:list - cleaned orders, which quantities could not be determined
+    - sku_totals:SKUQuantities - summed sku quantities of valid orders (interned sku ids)
+    - alerts:list - VBA alerts of orders, which quantity could not be read (order counted with quantity 1)
+    - carts:dict - {same buyer order id: [orders]} valid and invalid orders grouped by buyer order (shopping cart)
+    - unmapped_skus:dict - {sku: [candidate custom labels]} skus (without inner quantity prefix) of channel using sku mapping,
+    matching no mapping entry. Candidates are ranked on first access (see set_unmapped_skus_getter), not while parsing
+    - unresolved_compositions:dict - {composition key: order id} ambiguous orders (skus, number of items) of no learned composition'''
+
+    def __init__(self, sku_totals:SKUQuantities=None, alerts:list=None):
+        self.valid_orders = []
+        self.invalid_orders = []
+        self.sku_totals = sku_totals if sku_totals is not None else SKUQuantities()
+        self.alerts = alerts if alerts is not None else []
+        self.carts = {}
+        self._unmapped_skus = {}
+        self._get_unmapped_skus = None
+        self.unresolved_compositions = {}
+
+    @property
+    def unmapped_skus(self) -> dict:
+        if self._get_unmapped_skus is not None:
+            self._unmapped_skus, self._get_unmapped_skus = self._get_unmapped_skus(), None
+        return self._unmapped_skus
+
+    @unmapped_skus.setter
+    def unmapped_skus(self, unmapped_skus:dict):
+        self._unmapped_skus, self._get_unmapped_skus = unmapped_skus, None
+
+    def set_unmapped_skus_getter(self, get_unmapped_skus):
+        '''sets callable returning unmapped_skus, called once on first unmapped_skus access'''
+        self._get_unmapped_skus = get_unmapped_skus
+
+    @property
+    def export_obj(self) -> dict:
+        '''returns export object: {'sku1': qty1, 'sku2': qty2, ...}'''
+        return self.sku_totals.to_dict()
+
+    def get_cart_sku_totals(self, cart_id:str) -> dict:
+        '''returns {sku: qty} summed over valid orders of cart_id'''
+        sku_totals = {}
+        for order in self.carts.get(cart_id, []):
+            for sku, quantity in order.get('sku_quantities', {}).items():
+                sku_totals[sku] = sku_totals.get(sku, 0) + quantity
+        return sku_totals
+
+
+class ChannelPlan():
+    '''Single pass clean / parse / aggregate stage compiled once per sales channel.
+
+    Replaces three loops (cleaning in main, channel specific parsing and export_obj summing in ParseOrders).
+    Proxy keys, quantity regex, sku splitting and country rules are resolved on compile from registered
+    ChannelAdapter (see channels.py), parsed sku codes (mapping + inner quantity) are cached per distinct raw sku,
+    so each row costs few dict lookups.
+
+    Args:
+    - sales_channel:str - 'Etsy' / 'Amazon' / 'Amazon Warehouse'
+    - proxy_keys:dict - keys mapping specific to sales channel
+    - sku_mapping:dict - optional {amazon_sku: custom_label} mapping (or compiled SKUMappingIndex) applied before parsing inner quantity.
+    Unmapped skus are recorded while parsing (self.unmapped_raw_skus), candidate labels are ranked by get_unmapped_skus
+    - compositions:dict - optional {composition key: [multipliers]} learned listing compositions resolving ambiguous orders
+    (several skus, number of items telling no quantities, see listing_compositions.py). Others in self.unresolved_compositions
+
+    Main methods:
+    - process(order) - cleans (in place) and parses single order, returns (order key, sku quantities or None if invalid)
+    - run(orders) - processes all orders, returns PlanResult
+    - bind_columns(headers), process_row(row) - positional parsing of csv rows (no order dicts, no cleaning)'''
+
+    def __init__(self, sales_channel:str, proxy_keys:dict, sku_mapping:dict=None, compositions:dict=None):
+        self.sales_channel = sales_channel
+        self.adapter = get_channel(sales_channel)
+        self.proxy_keys = proxy_keys
+        self.sku_mapping = sku_mapping if isinstance(sku_mapping, SKUMappingIndex) else SKUMappingIndex(sku_mapping)
+        # bound once: empty mapping is not looked up per raw sku
+        self.__resolve_sku = self.sku_mapping.resolve if self.sku_mapping else None
+        self.unmapped_raw_skus = {}
+        self.compositions = compositions if compositions else {}
+        self.unresolved_compositions = {}
+        self.resolved_by_composition = 0
+        self.order_id_key = proxy_keys['order-id']
+        self.sku_key = proxy_keys['sku']
+        self.quantity_key = proxy_keys['quantity-purchased']
+        self.country_key = proxy_keys['ship-country']
+        self.cart_key = proxy_keys.get('same-buyer-order-id')
+        self.quantity_regex = re.compile(self.adapter.quantity_pattern)
+        # per run symbol table: handed to helper file update with sku_totals
+        self.symbols = SKUSymbolTable()
+        self.sku_totals = SKUQuantities(self.symbols)
+        self.alerts = []
+        self.columns = None
+        self.__sku_cache = {}
+        self.__compile_channel_rules()
+
+    def __compile_channel_rules(self):
+        '''binds sales channel specific sku splitting, country cleaning and quantities resolving functions'''
+        self.split_sku = self.adapter.split_sku
+        self.clean_country = self.adapter.clean_country
+        if self.adapter.skus_counted_in_quantity:
+            self.resolve_sku_quantities = self._resolve_etsy_sku_quantities
+        else:
+            self.resolve_sku_quantities = self._resolve_amazon_sku_quantities
+
+    def bind_columns(self, headers:list) -> ChannelColumns:
+        '''validates source file headers (SourceHeadersError on missing column), binds column positions used by process_row'''
+        self.columns = self.adapter.compile(headers)
+        self.__sku_index = self.columns.indexes['sku']
+        self.__quantity_index = self.columns.indexes.get('quantity-purchased')
+        self.__order_id_index = self.columns.indexes['order-id']
+        return self.columns
+
+    def run(self, orders:list, progress=None) -> PlanResult:
+        '''cleans, parses and aggregates orders in single pass. Raises SourceHeadersError if order is missing expected column.
+        Optional progress (ProgressReporter) is updated while orders are processed'''
+        # sku quantities are accumulated into plan sku_totals while parsing valid orders
+        result = PlanResult(self.sku_totals, self.alerts)
+        result.unresolved_compositions = self.unresolved_compositions
+        process = self.process
+        valid_append, invalid_append = result.valid_orders.append, result.invalid_orders.append
+        cart_key, carts = self.cart_key, result.carts
+        for order in progress.iterate(orders) if progress else orders:
+            try:
+                _, sku_quantities = process(order)
+            except KeyError as e:
+                logging.critical('Failed while cleaning loaded orders. Missing column: %s. Source file columns: %s', e, list(order))
+                raise SourceHeadersError(f'Missing column: {e}') from e
+            cart_id = order.get(cart_key) if cart_key else None
+            if cart_id:
+                carts.setdefault(cart_id, []).append(order)
+            if sku_quantities is None:
+                invalid_append(order)
+                continue
+            valid_append(order)
+        result.set_unmapped_skus_getter(self.get_unmapped_skus)
+        logging.info(f'{self.sales_channel} plan processed {len(orders)} orders, distinct raw skus parsed: {len(self.__sku_cache)}, '
+                    f'unmapped: {len(self.unmapped_raw_skus)}, resolved by listing composition: {self.resolved_by_composition}')
+        return result
+
+    def process(self, order:dict) -> tuple:
+        '''cleans order in place, adds 'sku_quantities' key for valid orders.
+        Returns tuple: (order key, sku quantities dict or None if order is invalid)'''
+        skus = self.split_sku(order[self.sku_key])
+        # sku str value replaced by list of skus
+        order[self.sku_key] = skus
+        if self.clean_country:
+            order[self.country_key] = self.clean_country(order[self.country_key])
+        sku_quantities = self.resolve_sku_quantities(order.get(self.order_id_key), self._get_quantity(order), skus)
+        if sku_quantities is not None:
+            order['sku_quantities'] = sku_quantities
+        return order[self.order_id_key], sku_quantities
+
+    def process_row(self, row:list):
+        '''parses csv row of bound columns (see bind_columns) without building order dict. Order is not cleaned
+        (raw sku field, country kept). Returns sku quantities dict or None if order is invalid'''
+        skus = self.split_sku(row[self.__sku_index])
+        return self.resolve_sku_quantities(row[self.__order_id_index], self._get_row_quantity(row), skus)
+
+    def get_unmapped_skus(self, raw_skus:dict=None) -> dict:
+        '''returns {sku without inner quantity prefix: [candidate custom labels]} of unmapped raw_skus ({raw sku: canonical base sku},
+        default: all recorded while parsing). Candidates are ranked here, once per base sku, not in parsing loop'''
+        raw_skus = self.unmapped_raw_skus if raw_skus is None else raw_skus
+        # reported once per sku regardless of inner quantity prefix: single mapping entry covers all
+        return {strip_quantity_prefix(sku): self.sku_mapping.get_unmapped_candidates(base_key) for sku, base_key in raw_skus.items()}
+
+    def _get_quantity(self, order:dict) -> int:
+        '''returns 'quantity-purchased' value as integer. Falls back to utils.get_order_quantity (1), adding VBA alert'''
+        try:
+            return int(order[self.quantity_key])
+        except (KeyError, ValueError) as e:
+            self.alerts.append(VBA_KEYERROR_ALERT if isinstance(e, KeyError) else VBA_ERROR_ALERT)
+            return get_order_quantity(order, self.proxy_keys)
+
+    def _get_row_quantity(self, row:list) -> int:
+        '''positional _get_quantity: quantity column value as integer, 1 with VBA alert if column is missing or not a number'''
+        if self.__quantity_index is None:
+            self.alerts.append(VBA_KEYERROR_ALERT)
+            logging.critical('Failed to retrieve order quantity (column: %s) for order: %s. Returning 1', self.quantity_key, row[self.__order_id_index])
+            return 1
+        try:
+            return int(row[self.__quantity_index])
+        except ValueError:
+            self.alerts.append(VBA_ERROR_ALERT)
+            logging.critical('Failed to convert order quantity: %r for order: %s. Returning 1', row[self.__quantity_index], row[self.__order_id_index])
+            return 1
+
+    def _resolve_etsy_sku_quantities(self, order_id:str, qty_purchased:int, skus:list):
+        '''returns dict for each sku and matching real parsed quantity or None if order q-ty and skus may yield various combinations
+        and composition was not resolved before (see listing_compositions.py)'''
+        if len(skus) > 1 and qty_purchased > 1 and qty_purchased != len(skus):
+            key = get_composition_key(skus, qty_purchased)
+            multipliers = self.compositions.get(key)
+            if multipliers is not None:
+                self.resolved_by_composition += 1
+                return self._get_sku_quantities(skus, qty_purchased, get_multipliers_map(key, multipliers))
+            logging.info('Etsy order q-ty and skus may yield various combinations. Qty: %s, skus: %s. Ordr being added to invalid list', qty_purchased, skus)
+            self.unresolved_compositions.setdefault(key, order_id)
+            return None
+        if len(skus) == qty_purchased:
+            # order having 7 skus in order will have qty_purchased 7. In reality 7 items were purchased w/ individual quantity = 1
+            qty_purchased = 1
+        return self._get_sku_quantities(skus, qty_purchased)
+
+    def _resolve_amazon_sku_quantities(self, order_id:str, qty_purchased:int, skus:list):
+        '''returns dict for each (mapped) sku and matching real parsed quantity. In unlikely error returns None (invalid order)'''
+        try:
+            return self._get_sku_quantities(skus, qty_purchased)
+        except Exception as e:
+            logging.critical('Unexpected error while parsing amazon order: %s Err: %s. Adding to invalid orders list', order_id, e)
+            return None
+
+    def _get_sku_quantities(self, skus:list, qty_purchased:int, multipliers:dict=None) -> dict:
+        '''returns {inner_sku: real quantity} for order skus, adds quantities to self.sku_totals by interned sku id.
+        multipliers - optional {raw sku: multiplier} replacing qty_purchased per sku (resolved listing composition)'''
+        sku_qties = {}
+        cache = self.__sku_cache
+        totals = self.sku_totals.quantities
+        for sku in skus:
+            parsed = cache.get(sku)
+            inner_qty, inner_sku, sku_id = parsed if parsed else self._parse_inner_qty_sku(sku)
+            if inner_sku in sku_qties:
+                # same sku listed twice in order: last one wins
+                totals[sku_id] -= sku_qties[inner_sku]
+            sku_qties[inner_sku] = real_sku_qty = inner_qty * (multipliers[sku.strip()] if multipliers else qty_purchased)
+            totals[sku_id] += real_sku_qty
+        return sku_qties
+
+    def _parse_inner_qty_sku(self, sku:str) -> tuple:
+        '''returns (inner quantity, inner sku, interned inner sku id) for raw sku and caches it.
+        Mapping is applied before parsing (see utils.get_inner_qty_sku), unmapped sku is recorded in self.unmapped_raw_skus'''
+        # attempt to find matching Shop4Top sku for every amazon original sku before parsing
+        code, base_key = self.__resolve_sku(sku) if self.__resolve_sku else (None, None)
+        if code is not None:
+            logging.debug('Mapping match found for code: %s, match: %s', sku, code)
+        else:
+            code = sku
+            if base_key is not None:
+                self.unmapped_raw_skus[sku] = base_key
+        # most skus have no inner quantity prefix: no exception raised and caught for them
+        match = self.quantity_regex.match(code) if isinstance(code, str) else None
+        if match:
+            quantity_str = match.group(0)
+            inner_qty, inner_sku = int(DIGITS_REGEX.search(quantity_str).group(0)), code.replace(quantity_str, '')
+        else:
+            inner_qty, inner_sku = 1, code
+        parsed = inner_qty, inner_sku, self.sku_totals.reserve_sku(inner_sku)
+        self.__sku_cache[sku] = parsed
+        return parsed
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,336 @@
+import urllib.request
+import urllib.error
+import hashlib
+import uuid
+import abc
+import logging
+import json
+import time
+import csv
+import os
+from datetime import datetime
+from helper_file import HelperFileCreate, HelperFileUpdate
+from exceptions import InventoryError, HelperFileError, OutputSinkError
+from utils import get_output_dir, sort_by_quantity
+from constants import EXPORT_FILE
+
+
+# GLOBAL VARIABLES
+SINKS_CONFIG_NAME = 'output_sinks.json'
+# {new orders hash: run key} of runs delivered to sinks, not yet committed to database (see get_run_key)
+PENDING_RUN_KEYS_NAME = 'pending run keys.json'
+# {undo run key: [sinks already written]} of undo-runs not yet committed to database (see RunRollback)
+PENDING_UNDO_SINKS_NAME = 'pending undo sinks.json'
+# sinks used when config file is missing: local helper file only (behaviour before sinks)
+DEFAULT_SINKS_CONFIG = {'sinks': [{'type': 'xlsx'}]}
+DEFAULT_CSV_NAME = 'inventory deltas.csv'
+DEFAULT_JSONL_NAME = 'inventory deltas.jsonl'
+CSV_HEADERS = ['run_key', 'timestamp', 'sales_channel', 'sku', 'quantity']
+SERVICE_TIMEOUT = 10
+SERVICE_RETRIES = 4
+# seconds, doubled after each failed attempt
+SERVICE_BACKOFF = 0.5
+SERVICE_MAX_BACKOFF = 30
+# responses retried with backoff. 409: delta with same idempotency key already applied - success
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def get_orders_hash(sales_channel:str, order_ids:list) -> str:
+    '''returns hash of sales channel and sorted new order ids'''
+    digest = hashlib.sha1(sales_channel.encode('utf-8'))
+    for order_id in sorted(order_ids):
+        digest.update(b'\0' + str(order_id).encode('utf-8'))
+    return digest.hexdigest()
+
+def get_pending_run_keys_path(output_dir:str=None) -> str:
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    return os.path.join(output_dir, PENDING_RUN_KEYS_NAME)
+
+def _read_pending(fpath:str) -> dict:
+    '''returns contents of pending keys json fpath, empty dict if file is missing / unreadable'''
+    if not os.path.exists(fpath):
+        return {}
+    try:
+        with open(fpath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f'Could not read pending keys {fpath}. Err: {e}')
+        return {}
+
+def _write_pending(fpath:str, pending:dict):
+    '''writes pending keys json fpath, deletes file when nothing is pending'''
+    if not pending:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+        return
+    with open(fpath, 'w', encoding='utf-8') as f:
+        json.dump(pending, f, indent=2)
+
+def read_pending_run_keys(output_dir:str=None) -> dict:
+    '''returns {new orders hash: run key} of runs not yet committed to database, empty dict if file is missing / unreadable'''
+    return _read_pending(get_pending_run_keys_path(output_dir))
+
+def write_pending_run_keys(pending_run_keys:dict, output_dir:str=None):
+    _write_pending(get_pending_run_keys_path(output_dir), pending_run_keys)
+
+def get_run_key(sales_channel:str, order_ids:list, output_dir:str=None) -> str:
+    '''returns idempotency key of run sku deltas: sales channel and random nonce, unique per run.
+    Key is kept in PENDING_RUN_KEYS_NAME (by hash of new order ids) until run orders are committed to database (release_run_key):
+    repeated run of same new orders after crash reuses key, same export loaded again after undo-run gets new key'''
+    orders_hash = get_orders_hash(sales_channel, order_ids)
+    pending_run_keys = read_pending_run_keys(output_dir)
+    if orders_hash in pending_run_keys:
+        logging.info(f'Reusing run key {pending_run_keys[orders_hash]} of run not committed to database')
+        return pending_run_keys[orders_hash]
+    run_key = f'{sales_channel.lower().replace(" ", "-")}-{uuid.uuid4().hex[:20]}'
+    pending_run_keys[orders_hash] = run_key
+    write_pending_run_keys(pending_run_keys, output_dir)
+    return run_key
+
+def release_run_key(run_key:str, output_dir:str=None):
+    '''forgets pending run_key after run orders were committed to database'''
+    pending_run_keys = read_pending_run_keys(output_dir)
+    remaining = {orders_hash: key for orders_hash, key in pending_run_keys.items() if key != run_key}
+    if len(remaining) != len(pending_run_keys):
+        write_pending_run_keys(remaining, output_dir)
+
+def get_pending_undo_sinks_path(output_dir:str=None) -> str:
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    return os.path.join(output_dir, PENDING_UNDO_SINKS_NAME)
+
+def get_applied_undo_sinks(undo_key:str, output_dir:str=None) -> list:
+    '''returns sinks (repr) which already received negated deltas of undo_key, while run is not yet deleted from database'''
+    return _read_pending(get_pending_undo_sinks_path(output_dir)).get(undo_key, [])
+
+def add_applied_undo_sink(undo_key:str, sink:object, output_dir:str=None):
+    '''records sink as written for undo_key: repeated undo-run (after later sink or database failure) skips it'''
+    fpath = get_pending_undo_sinks_path(output_dir)
+    pending = _read_pending(fpath)
+    pending.setdefault(undo_key, []).append(repr(sink))
+    _write_pending(fpath, pending)
+
+def release_undo_key(undo_key:str, output_dir:str=None):
+    '''forgets applied sinks of undo_key after run was deleted from database'''
+    fpath = get_pending_undo_sinks_path(output_dir)
+    pending = _read_pending(fpath)
+    if pending.pop(undo_key, None) is not None:
+        _write_pending(fpath, pending)
+
+def get_deltas_payload(export_obj:dict, run_key:str, sales_channel:str) -> dict:
+    '''returns json serializable run deltas: {'run_key', 'sales_channel', 'timestamp', 'deltas': [[sku, qty], ...]}'''
+    return {'run_key': run_key, 'sales_channel': sales_channel, 'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'deltas': [[sku, quantity] for sku, quantity in sort_by_quantity(export_obj)]}
+
+
+class OutputSink(abc.ABC):
+    '''Destination of run sku deltas (export_obj: {sku: qty} / SKUQuantities, negative quantities subtract).
+
+    - idempotent:bool - repeated write with same run_key is applied once (such sinks are written first, see ParseOrders)
+    - write(export_obj, run_key, sales_channel, drop_empty=False) - delivers deltas, raises InventoryError subclass'''
+    name = 'sink'
+    idempotent = False
+
+    @abc.abstractmethod
+    def write(self, export_obj:dict, run_key:str, sales_channel:str, drop_empty:bool=False):
+        pass
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__}>'
+
+
+class XlsxSink(OutputSink):
+    '''local helper file (EXPORT_FILE): created on first run, updated (merged) afterwards'''
+    name = 'xlsx'
+
+    def __init__(self, inventory_file:str=None, open_files:bool=True, backup_dir:str=None):
+        self.inventory_file = inventory_file if inventory_file else os.path.join(get_output_dir(client_file=True), EXPORT_FILE)
+        self.open_files = open_files
+        self.backup_dir = backup_dir
+
+    def write(self, export_obj:dict, run_key:str, sales_channel:str, drop_empty:bool=False):
+        '''Depending on file existence CREATES or UPDATES helper file'''
+        if os.path.exists(self.inventory_file):
+            logging.debug(f'{self.inventory_file} found. Updating...')
+            self.update_inventory_file(export_obj, drop_empty)
+        else:
+            logging.debug(f'{self.inventory_file} not found. Creating file from scratch...')
+            self.create_inventory_file(export_obj)
+
+    def update_inventory_file(self, export_obj:dict, drop_empty:bool=False):
+        '''creates HelperFileUpdate instance, and updates data in self.inventory_file xlsx file'''
+        try:
+            HelperFileUpdate(export_obj, drop_empty=drop_empty, backup_dir=self.backup_dir).update_workbook(self.inventory_file)
+            logging.info(f'Helper file {os.path.basename(self.inventory_file)} successfully updated, opening: {self.open_files}')
+            if self.open_files:
+                os.startfile(self.inventory_file)
+        except InventoryError:
+            raise
+        except Exception as e:
+            logging.exception(f'Unexpected error UPDATING helper file. Alerting VBA, exiting... Last error: {e}')
+            raise HelperFileError(f'Unexpected error updating helper file: {e}') from e
+
+    def create_inventory_file(self, export_obj:dict):
+        '''creates HelperFileCreate instance, and exports data in xlsx format'''
+        try:
+            HelperFileCreate(export_obj).export(self.inventory_file)
+            logging.info(f'Helper file {os.path.basename(self.inventory_file)} successfully created, opening: {self.open_files}')
+            if self.open_files:
+                os.startfile(self.inventory_file)
+        except Exception as e:
+            logging.exception(f'Unexpected error CREATING helper file. Alerting VBA, exiting... Last error: {e}')
+            raise HelperFileError(f'Unexpected error creating helper file: {e}') from e
+
+    def __repr__(self) -> str:
+        return f'<XlsxSink {self.inventory_file}>'
+
+
+class CSVSink(OutputSink):
+    '''appends run deltas to csv file, one row per sku (CSV_HEADERS)'''
+    name = 'csv'
+
+    def __init__(self, fpath:str=None):
+        self.fpath = fpath if fpath else os.path.join(get_output_dir(client_file=True), DEFAULT_CSV_NAME)
+
+    def write(self, export_obj:dict, run_key:str, sales_channel:str, drop_empty:bool=False):
+        payload = get_deltas_payload(export_obj, run_key, sales_channel)
+        try:
+            write_headers = not os.path.exists(self.fpath)
+            with open(self.fpath, 'a', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                if write_headers:
+                    writer.writerow(CSV_HEADERS)
+                writer.writerows([run_key, payload['timestamp'], sales_channel, sku, quantity] for sku, quantity in payload['deltas'])
+        except OSError as e:
+            logging.critical(f'Failed to append run {run_key} deltas to {self.fpath}. Err: {e}')
+            raise OutputSinkError(f'Failed to write {self.fpath}: {e}') from e
+        logging.info(f'{len(payload["deltas"])} sku deltas of run {run_key} appended to {os.path.basename(self.fpath)}')
+
+    def __repr__(self) -> str:
+        return f'<CSVSink {self.fpath}>'
+
+
+class JSONLSink(OutputSink):
+    '''appends run deltas to json lines file, one line (get_deltas_payload) per run'''
+    name = 'jsonl'
+
+    def __init__(self, fpath:str=None):
+        self.fpath = fpath if fpath else os.path.join(get_output_dir(client_file=True), DEFAULT_JSONL_NAME)
+
+    def write(self, export_obj:dict, run_key:str, sales_channel:str, drop_empty:bool=False):
+        payload = get_deltas_payload(export_obj, run_key, sales_channel)
+        try:
+            with open(self.fpath, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logging.critical(f'Failed to append run {run_key} deltas to {self.fpath}. Err: {e}')
+            raise OutputSinkError(f'Failed to write {self.fpath}: {e}') from e
+        logging.info(f'{len(payload["deltas"])} sku deltas of run {run_key} appended to {os.path.basename(self.fpath)}')
+
+    def __repr__(self) -> str:
+        return f'<JSONLSink {self.fpath}>'
+
+
+class InventoryServiceSink(OutputSink):
+    '''Remote inventory service (spreadsheet backend). Whole run is sent as single batched POST of json deltas
+    (get_deltas_payload) with 'Idempotency-Key: <run key>' header: service applies each key once.
+
+    Connection errors, timeouts and RETRY_STATUSES responses are retried with exponential backoff
+    (Retry-After header respected), other 4xx responses fail at once. See inventory_service.py for local stand-in server.
+
+    Args:
+    - url:str - deltas endpoint
+    - token:str - optional bearer token
+    - timeout:float, retries:int, backoff:float - request timeout, retries after first attempt, first retry delay (seconds)'''
+    name = 'service'
+    idempotent = True
+
+    def __init__(self, url:str, token:str=None, timeout:float=SERVICE_TIMEOUT, retries:int=SERVICE_RETRIES,
+                backoff:float=SERVICE_BACKOFF, sleep=time.sleep):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def write(self, export_obj:dict, run_key:str, sales_channel:str, drop_empty:bool=False):
+        payload = get_deltas_payload(export_obj, run_key, sales_channel)
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json; charset=utf-8', 'Idempotency-Key': run_key}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        for attempt in range(self.retries + 1):
+            request = urllib.request.Request(self.url, data=body, headers=headers, method='POST')
+            retry_after = None
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    logging.info(f'{len(payload["deltas"])} sku deltas of run {run_key} delivered to {self.url} '
+                                f'(status {response.status}, attempt {attempt + 1})')
+                    return
+            except urllib.error.HTTPError as e:
+                if e.code == 409:
+                    logging.info(f'Run {run_key} deltas already applied by {self.url}')
+                    return
+                if e.code not in RETRY_STATUSES:
+                    logging.critical(f'Inventory service rejected run {run_key} deltas. Status: {e.code}, response: {e.read()[:500]!r}')
+                    raise OutputSinkError(f'Inventory service rejected deltas: HTTP {e.code}') from e
+                error = e
+                retry_after = e.headers.get('Retry-After') if e.headers else None
+            except (urllib.error.URLError, OSError) as e:
+                error = e
+            if attempt == self.retries:
+                break
+            delay = self.get_delay(attempt, retry_after)
+            logging.warning(f'Inventory service attempt {attempt + 1} failed: {error}. Retrying in {delay:.1f}s')
+            self.sleep(delay)
+        logging.critical(f'Failed to deliver run {run_key} deltas to {self.url} after {self.retries + 1} attempts. Last err: {error}')
+        raise OutputSinkError(f'Inventory service unavailable: {error}') from error
+
+    def get_delay(self, attempt:int, retry_after:str=None) -> float:
+        '''returns seconds to wait before retry: Retry-After seconds if passed, else exponential backoff'''
+        try:
+            return min(float(retry_after), SERVICE_MAX_BACKOFF)
+        except (TypeError, ValueError):
+            return min(self.backoff * 2 ** attempt, SERVICE_MAX_BACKOFF)
+
+    def __repr__(self) -> str:
+        return f'<InventoryServiceSink {self.url}>'
+
+
+def read_sinks_config(output_dir:str=None) -> dict:
+    '''returns sinks config from SINKS_CONFIG_NAME json in output_dir, DEFAULT_SINKS_CONFIG if file is missing'''
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    config_path = os.path.join(output_dir, SINKS_CONFIG_NAME)
+    if not os.path.exists(config_path):
+        return DEFAULT_SINKS_CONFIG
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def get_output_sinks(open_files:bool=True, config:dict=None) -> list:
+    '''returns configured output sinks, idempotent ones first (see read_sinks_config). Relative paths are relative
+    to client output dir. Example config:
+
+    {"sinks": [{"type": "xlsx"}, {"type": "jsonl", "path": "deltas.jsonl"}, {"type": "service", "url": "http://127.0.0.1:8765/deltas"}]}'''
+    config = config if config else read_sinks_config()
+    client_dir = get_output_dir(client_file=True)
+    sinks = []
+    for sink_config in config.get('sinks', []):
+        sink_type = sink_config.get('type')
+        fpath = os.path.join(client_dir, sink_config['path']) if sink_config.get('path') else None
+        if sink_type == 'xlsx':
+            sinks.append(XlsxSink(fpath, open_files))
+        elif sink_type == 'csv':
+            sinks.append(CSVSink(fpath))
+        elif sink_type == 'jsonl':
+            sinks.append(JSONLSink(fpath))
+        elif sink_type == 'service':
+            sinks.append(InventoryServiceSink(sink_config['url'], sink_config.get('token'), sink_config.get('timeout', SERVICE_TIMEOUT),
+                                            sink_config.get('retries', SERVICE_RETRIES), sink_config.get('backoff', SERVICE_BACKOFF)))
+        else:
+            raise OutputSinkError(f'Unexpected output sink type in {SINKS_CONFIG_NAME}: {sink_type}')
+    # idempotent sinks first: if later (local) sink fails, run is repeated and remote deltas are not applied twice
+    return sorted(sinks, key=lambda sink: not sink.idempotent)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,222 @@
+import concurrent.futures
+import multiprocessing
+import logging
+import csv
+import io
+import os
+from order_plan import ChannelPlan, PlanResult
+from sku_symbols import SKUQuantities
+from channels import get_channel
+
+
+# GLOBAL VARIABLES
+# smaller source files are read and parsed in single process (worker start up costs more than it saves)
+PARALLEL_PARSE_MIN_BYTES = 64 * 2**20
+PARALLEL_PARSE_MAX_WORKERS = 8
+# more chunks than workers evens out uneven chunks / worker start up
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_BYTES = 2**20
+# only these order columns are sent back from workers (used by database and invalid orders export)
+SLIM_ORDER_KEYS = ['order-id', 'secondary-order-id', 'same-buyer-order-id', 'purchase-date', 'buyer-name']
+
+# worker process state, set by _init_worker
+WORKER_PLAN = None
+WORKER_ORDER_KEYS = None
+WORKER_ORDER_GETTER = None
+
+
+class ChunkBoundaryError(Exception):
+    '''source file record spans several lines (quoted newline) - byte range chunks are not record aligned'''
+
+
+class ChunkedParse():
+    '''Merged result of parse_in_chunks: slim orders in source file order and sku quantities summed per chunk.
+
+    - orders:list - slim order dicts (SLIM_ORDER_KEYS columns), valid orders with 'sku_quantities' key
+    - sku_totals:dict - {sku: [quantity, orders count]} of all valid orders
+    - alerts:list - (order position in orders, VBA alert) of orders, which quantity could not be read
+    - mapping_alerts:list - duplicate sku mapping alerts
+    - cart_key:str - same buyer order id column, orders are grouped by (see PlanResult.carts)
+    - unmapped_skus:dict - {sku: [candidate labels]} unmapped skus of all source file orders (incl. filtered ones)
+
+    Database filters already added orders from self.orders (see SQLAlchemyOrdersDB.get_new_orders_only),
+    get_plan_result(new_orders) then subtracts filtered orders from sku_totals'''
+
+    def __init__(self, sku_mapping_alerts:list=None, cart_key:str=None):
+        self.orders = []
+        self.sku_totals = {}
+        self.alerts = []
+        self.mapping_alerts = sku_mapping_alerts if sku_mapping_alerts else []
+        self.cart_key = cart_key
+        self.unmapped_skus = {}
+
+    def merge(self, chunk_result:tuple):
+        '''adds chunk_result (see parse_chunk) to merged result. Called in chunk order'''
+        orders, partial_totals, alerts, unmapped_skus = chunk_result
+        self.unmapped_skus.update(unmapped_skus)
+        offset = len(self.orders)
+        self.orders.extend(orders)
+        self.alerts.extend((offset + position, alert) for position, alert in alerts)
+        sku_totals = self.sku_totals
+        for sku, quantity, orders_count in partial_totals:
+            entry = sku_totals.get(sku)
+            if entry is None:
+                sku_totals[sku] = [quantity, orders_count]
+            else:
+                entry[0] += quantity
+                entry[1] += orders_count
+
+    def get_plan_result(self, new_orders:list) -> PlanResult:
+        '''returns PlanResult of new_orders (subset of self.orders) same as ChannelPlan.run(new_orders) would'''
+        new_order_ids = set(map(id, new_orders))
+        totals = {sku: list(entry) for sku, entry in self.sku_totals.items()}
+        if len(new_order_ids) != len(self.orders):
+            for order in self.orders:
+                if id(order) in new_order_ids or 'sku_quantities' not in order:
+                    continue
+                for sku, quantity in order['sku_quantities'].items():
+                    entry = totals[sku]
+                    entry[0] -= quantity
+                    entry[1] -= 1
+        alerts = [alert for position, alert in self.alerts if id(self.orders[position]) in new_order_ids]
+        result = PlanResult(SKUQuantities(), alerts)
+        result.unmapped_skus = dict(self.unmapped_skus)
+        for sku, (quantity, orders_count) in totals.items():
+            # skus of filtered orders only are dropped, skus summing up to 0 kept (as in ChannelPlan)
+            if orders_count:
+                result.sku_totals.add_sku(sku, quantity)
+        for order in new_orders:
+            if 'sku_quantities' in order:
+                result.valid_orders.append(order)
+            else:
+                result.invalid_orders.append(order)
+            cart_id = order.get(self.cart_key) if self.cart_key else None
+            if cart_id:
+                result.carts.setdefault(cart_id, []).append(order)
+        return result
+
+
+def get_parse_workers(workers:int=None) -> int:
+    '''returns number of parse worker processes: workers or cpu count capped at PARALLEL_PARSE_MAX_WORKERS'''
+    return workers if workers else min(os.cpu_count() or 1, PARALLEL_PARSE_MAX_WORKERS)
+
+def can_parse_in_chunks(fpath:str, encoding:str, delimiter:str) -> bool:
+    '''source file is large enough and can be split into line aligned byte ranges: tab separated (amazon exports, no
+    quoted multiline fields) and newline is single byte in file encoding (not utf-16)'''
+    if delimiter != '\t':
+        return False
+    try:
+        single_byte_newline = '\n'.encode(encoding) == b'\n'
+    except LookupError:
+        return False
+    return single_byte_newline and os.path.getsize(fpath) >= PARALLEL_PARSE_MIN_BYTES
+
+def get_chunk_ranges(fpath:str, chunks_count:int) -> tuple:
+    '''returns (header line bytes, list of (start, end) byte ranges after header), each range ends at line end'''
+    file_size = os.path.getsize(fpath)
+    with open(fpath, 'rb') as f:
+        header_line = f.readline()
+        data_start = f.tell()
+        chunk_size = max((file_size - data_start) // chunks_count + 1, MIN_CHUNK_BYTES)
+        ranges = []
+        start = data_start
+        while start < file_size:
+            f.seek(min(start + chunk_size, file_size))
+            # move chunk end to the end of line it falls into
+            f.readline()
+            end = min(f.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return header_line, ranges
+
+def get_headers(header_line:bytes, encoding:str, delimiter:str) -> list:
+    '''returns source file headers (same as csv.DictReader fieldnames)'''
+    return next(csv.reader(io.StringIO(header_line.decode(encoding), newline=None), delimiter=delimiter), [])
+
+def _init_worker(sales_channel:str, sku_mapping:dict, headers:list):
+    '''process pool initializer: compiles sales channel plan and header column positions once per worker
+    (parsed sku cache is reused across chunks)'''
+    global WORKER_PLAN, WORKER_ORDER_KEYS, WORKER_ORDER_GETTER
+    adapter = get_channel(sales_channel)
+    WORKER_PLAN = ChannelPlan(sales_channel, adapter.proxy_keys, sku_mapping)
+    columns = WORKER_PLAN.bind_columns(headers)
+    # slim order keys are source columns (as in orders read by csv.DictReader): {column: universal key}
+    slim_columns = {}
+    for key in SLIM_ORDER_KEYS:
+        if key in columns.indexes:
+            slim_columns.setdefault(adapter.proxy_keys[key], key)
+    WORKER_ORDER_KEYS = list(slim_columns)
+    WORKER_ORDER_GETTER = columns.getter(*slim_columns.values())
+
+def parse_chunk(fpath:str, start:int, end:int, encoding:str, delimiter:str) -> tuple:
+    '''worker: reads and parses source file byte range [start, end) with plan compiled by _init_worker.
+    Rows are accessed by column position, only slim order dicts are built.
+    Returns compact result: (slim orders, [(sku, quantity, orders count), ...], [(order position, alert), ...], unmapped skus)'''
+    plan, order_keys, order_getter = WORKER_PLAN, WORKER_ORDER_KEYS, WORKER_ORDER_GETTER
+    headers_count = len(plan.columns.headers)
+    with open(fpath, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding)
+    reader = csv.reader(io.StringIO(text, newline=None), delimiter=delimiter)
+    orders, partial_totals, alerts = [], {}, []
+    # worker plan collects unmapped skus across its chunks: only ones first seen in this chunk are sent back
+    unmapped_before = len(plan.unmapped_raw_skus)
+    rows_read = 0
+    for row in reader:
+        rows_read += 1
+        if not row:
+            continue
+        if len(row) < headers_count:
+            # same as csv.DictReader: missing values are None
+            row.extend([None] * (headers_count - len(row)))
+        alerts_count = len(plan.alerts)
+        sku_quantities = plan.process_row(row)
+        slim_order = dict(zip(order_keys, order_getter(row)))
+        if len(plan.alerts) > alerts_count:
+            alerts.extend((len(orders), alert) for alert in plan.alerts[alerts_count:])
+        if sku_quantities is not None:
+            slim_order['sku_quantities'] = sku_quantities
+            for sku, quantity in sku_quantities.items():
+                entry = partial_totals.get(sku)
+                if entry is None:
+                    partial_totals[sku] = [quantity, 1]
+                else:
+                    entry[0] += quantity
+                    entry[1] += 1
+        orders.append(slim_order)
+    if reader.line_num != rows_read:
+        raise ChunkBoundaryError(f'Record spanning several lines in bytes {start}-{end} of {os.path.basename(fpath)}')
+    unmapped_skus = plan.get_unmapped_skus(dict(list(plan.unmapped_raw_skus.items())[unmapped_before:]))
+    return orders, [(sku, quantity, orders_count) for sku, (quantity, orders_count) in partial_totals.items()], alerts, unmapped_skus
+
+def parse_in_chunks(fpath:str, encoding:str, delimiter:str, sales_channel:str, sku_mapping:dict, workers:int=None,
+                    sku_mapping_alerts:list=None) -> ChunkedParse:
+    '''splits source file into line aligned byte ranges after header, parses them in ProcessPoolExecutor workers,
+    merges compact results in chunk (source file) order. Raises ChunkBoundaryError if file can not be chunked
+    (caller falls back to single process parsing), SourceHeadersError if header is missing required column'''
+    workers = get_parse_workers(workers)
+    header_line, ranges = get_chunk_ranges(fpath, workers * CHUNKS_PER_WORKER)
+    headers = get_headers(header_line, encoding, delimiter)
+    adapter = get_channel(sales_channel)
+    # fails before any worker is started
+    adapter.compile(headers)
+    chunked_parse = ChunkedParse(sku_mapping_alerts, adapter.proxy_keys.get('same-buyer-order-id'))
+    # spawn on every platform: same behaviour as frozen windows exe, no forking of logging queue thread
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(ranges)) or 1, mp_context=mp_context,
+                                                initializer=_init_worker, initargs=(sales_channel, sku_mapping, headers)) as executor:
+        futures = [executor.submit(parse_chunk, fpath, start, end, encoding, delimiter) for start, end in ranges]
+        try:
+            for future in futures:
+                chunked_parse.merge(future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    logging.info(f'{os.path.basename(fpath)} parsed in {len(ranges)} chunks by {workers} workers. '
+                f'Orders: {len(chunked_parse.orders)}, distinct skus: {len(chunked_parse.sku_totals)}')
+    return chunked_parse
+
+
+if __name__ == "__main__":
+    pass
@@ -1,230 +1,186 @@
 import logging
-import sys
 import os
 from datetime import datetime
-from utils import get_output_dir, get_inner_qty_sku, get_order_quantity, dump_to_json
-from utils import delete_file, export_invalid_order_ids
-from helper_file import HelperFileCreate, HelperFileUpdate
-from sku_mapping import SKUMapping
-from constants import QUANTITY_PATTERN, EXPORT_FILE, SKU_MAPPING_WB_NAME
-from constants import VBA_ERROR_ALERT, VBA_NO_NEW_JOB, VBA_KEYERROR_ALERT
+from utils import get_output_dir
+from utils import delete_file, export_invalid_order_ids, timed_stage
+from output_sinks import get_output_sinks, get_run_key, release_run_key
+from debug_capture import DebugCapture
+from progress import ProgressReporter
+from listing_compositions import read_compositions_file, add_pending_compositions
+from order_plan import ChannelPlan, PlanResult
+from channels import get_channel
+from sku_mapping import get_sku_mapping, export_unmapped_skus
+from constants import SKU_MAPPING_WB_NAME, UNMAPPED_SKUS_NAME, LISTING_COMPOSITIONS_NAME
+
+
+def get_channel_sku_mapping(sales_channel:str, sku_mapping_fpath:str=None) -> tuple:
+    '''returns (SKUMappingIndex, duplicate mapping VBA alerts) applied by sales channel plan. Etsy orders are not mapped (empty dict)'''
+    if not get_channel(sales_channel).uses_sku_mapping:
+        return {}, []
+    sku_mapping_fpath = sku_mapping_fpath if sku_mapping_fpath else os.path.join(get_output_dir(client_file=False), SKU_MAPPING_WB_NAME)
+    return get_sku_mapping(sku_mapping_fpath)
 
 
 class ParseOrders():
     '''Parses and prepares orders with Helper File generation / update.
     
     Args:
-    - orders:list - list of orders
+    - orders:list - list of raw (not cleaned) orders. Cleaned in place by ChannelPlan
     - db_client:object - instance of database class
     - sales_channel:str - 'Etsy' / 'Amazon' / 'Amazon Warehouse'
     - proxy_keys:dict - keys mapping specific to sales channel
+    - open_files:bool - open helper file and invalid orders file after export (False in unattended watcher mode)
+    - chunked_parse:ChunkedParse - optional, orders already parsed by parallel_parse workers (orders are its slim orders)
+    - sinks:list - optional OutputSink instances receiving run sku deltas. Defaults to get_output_sinks (output_sinks.json, helper file)
+    - capture:DebugCapture - optional, streams new / valid / invalid orders to DEBUG_*.jsonl (see debug_capture.py). Default: off
+    - output_dir:str - optional directory of unmapped skus, invalid orders and listing compositions files. Default: program dirs
+    - progress:ProgressReporter - optional, plan / helper file / database stage progress lines (see progress.py). Default: off
     
     Main method:
 
     - export_orders(testing=False)
     
-    sorts orders to valid/invalid, exports invalid as separate text file, 
+    sorts orders to valid/invalid, exports invalid as separate text file, updates helper file (output sinks), pushes orders to db.
+    Errors are raised as InventoryError subclasses (see pipeline.run_pipeline)
     
     NOTE: check behaviour when testing flag is True in export_orders'''
     
-    def __init__(self, orders:list, db_client:object, sales_channel:str, proxy_keys:dict):
+    def __init__(self, orders:list, db_client:object, sales_channel:str, proxy_keys:dict, open_files:bool=True, chunked_parse=None,
+                sinks:list=None, capture:DebugCapture=None, output_dir:str=None, progress:ProgressReporter=None):
         self.orders = orders
         self.db_client = db_client
         self.sales_channel = sales_channel
         self.proxy_keys = proxy_keys
-
-        self.quantity_pattern = QUANTITY_PATTERN[sales_channel]
-        self.__get_fpaths()
-
-    def __get_fpaths(self):
-        '''initiates filepaths used to refer to or create files'''
+        self.open_files = open_files
+        self.chunked_parse = chunked_parse
+        self.sinks = sinks
+        self.capture = capture if capture else DebugCapture()
+        self.progress = progress if progress else ProgressReporter()
+        self.run_key = None
+        self.alerts = []
+        self.timings = {}
+        self.added_to_db = 0
+        self.invalid_orders_exported = None
+        self.listed_compositions = set()
+        self.__get_fpaths(output_dir)
+
+    def __get_fpaths(self, output_dir:str=None):
+        '''initiates filepaths used to refer to or create files. Sku mapping is read from program dir regardless of output_dir'''
         timestamp = datetime.today().strftime("%Y.%m.%d %H.%M")
         invalid_orders_fname = f'{self.sales_channel} invalid_orders {timestamp}.txt'
         
         self.sku_mapping_fpath = os.path.join(get_output_dir(client_file=False), SKU_MAPPING_WB_NAME)
-        self.inventory_file = os.path.join(get_output_dir(client_file=True), EXPORT_FILE)
-        self.invalid_orders_fpath = os.path.join(get_output_dir(client_file=True), invalid_orders_fname)
-
-    def export_orders(self, testing=False):
-        '''Summing up tasks inside ParseOrders class'''
-        if testing:
-            self.__delete_debug_jsons()
-            dump_to_json(self.orders, 'DEBUG_new_unparsed.json')
-
-        valid_orders, invalid_orders = self._parse_based_on_sales_channel()
-        logging.info(f'Orders inside valid: {len(valid_orders)}; invalid: {len(invalid_orders)}')
-        self._exit_no_new_valid_orders(valid_orders, invalid_orders)
-        export_obj = self.get_export_obj(valid_orders)
+        systemic_dir = self.systemic_dir = output_dir if output_dir else get_output_dir(client_file=False)
+        client_dir = output_dir if output_dir else get_output_dir(client_file=True)
+        self.unmapped_skus_fpath = os.path.join(systemic_dir, UNMAPPED_SKUS_NAME.format(self.sales_channel))
+        self.invalid_orders_fpath = os.path.join(client_dir, invalid_orders_fname)
+        self.compositions_fpath = os.path.join(client_dir, LISTING_COMPOSITIONS_NAME.format(self.sales_channel))
+
+    def export_orders(self, testing=False) -> PlanResult:
+        '''Summing up tasks inside ParseOrders class. Returns PlanResult (no valid and invalid orders - no new job).
+        Stage timings are recorded in self.timings, non fatal VBA alerts in self.alerts. Raises InventoryError subclasses'''
+        self.capture.capture('new_unparsed', self.orders)
+
+        plan_result = self.parse()
+        self._export_unmapped_skus(plan_result.unmapped_skus)
+        add_pending_compositions(self.compositions_fpath, plan_result.unresolved_compositions, self.listed_compositions)
+        valid_orders, invalid_orders = plan_result.valid_orders, plan_result.invalid_orders
+        if not valid_orders and not invalid_orders:
+            logging.info(f'No new orders found. Nothing to export.')
+            return plan_result
+        self._export_invalid_orders_start_file(invalid_orders)
+        # SKUQuantities (interned sku ids), converted to sku strings only when written out
+        export_obj = plan_result.sku_totals
         
         if testing:
             # CHANGE BEHAVIOR WHEN TESTING HERE
             logging.info(f'Testing mode: {testing}. Change behaviour in export_orders method in ParseOrders class')
-            print(f'Testing mode: {testing}. Change behaviour in export_orders method in ParseOrders class')
-            dump_to_json(valid_orders, 'DEBUG_valid_parsed.json')
-            dump_to_json(invalid_orders, 'DEBUG_invalid_orders.json')
+        self.capture.capture('valid_parsed', valid_orders)
+        self.capture.capture('invalid_orders', invalid_orders)
+
+        if self.sinks is None:
+            self.sinks = get_output_sinks(self.open_files)
+        with timed_stage(self.timings, 'helper file'), self.progress.stage('helper file', len(export_obj)):
             self.export_update_inventory_helper_file(export_obj)
-            self.push_orders_to_db()
+        with timed_stage(self.timings, 'database'), self.progress.stage('database', len(self.orders)):
+            self.push_orders_to_db(export_obj)
+        return plan_result
+
+    def parse(self) -> PlanResult:
+        '''cleans, parses and aggregates orders without exporting anything (used directly by preview)'''
+        with timed_stage(self.timings, 'plan'), self.progress.stage('plan', len(self.orders)):
+            plan_result = self._parse_based_on_sales_channel()
+        logging.info(f'Orders inside valid: {len(plan_result.valid_orders)}; invalid: {len(plan_result.invalid_orders)}')
+        return plan_result
+
+    def _parse_based_on_sales_channel(self) -> PlanResult:
+        '''cleans, parses and aggregates orders in single pass with plan compiled for sales channel.
+        Orders parsed in chunks only have filtered (already in database) orders subtracted from chunk sums'''
+        if self.chunked_parse:
+            plan_result = self.chunked_parse.get_plan_result(self.orders)
+            self.alerts.extend(self.chunked_parse.mapping_alerts + plan_result.alerts)
+            return plan_result
+        sku_mapping, mapping_alerts = get_channel_sku_mapping(self.sales_channel, self.sku_mapping_fpath)
+        self.alerts.extend(mapping_alerts)
+        compositions = self._get_listing_compositions() if get_channel(self.sales_channel).skus_counted_in_quantity else None
+        plan = ChannelPlan(self.sales_channel, self.proxy_keys, sku_mapping, compositions)
+        try:
+            return plan.run(self.orders, self.progress)
+        finally:
+            self.alerts.extend(plan.alerts)
+
+    def _get_listing_compositions(self) -> dict:
+        '''returns {composition key: [multipliers]} learned listing compositions: database ones updated by rows resolved
+        manually in listing compositions file. New / changed rows are saved to database (kept after file is cleared)'''
+        resolved, self.listed_compositions = read_compositions_file(self.compositions_fpath)
+        compositions = self.db_client.get_listing_compositions(self.sales_channel)
+        changed = {key: multipliers for key, multipliers in resolved.items() if compositions.get(key) != multipliers}
+        if changed and not self.db_client.read_only:
+            self.db_client.add_listing_compositions(self.sales_channel, changed)
+            logging.info(f'{len(changed)} manually resolved {self.sales_channel} listing compositions learned')
+        compositions.update(resolved)
+        return compositions
+
+    def _export_unmapped_skus(self, unmapped_skus:dict):
+        '''replaces unmapped skus report of sales channel (skus with candidate custom labels). Report of previous run
+        is deleted if all skus were mapped. Channels without sku mapping are skipped'''
+        if not get_channel(self.sales_channel).uses_sku_mapping:
             return
-
-        self.export_update_inventory_helper_file(export_obj)
-        self.push_orders_to_db()
-
-    def __delete_debug_jsons(self):
-        '''deletes three json files from previous program run in testing mode'''
-        output_dir = get_output_dir(client_file=False)
-        files_to_delete = ['DEBUG_new_unparsed.json', 'DEBUG_valid_parsed.json', 'DEBUG_invalid_orders.json']
-        for json_f in files_to_delete:
-            json_path = os.path.join(output_dir, json_f)
-            delete_file(json_path)
-        logging.debug(f'Old json files deleted. Ready for debugging')
-
-    def _parse_based_on_sales_channel(self):
-        '''parses orders based on sales channel'''
-        valid_orders, invalid_orders = [], []
-        if self.sales_channel == 'Etsy':
-            return self._parse_etsy_orders(valid_orders, invalid_orders)
-        else:
-            # AmazonCOM / AmazonEU / Amazon Warehouse
-            return self._parse_amazon_orders(valid_orders, invalid_orders)
-
-    def _parse_etsy_orders(self, valid_orders:list, invalid_orders:list):
-        '''returns valid_orders and invalid_orders lists based on ability to correctly calculate etsy sku quantities'''
-        for order in self.orders:
-            qty_purchased = get_order_quantity(order, self.proxy_keys)
-            skus = order[self.proxy_keys['sku']]
-            if len(skus) > 1 and qty_purchased > 1 and qty_purchased != len(skus):
-                logging.info(f'Etsy order q-ty and skus may yield various combinations. Qty: {qty_purchased}, skus: {skus}. Ordr being added to invalid list')
-                invalid_orders.append(order)
-            else:
-                if len(skus) == qty_purchased:
-                    # order having 7 skus in order will have qty_purchased 7. In reality 7 items were purchased w/ individual quantity = 1 
-                    qty_purchased = 1
-
-                parsed_order = self._parse_etsy_order_qty_skus(order, qty_purchased, skus)
-                valid_orders.append(parsed_order)
-        return valid_orders, invalid_orders
-
-    def _parse_etsy_order_qty_skus(self, order:dict, qty_purchased:int, skus:list):
-        '''returns order with added key: 'sku_quantities', value: dict for each sku and matching real parsed quantity'''
-        sku_qties = {}
-        for sku in skus:
-            inner_qty, inner_sku = get_inner_qty_sku(sku, self.quantity_pattern)
-            real_sku_qty = inner_qty * qty_purchased
-            sku_qties[inner_sku] = real_sku_qty
-        order['sku_quantities'] = sku_qties
-        return order
-    
-    def _parse_amazon_orders(self, valid_orders:list, invalid_orders:list):
-        '''returns valid_orders and invalid_orders lists for Amazon orders. In unlikely error when parsing, adds order to invalid_orders list'''
-        sku_mapping = SKUMapping(self.sku_mapping_fpath).read_sku_mapping_to_dict()
-        for order in self.orders:
-            qty_purchased = get_order_quantity(order, self.proxy_keys)
-            skus = order[self.proxy_keys['sku']]
-            try:
-                parsed_order = self._parse_amazon_order_qty_skus(order, qty_purchased, skus, sku_mapping)
-                valid_orders.append(parsed_order)
-            except Exception as e:
-                logging.critical(f'Unexpected error while parsing amazon order: {order} Err: {e}. Adding to invalid orders list')
-                invalid_orders.append(order)
-        return valid_orders, invalid_orders
-
-    def _parse_amazon_order_qty_skus(self, order:dict, qty_purchased:int, skus:list, sku_mapping:dict):
-        '''returns order with added key: 'sku_quantities', value: dict for each sku and matching real parsed quantity.
-        Attempts to use mapped sku if found in sku_mapping'''
-        sku_qties = {}
-        for sku in skus:
-            # attempt to find matching Shop4Top sku for every amazon original sku before parsing
-            if sku in sku_mapping:
-                logging.debug(f'Mapping match found for code: {sku}, match: {sku_mapping[sku]}')
-                sku = sku_mapping[sku]
-            
-            inner_qty, inner_sku = get_inner_qty_sku(sku, self.quantity_pattern)
-            real_sku_qty = inner_qty * qty_purchased
-            sku_qties[inner_sku] = real_sku_qty
-        order['sku_quantities'] = sku_qties
-        return order
-
-    def _exit_no_new_valid_orders(self, valid_orders:list, invalid_orders:list):
-        '''Suspend program, warn VBA if no new orders were found'''
-        if not valid_orders and not invalid_orders:
-            logging.info(f'No new orders found. Terminating, closing database connection, alerting VBA.')
-            self.db_client.session.close()
-            print(VBA_NO_NEW_JOB)
-            sys.exit()
-        elif not valid_orders:
-            # invalid orders present
-            self._export_invalid_orders_start_file(invalid_orders)
-            print(VBA_NO_NEW_JOB)
-        else:
-            # 1+ valid orders present and 0 or more invalid
-            self._export_invalid_orders_start_file(invalid_orders)
+        if os.path.exists(self.unmapped_skus_fpath):
+            delete_file(self.unmapped_skus_fpath)
+        if unmapped_skus:
+            logging.warning(f'{len(unmapped_skus)} skus not found in sku mapping. See report: {self.unmapped_skus_fpath}')
+            export_unmapped_skus(unmapped_skus, self.unmapped_skus_fpath)
 
     def _export_invalid_orders_start_file(self, invalid_orders:list):
         '''exports invalid order IDs to txt file and opens it'''
         if invalid_orders:
             export_invalid_order_ids(invalid_orders, self.proxy_keys, self.invalid_orders_fpath)
-            os.startfile(self.invalid_orders_fpath)
-            logging.info(f'Invalid orders exported at {self.invalid_orders_fpath} and opened.')
-
-    def get_export_obj(self, orders:list) -> dict:
-        '''returns export object: export_obj = {'sku1': qty1, 'sku2': qty2, ...}'''
-        export_obj = {}
-        for order in orders:
-            try:
-                sku_qties = order['sku_quantities']
-                for sku in sku_qties:
-                    # Add new sku or add its quantity to existing sku
-                    if sku not in export_obj:
-                        export_obj[sku] = sku_qties[sku]
-                    else:
-                        export_obj[sku] += sku_qties[sku]
-            except Exception as e:
-                logging.exception(f'Err: {e} creating export_obj. Last order: {order}\nClosing connection to database, alerting VBA, exiting...')
-                self.db_client.session.close()
-                print(VBA_KEYERROR_ALERT)
-                sys.exit()
-        return export_obj
+            self.invalid_orders_exported = self.invalid_orders_fpath
+            if self.open_files:
+                os.startfile(self.invalid_orders_fpath)
+            logging.info(f'Invalid orders exported at {self.invalid_orders_fpath}. Opened: {self.open_files}')
 
     def export_update_inventory_helper_file(self, export_obj:dict):
-        '''Depending on file existence CREATES or UPDATES helper file via different functions'''
-        if export_obj:
-            if os.path.exists(self.inventory_file):
-                logging.debug(f'{self.inventory_file} found. Updating...')
-                self.update_inventory_file(export_obj)
-            else:
-                logging.debug(f'{self.inventory_file} not found. Creating file from scratch...')
-                self.create_inventory_file(export_obj)
-        else:
+        '''delivers export_obj (run sku deltas) to output sinks: helper file, csv / jsonl, inventory service (see output_sinks.py).
+        Single batched write per sink keyed by self.run_key'''
+        if not export_obj:
             logging.info(f'Formed export_obj is empty. Helper File Creation / Update bypassed.')
-    
-    def update_inventory_file(self, export_obj:dict):
-        '''creates HelperFileUpdate instance, and updates data in self.inventory_file xlsx file'''
-        try:
-            HelperFileUpdate(export_obj).update_workbook(self.inventory_file)
-            logging.info(f'Helper file {os.path.basename(self.inventory_file)} successfully updated, opening....')
-            os.startfile(self.inventory_file)
-        except Exception as e:
-            logging.exception(f'Unexpected error UPDATING helper file. Closing database connection, alerting VBA, exiting... Last error: {e}')
-            self.db_client.session.close()
-            print(VBA_ERROR_ALERT)
-            sys.exit()
-
-    def create_inventory_file(self, export_obj:dict):
-        '''creates HelperFileCreate instance, and exports data in xlsx format'''
-        try:
-            HelperFileCreate(export_obj).export(self.inventory_file)
-            logging.info(f'Helper file {os.path.basename(self.inventory_file)} successfully created, opening...')
-            os.startfile(self.inventory_file)
-        except Exception as e:
-            logging.exception(f'Unexpected error CREATING helper file. Closing database connection, alerting VBA, exiting... Last error: {e}')
-            self.db_client.session.close()
-            print(VBA_ERROR_ALERT)
-            sys.exit()
-        
-    def push_orders_to_db(self):
-        '''adds all orders in this class to orders table in db'''
-        count_added_to_db = self.db_client.add_orders_to_db()
-        logging.info(f'Total of {count_added_to_db} new orders have been added to database, after exports were completed, closing connection to DB')
+            return
+        order_id_key = self.proxy_keys['order-id']
+        self.run_key = get_run_key(self.sales_channel, [order[order_id_key] for order in self.orders], self.systemic_dir)
+        for sink in self.sinks:
+            with timed_stage(self.timings, f'sink {sink.name}'):
+                sink.write(export_obj, self.run_key, self.sales_channel)
+        logging.info(f'Run {self.run_key} sku deltas ({len(export_obj)} skus) delivered to sinks: {self.sinks}')
+
+    def push_orders_to_db(self, export_obj:dict):
+        '''adds all orders in this class to orders table in db, saves export_obj as run sku deltas'''
+        self.added_to_db = self.db_client.add_orders_to_db(export_obj)
+        if self.run_key:
+            # run committed: same export loaded again (e.g. after undo-run) is delivered under new key
+            release_run_key(self.run_key, self.systemic_dir)
+        logging.info(f'Total of {self.added_to_db} new orders have been added to database, after exports were completed, closing connection to DB')
         self.db_client.session.close()
 
 
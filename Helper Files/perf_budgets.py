@@ -0,0 +1,257 @@
+import tracemalloc
+import argparse
+import logging
+import tempfile
+import platform
+import shutil
+import json
+import sys
+import os
+from datetime import datetime
+from benchmarks import best_time, get_sample_mapping
+from database import SQLAlchemyOrdersDB, ProgramRun, Order, get_partition_month
+from order_plan import ChannelPlan
+from output_sinks import XlsxSink
+from sku_mapping import SKUMappingIndex
+from sample_data import generate_orders, get_sample_skus, write_export
+from utils import get_file_encoding_delimiter, get_raw_orders
+from constants import SALES_CHANNEL_PROXY_KEYS
+
+
+# GLOBAL VARIABLES
+# per stage {'seconds', 'peak_mb'} baselines, kept in repo next to this module. Rewritten by --update-baselines
+BASELINES_FPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baselines.json')
+# allowed growth over baseline: relative, plus absolute slack (tiny stages are dominated by timer / allocator noise)
+TIME_TOLERANCE = 0.5
+TIME_SLACK = 0.02
+MEMORY_TOLERANCE = 0.25
+MEMORY_SLACK_MB = 1.0
+BUDGET_REPEATS = 3
+
+EXPORT_ORDERS = 20000
+DB_ORDERS = 100000
+# export orders already in database (rest are new)
+DUPLICATE_SHARE = 0.5
+MAPPING_ORDERS = 50000
+MAPPED_SKUS = 3000
+HELPER_FILE_SKUS = 20000
+HELPER_FILE_UPDATE_SKUS = 2000
+
+
+class BudgetInputs():
+    '''Generated inputs shared by budget stages, created on first use in tmp_dir:
+
+    - get_export_fpath() - tab separated Amazon export of EXPORT_ORDERS orders (DUPLICATE_SHARE of them in database)
+    - get_db_client() - SQLAlchemyOrdersDB over database of DB_ORDERS Amazon orders, loaded with export orders
+    - get_helper_file() - helper file of HELPER_FILE_SKUS skus'''
+
+    def __init__(self, tmp_dir:str):
+        self.tmp_dir = tmp_dir
+        self.sku_pool = get_sample_skus(HELPER_FILE_SKUS)
+        self.__export_fpath = None
+        self.__db_client = None
+        self.__helper_file = None
+
+    def get_export_orders(self) -> list:
+        id_offset = DB_ORDERS - int(EXPORT_ORDERS * DUPLICATE_SHARE)
+        return generate_orders('Amazon', EXPORT_ORDERS, self.sku_pool, seed=1, id_offset=id_offset)
+
+    def get_export_fpath(self) -> str:
+        if not self.__export_fpath:
+            self.__export_fpath = os.path.join(self.tmp_dir, 'amazon export.txt')
+            write_export(self.__export_fpath, self.get_export_orders(), 'Amazon')
+        return self.__export_fpath
+
+    def get_db_client(self) -> SQLAlchemyOrdersDB:
+        '''orders are bulk inserted to partition of single run (not timed), order id index is rebuilt before stages'''
+        if not self.__db_client:
+            proxy_keys = SALES_CHANNEL_PROXY_KEYS['Amazon']
+            db_dir = os.path.join(self.tmp_dir, 'db')
+            os.makedirs(db_dir)
+            db_client = SQLAlchemyOrdersDB(self.get_export_orders(), self.get_export_fpath(), 'Amazon', proxy_keys,
+                                        testing=True, output_dir=db_dir)
+            run = ProgramRun(fpath=self.get_export_fpath(), sales_channel='Amazon', timestamp=datetime.now())
+            db_client.session.add(run)
+            db_client.session.commit()
+            orders_session = db_client.partitions.get_session(get_partition_month(run.timestamp), create=True)
+            orders_session.execute(Order.__table__.insert(), [{'order_id': order[proxy_keys['order-id']],
+                                    'order_id_secondary': order[proxy_keys['same-buyer-order-id']],
+                                    'purchase_date': order[proxy_keys['purchase-date']], 'buyer_name': order[proxy_keys['buyer-name']],
+                                    'run': run.id} for order in generate_orders('Amazon', DB_ORDERS, self.sku_pool)])
+            orders_session.commit()
+            db_client.check_order_index()
+            self.__db_client = db_client
+        return self.__db_client
+
+    def get_helper_file(self) -> str:
+        if not self.__helper_file:
+            self.__helper_file = os.path.join(self.tmp_dir, 'helper base.xlsx')
+            XlsxSink(self.__helper_file, open_files=False).create_inventory_file(self.get_sku_quantities(HELPER_FILE_SKUS))
+        return self.__helper_file
+
+    def get_sku_quantities(self, skus_count:int) -> dict:
+        return {sku: i % 50 + 1 for i, sku in enumerate(self.sku_pool[:skus_count])}
+
+    def close(self):
+        if self.__db_client:
+            self.__db_client.close()
+            self.__db_client.engine.dispose()
+
+
+def dedup_orders(db_client:SQLAlchemyOrdersDB) -> list:
+    '''order id index lookup + database query of possible duplicates (SQLAlchemyOrdersDB.get_new_orders_only)'''
+    new_orders = db_client.get_new_orders_only()
+    assert len(new_orders) == EXPORT_ORDERS - int(EXPORT_ORDERS * DUPLICATE_SHARE), f'dedup returned {len(new_orders)} new orders'
+    return new_orders
+
+def parse_mapped_orders(orders:list, sku_mapping:dict) -> dict:
+    '''mapping index compilation and ChannelPlan parse of Amazon orders (parse_orders single process path)'''
+    return ChannelPlan('Amazon', SALES_CHANNEL_PROXY_KEYS['Amazon'], SKUMappingIndex(sku_mapping)).run(orders).export_obj
+
+def create_helper_file(inventory_file:str, export_obj:dict):
+    if os.path.exists(inventory_file):
+        os.remove(inventory_file)
+    XlsxSink(inventory_file, open_files=False).create_inventory_file(export_obj)
+
+def update_helper_file(inventory_file:str, export_obj:dict, backup_dir:str):
+    XlsxSink(inventory_file, open_files=False, backup_dir=backup_dir).update_inventory_file(export_obj)
+
+def backup_db(db_client:SQLAlchemyOrdersDB, backup_db_path:str):
+    '''SQLAlchemyOrdersDB._backup_db into empty backup location (all partitions copied)'''
+    db_client.testing = False
+    try:
+        db_client._backup_db(backup_db_path)
+    finally:
+        db_client.testing = True
+
+def copy_helper_file(inputs:BudgetInputs) -> str:
+    inventory_file = os.path.join(inputs.tmp_dir, 'helper update.xlsx')
+    shutil.copy(inputs.get_helper_file(), inventory_file)
+    return inventory_file
+
+def get_empty_backup_path(inputs:BudgetInputs) -> str:
+    backup_dir = os.path.join(inputs.tmp_dir, 'db backup')
+    shutil.rmtree(backup_dir, ignore_errors=True)
+    os.makedirs(backup_dir)
+    return os.path.join(backup_dir, 'inventory_lrun.db')
+
+
+# {stage: (function, make_args(inputs) -> args tuple)}. make_args is neither timed nor memory traced
+BUDGET_STAGES = {
+    'encoding detection': (get_file_encoding_delimiter, lambda inputs: (inputs.get_export_fpath(),)),
+    'ingest': (get_raw_orders, lambda inputs: (inputs.get_export_fpath(), 'utf-8', '\t')),
+    'dedup 100k orders db': (dedup_orders, lambda inputs: (inputs.get_db_client(),)),
+    'amazon mapping parse': (parse_mapped_orders, lambda inputs: (generate_orders('Amazon', MAPPING_ORDERS, inputs.sku_pool[:5000]),
+                            get_sample_mapping(inputs.sku_pool, MAPPED_SKUS))),
+    'helper file create 20k skus': (create_helper_file, lambda inputs: (os.path.join(inputs.tmp_dir, 'helper create.xlsx'),
+                                    inputs.get_sku_quantities(HELPER_FILE_SKUS))),
+    'helper file update 20k skus': (update_helper_file, lambda inputs: (copy_helper_file(inputs),
+                                    inputs.get_sku_quantities(HELPER_FILE_UPDATE_SKUS), inputs.tmp_dir)),
+    'db backup': (backup_db, lambda inputs: (inputs.get_db_client(), get_empty_backup_path(inputs))),
+    }
+
+
+def measure_stage(stage:str, inputs:BudgetInputs, repeats:int=BUDGET_REPEATS) -> dict:
+    '''returns {'seconds': best wall time, 'peak_mb': peak of python allocations (tracemalloc, separate untimed pass)}'''
+    func, make_args = BUDGET_STAGES[stage]
+    seconds, _ = best_time(func, lambda: make_args(inputs), repeats)
+    args = make_args(inputs)
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': round(seconds, 4), 'peak_mb': round(peak / 2**20, 2)}
+
+def measure_stages(stages:list, repeats:int=BUDGET_REPEATS) -> dict:
+    '''returns {stage: measurement} of stages on inputs generated in temporary directory'''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        inputs = BudgetInputs(tmp_dir)
+        try:
+            return {stage: measure_stage(stage, inputs, repeats) for stage in stages}
+        finally:
+            inputs.close()
+
+def read_baselines(fpath:str=BASELINES_FPATH) -> dict:
+    '''returns {stage: {'seconds', 'peak_mb'}} stored baselines, empty dict if file is missing'''
+    if not os.path.exists(fpath):
+        return {}
+    with open(fpath, 'r', encoding='utf-8') as f:
+        return json.load(f)['stages']
+
+def write_baselines(results:dict, fpath:str=BASELINES_FPATH):
+    '''updates stored baselines of measured stages (other stages are kept)'''
+    stages = read_baselines(fpath)
+    stages.update(results)
+    baselines = {'machine': f'{platform.system()} {platform.machine()}, python {platform.python_version()}, cpus: {os.cpu_count()}',
+                'updated': datetime.now().strftime('%Y-%m-%d'), 'stages': stages}
+    with open(fpath, 'w', encoding='utf-8') as f:
+        json.dump(baselines, f, indent=2)
+        f.write('\n')
+
+def get_budget(baseline:dict) -> dict:
+    '''returns {'seconds', 'peak_mb'} limits of stage baseline'''
+    return {'seconds': baseline['seconds'] * (1 + TIME_TOLERANCE) + TIME_SLACK,
+            'peak_mb': baseline['peak_mb'] * (1 + MEMORY_TOLERANCE) + MEMORY_SLACK_MB}
+
+def compare_to_baselines(results:dict, baselines:dict) -> list:
+    '''returns list of over budget messages (empty: all stages within budget). Stages without baseline are not checked'''
+    failures = []
+    for stage, result in results.items():
+        if stage not in baselines:
+            continue
+        budget = get_budget(baselines[stage])
+        for metric in ('seconds', 'peak_mb'):
+            if result[metric] > budget[metric]:
+                failures.append(f'{stage}: {metric} {result[metric]} over budget {budget[metric]:.4g} (baseline {baselines[stage][metric]})')
+    return failures
+
+def print_comparison(results:dict, baselines:dict):
+    '''prints per stage measurement, baseline and change'''
+    print(f'{"stage":<30} {"ms":>10} {"baseline":>10} {"change":>8} {"peak MB":>10} {"baseline":>10} {"change":>8}')
+    for stage, result in results.items():
+        baseline = baselines.get(stage)
+        if not baseline:
+            print(f'{stage:<30} {result["seconds"] * 1000:>10.1f} {"-":>10} {"":>8} {result["peak_mb"]:>10.2f} {"-":>10}')
+            continue
+        time_change = result['seconds'] / baseline['seconds'] - 1 if baseline['seconds'] else 0
+        memory_change = result['peak_mb'] / baseline['peak_mb'] - 1 if baseline['peak_mb'] else 0
+        print(f'{stage:<30} {result["seconds"] * 1000:>10.1f} {baseline["seconds"] * 1000:>10.1f} {time_change:>+8.0%} '
+            f'{result["peak_mb"]:>10.2f} {baseline["peak_mb"]:>10.2f} {memory_change:>+8.0%}')
+
+def check_budgets(stages:list=None, repeats:int=BUDGET_REPEATS, update_baselines:bool=False) -> list:
+    '''measures stages (default: all BUDGET_STAGES), prints comparison with stored baselines. Returns list of over budget
+    messages (empty: all stages within budget or baselines were updated)'''
+    results = measure_stages(stages if stages else list(BUDGET_STAGES), repeats)
+    baselines = read_baselines()
+    print_comparison(results, baselines)
+    if update_baselines:
+        write_baselines(results)
+        print(f'Baselines updated: {BASELINES_FPATH}')
+        return []
+    failures = compare_to_baselines(results, baselines)
+    if failures:
+        print('\nPERFORMANCE BUDGET EXCEEDED:')
+        for failure in failures:
+            print(f'  {failure}')
+    else:
+        print('\nAll stages within budget')
+    return failures
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per stage time and peak memory budgets checked against stored baselines')
+    parser.add_argument('stages', nargs='*', help=f'stages to check (default: all): {list(BUDGET_STAGES)}')
+    parser.add_argument('--update-baselines', action='store_true', help=f'store measurements as new baselines in {BASELINES_FPATH}')
+    parser.add_argument('--repeats', type=int, default=BUDGET_REPEATS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    args = parse_args()
+    unknown_stages = [stage for stage in args.stages if stage not in BUDGET_STAGES]
+    if unknown_stages:
+        sys.exit(f'Unknown stages: {unknown_stages}. Available: {list(BUDGET_STAGES)}')
+    if check_budgets(args.stages, args.repeats, args.update_baselines):
+        sys.exit(1)
@@ -0,0 +1,209 @@
+import logging
+import os
+from datetime import datetime
+from database import SQLAlchemyOrdersDB
+from parse_orders import ParseOrders, get_channel_sku_mapping
+from parallel_parse import ChunkBoundaryError, can_parse_in_chunks, parse_in_chunks, get_parse_workers
+from channels import get_channel, validate_source_headers
+from exceptions import InventoryError
+from utils import get_file_encoding_delimiter, get_raw_orders, timed_stage
+from utils import sort_by_quantity
+from debug_capture import DebugCapture, get_debug_capture
+from progress import ProgressReporter
+from constants import VBA_NO_NEW_JOB, VBA_OK
+
+
+class PipelineOptions():
+    '''run_pipeline options:
+
+    - testing:bool - debug capture of orders (unless INVENTORY_CAPTURE says otherwise, see debug_capture.py),
+    source file path saved to db instead of backup, db backups suspended
+    - open_files:bool - open helper file / invalid orders file after export (False for unattended runs)
+    - preview:bool - read-only database dedup, parsing and aggregation only: no backups, database writes,
+    helper file / invalid orders file exports (see RunResult.to_dict)
+    - parse_workers:int - worker processes parsing large exports (see parallel_parse). None: cpu count, 1: single process
+    - sinks:list - OutputSink instances receiving run sku deltas. None: configured in output_sinks.json (helper file by default)
+    - output_dir:str - directory for database, backups, order indexes, debug capture and report files (scratch runs, see replay.py).
+    None: program dirs. Sku mapping is always read from program dir
+    - clock:callable - returns current datetime for run timestamp, source backup name and flush cutoff (replayed runs keep original time)
+    - progress:ProgressReporter - stage progress lines for VBA caller (see progress.py). None: off (always off in preview)'''
+
+    def __init__(self, testing:bool=False, open_files:bool=True, preview:bool=False, parse_workers:int=None, sinks:list=None,
+                output_dir:str=None, clock=datetime.now, progress:ProgressReporter=None):
+        self.testing = testing and not preview
+        self.open_files = open_files and not preview
+        self.preview = preview
+        self.parse_workers = parse_workers
+        self.sinks = sinks
+        self.output_dir = output_dir
+        self.clock = clock
+        self.progress = progress if progress and not preview else ProgressReporter()
+
+
+class RunResult():
+    '''Structured outcome of run_pipeline:
+
+    - source_fpath:str, sales_channel:str
+    - loaded_orders:int - orders in source file
+    - new_orders:int - orders not yet in database
+    - valid_orders:list, invalid_orders:list - parsed new orders (invalid: quantities could not be determined)
+    - added_to_db:int - orders committed to database
+    - carts:dict - {same buyer order id: [orders]} new orders grouped by buyer cart (see PlanResult.carts)
+    - unmapped_skus:dict - {sku: [candidate custom labels]} skus not found in sku mapping (see sku_mapping.SKUMappingIndex)
+    - split_carts:dict - {same buyer order id: [earlier run ids]} buyer carts of new orders partially added by earlier runs
+    - export_obj:SKUQuantities - sku quantities added to helper file (None if run ended before parsing)
+    - run_key:str - idempotency key sku deltas were delivered to output sinks with (None if nothing was delivered)
+    - invalid_orders_fpath:str - exported invalid order ids file or None
+    - alerts:list - non fatal VBA alerts (duplicate mapping skus, unreadable quantities)
+    - timings:dict - {stage: seconds}
+    - error:InventoryError - error, that ended run or None
+
+    vba_messages - protocol strings printed by main_inventory (same as before pipeline API existed)'''
+
+    def __init__(self, source_fpath:str, sales_channel:str):
+        self.source_fpath = source_fpath
+        self.sales_channel = sales_channel
+        self.loaded_orders = 0
+        self.new_orders = 0
+        self.valid_orders = []
+        self.invalid_orders = []
+        self.added_to_db = 0
+        self.carts = {}
+        self.split_carts = {}
+        self.unmapped_skus = {}
+        self.export_obj = None
+        self.run_key = None
+        self.invalid_orders_fpath = None
+        self.alerts = []
+        self.timings = {}
+        self.error = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def no_new_job(self) -> bool:
+        '''no new valid orders to add to helper file'''
+        return self.ok and not self.valid_orders
+
+    @property
+    def vba_messages(self) -> list:
+        '''alerts, then error messages / VBA_NO_NEW_JOB / VBA_OK'''
+        messages = list(self.alerts)
+        if self.error:
+            return messages + list(self.error.vba_messages)
+        if not self.valid_orders:
+            messages.append(VBA_NO_NEW_JOB)
+            if not self.invalid_orders:
+                return messages
+        messages.append(VBA_OK)
+        return messages
+
+    def to_dict(self) -> dict:
+        '''returns json serializable summary: counts, export_obj sorted by quantity, invalid order ids, alerts, error, timings'''
+        order_id_key = get_channel(self.sales_channel).proxy_keys['order-id']
+        return {'source_fpath': self.source_fpath,
+                'sales_channel': self.sales_channel,
+                'loaded_orders': self.loaded_orders,
+                'new_orders': self.new_orders,
+                'valid_orders': len(self.valid_orders),
+                'invalid_orders': [order[order_id_key] for order in self.invalid_orders],
+                'added_to_db': self.added_to_db,
+                'split_carts': self.split_carts,
+                'unmapped_skus': self.unmapped_skus,
+                'export_obj': dict(sort_by_quantity(self.export_obj)) if self.export_obj else {},
+                'run_key': self.run_key,
+                'alerts': self.alerts,
+                'error': str(self.error) if self.error else None,
+                'timings': {stage: round(seconds, 4) for stage, seconds in self.timings.items()}}
+
+    def __repr__(self) -> str:
+        return (f'<RunResult {self.sales_channel} {os.path.basename(str(self.source_fpath))}: loaded: {self.loaded_orders}, new: {self.new_orders}, '
+                f'valid: {len(self.valid_orders)}, invalid: {len(self.invalid_orders)}, added to db: {self.added_to_db}, error: {self.error!r}>')
+
+
+def read_source_orders(source_fpath:str, sales_channel:str, options:PipelineOptions, capture:DebugCapture=None) -> tuple:
+    '''returns (orders, ChunkedParse or None). Large tab separated exports are cleaned and parsed in worker processes
+    (see parallel_parse), otherwise raw orders are returned: cleaning is done later, in ChannelPlan, only for new orders.
+    Raw orders are streamed to capture'''
+    encoding, delimiter = get_file_encoding_delimiter(source_fpath)
+    logging.info(f'{os.path.basename(source_fpath)} detected encoding: {encoding}, delimiter <{delimiter}>')
+    # file of wrong channel / missing columns fails on header row, before orders are read
+    validate_source_headers(source_fpath, encoding, delimiter, sales_channel)
+    if get_parse_workers(options.parse_workers) > 1 and can_parse_in_chunks(source_fpath, encoding, delimiter):
+        sku_mapping, mapping_alerts = get_channel_sku_mapping(sales_channel)
+        try:
+            chunked_parse = parse_in_chunks(source_fpath, encoding, delimiter, sales_channel, sku_mapping,
+                                            options.parse_workers, mapping_alerts)
+            return chunked_parse.orders, chunked_parse
+        except ChunkBoundaryError as e:
+            logging.warning(f'{e}. Falling back to single process parsing')
+    raw_orders = get_raw_orders(source_fpath, encoding, delimiter)
+    if capture:
+        capture.capture('raw_orders', raw_orders)
+    return raw_orders, None
+
+def run_pipeline(source_fpath:str, sales_channel:str, options:PipelineOptions=None) -> RunResult:
+    '''reads source file, filters new orders, parses them, updates helper file and database.
+    Never prints or exits: errors are returned in RunResult.error (unexpected exceptions wrapped in InventoryError)'''
+    options = options if options else PipelineOptions()
+    result = RunResult(source_fpath, sales_channel)
+    proxy_keys = get_channel(sales_channel).proxy_keys
+    # preview writes nothing, debug capture included
+    capture = DebugCapture() if options.preview else get_debug_capture(options.testing, options.output_dir)
+    capture.reset()
+    progress = options.progress
+    db_client = None
+    try:
+        with timed_stage(result.timings, 'read'), progress.stage('read'):
+            source_orders, chunked_parse = read_source_orders(source_fpath, sales_channel, options, capture)
+            progress.update(len(source_orders))
+        result.loaded_orders = len(source_orders)
+
+        with timed_stage(result.timings, 'new orders'), progress.stage('new orders', len(source_orders)):
+            db_client = SQLAlchemyOrdersDB(source_orders, source_fpath, sales_channel, proxy_keys, testing=options.testing,
+                                        output_dir=options.output_dir, clock=options.clock, read_only=options.preview,
+                                        progress=progress)
+            new_orders = db_client.get_new_orders_only()
+            # checked before new orders are added: carts split across this and earlier runs
+            result.split_carts = db_client.get_split_carts(new_orders)
+        result.new_orders = len(new_orders)
+        logging.info(f'Loaded file contains: {len(source_orders)}. Further processing: {len(new_orders)} orders')
+
+        # Parse orders, export target files
+        parse_orders = ParseOrders(new_orders, db_client, sales_channel, proxy_keys, open_files=options.open_files,
+                                    chunked_parse=chunked_parse, sinks=options.sinks, capture=capture,
+                                    output_dir=options.output_dir, progress=progress)
+        try:
+            # preview: no invalid orders file, helper file or database writes
+            plan_result = parse_orders.parse() if options.preview else parse_orders.export_orders(options.testing)
+            result.valid_orders, result.invalid_orders = plan_result.valid_orders, plan_result.invalid_orders
+            result.carts = plan_result.carts
+            result.unmapped_skus = plan_result.unmapped_skus
+            result.export_obj = plan_result.sku_totals
+        finally:
+            result.alerts = parse_orders.alerts
+            result.timings.update(parse_orders.timings)
+            result.added_to_db = parse_orders.added_to_db
+            result.run_key = parse_orders.run_key
+            result.invalid_orders_fpath = parse_orders.invalid_orders_exported
+    except InventoryError as e:
+        result.error = e
+    except Exception as e:
+        logging.exception(f'Unexpected error running pipeline for {source_fpath} ({sales_channel}). Err: {e}')
+        result.error = InventoryError(f'Unexpected error: {e}')
+        result.error.__cause__ = e
+    finally:
+        if db_client:
+            db_client.close()
+    if capture.timings:
+        # capture time is reported apart and subtracted from stages it was spent in
+        result.timings['read'] = result.timings.get('read', 0.0) - capture.timings.get('capture raw_orders', 0.0)
+        result.timings.update(capture.timings)
+    logging.info(f'Pipeline finished: {result}. Timings: { {stage: round(seconds, 3) for stage, seconds in result.timings.items()} }')
+    return result
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,96 @@
+import tracemalloc
+import logging
+import cProfile
+import pstats
+import time
+import sys
+import io
+import os
+from datetime import datetime
+from utils import get_output_dir
+
+
+# GLOBAL VARIABLES
+PROFILE_FLAG = '--profile'
+# VBA passes fixed arguments, profiling of frozen exe is switched on via environment variable instead
+PROFILE_ENV_VAR = 'INVENTORY_PROFILE'
+PROFILE_TOP_N = 30
+TRACEMALLOC_FRAMES = 5
+
+
+def profiling_requested() -> bool:
+    '''returns True if PROFILE_FLAG is in sys.argv (flag is removed from sys.argv) or PROFILE_ENV_VAR is set to non empty, non '0' value'''
+    flag_passed = PROFILE_FLAG in sys.argv
+    if flag_passed:
+        sys.argv.remove(PROFILE_FLAG)
+    return flag_passed or os.environ.get(PROFILE_ENV_VAR, '0') not in ('', '0')
+
+def run_profiled(func, output_dir:str=None, top_n:int=PROFILE_TOP_N):
+    '''runs func under cProfile and tracemalloc. Writes 'profile <timestamp>.pstats' and .txt summary
+    of top_n functions by time and allocation sites next to inventory.log. Reports are written even if func calls sys.exit()'''
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    report_base = os.path.join(output_dir, f'profile {datetime.now().strftime("%Y.%m.%d %H.%M.%S")}')
+    profiler = cProfile.Profile()
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    start_snapshot = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    try:
+        return profiler.runcall(func)
+    finally:
+        elapsed = time.perf_counter() - start
+        end_snapshot = tracemalloc.take_snapshot()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(f'{report_base}.pstats')
+        summary = get_profile_summary(profiler, start_snapshot, end_snapshot, elapsed, peak_memory, top_n)
+        with open(f'{report_base}.txt', 'w', encoding='utf-8') as f:
+            f.write(summary)
+        logging.info(f'Profile of run written to: {report_base}.pstats / .txt. Elapsed: {elapsed:.2f}s, peak traced memory: {peak_memory / 2**20:.1f} MB')
+
+def get_profile_summary(profiler:cProfile.Profile, start_snapshot, end_snapshot, elapsed:float, peak_memory:int, top_n:int) -> str:
+    '''returns text report: run info, top_n functions by cumulative and own time, top_n allocation sites'''
+    out = io.StringIO()
+    out.write(f'Arguments: {sys.argv}\nElapsed: {elapsed:.3f} s\nPeak traced memory: {peak_memory / 2**20:.2f} MB\n')
+    stats = pstats.Stats(profiler, stream=out).strip_dirs()
+    out.write(f'\n=== Top {top_n} functions by cumulative time ===\n')
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+    out.write(f'\n=== Top {top_n} functions by own time ===\n')
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top_n)
+    out.write(f'\n=== Top {top_n} allocation sites still held at the end of run ===\n')
+    for stat in end_snapshot.statistics('lineno')[:top_n]:
+        out.write(f'{stat}\n')
+    out.write(f'\n=== Top {top_n} allocation growth during run ===\n')
+    for stat in end_snapshot.compare_to(start_snapshot, 'lineno')[:top_n]:
+        out.write(f'{stat}\n')
+    return out.getvalue()
+
+def diff_profiles(old_pstats_path:str, new_pstats_path:str, top_n:int=PROFILE_TOP_N) -> str:
+    '''returns text report of top_n functions with largest own / cumulative time change between two .pstats files'''
+    old_stats = pstats.Stats(old_pstats_path).strip_dirs().stats
+    new_stats = pstats.Stats(new_pstats_path).strip_dirs().stats
+    old_total = sum(stat[2] for stat in old_stats.values())
+    new_total = sum(stat[2] for stat in new_stats.values())
+    rows = []
+    for func in set(old_stats) | set(new_stats):
+        # stat tuple: primitive calls, total calls, own time, cumulative time, callers
+        _, old_calls, old_own, old_cum, _ = old_stats.get(func, (0, 0, 0.0, 0.0, None))
+        _, new_calls, new_own, new_cum, _ = new_stats.get(func, (0, 0, 0.0, 0.0, None))
+        rows.append((new_own - old_own, new_cum - old_cum, old_calls, new_calls, func))
+    rows.sort(key=lambda row: abs(row[0]), reverse=True)
+
+    out = io.StringIO()
+    out.write(f'Old: {old_pstats_path}\nNew: {new_pstats_path}\n')
+    out.write(f'Total own time: {old_total:.3f} s -> {new_total:.3f} s ({new_total - old_total:+.3f} s)\n\n')
+    out.write(f'{"own time delta":>15} {"cum time delta":>15} {"calls old":>10} {"calls new":>10}  function\n')
+    for own_delta, cum_delta, old_calls, new_calls, (fname, line, func_name) in rows[:top_n]:
+        out.write(f'{own_delta:>+15.4f} {cum_delta:>+15.4f} {old_calls:>10} {new_calls:>10}  {fname}:{line}({func_name})\n')
+    return out.getvalue()
+
+def print_profile_diff(old_pstats_path:str, new_pstats_path:str):
+    '''prints diff_profiles report'''
+    print(diff_profiles(old_pstats_path, new_pstats_path))
+
+
+if __name__ == "__main__":
+    # python profiling.py <old.pstats> <new.pstats>
+    print_profile_diff(sys.argv[1], sys.argv[2])
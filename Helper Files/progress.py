@@ -0,0 +1,132 @@
+import contextlib
+import time
+import sys
+import os
+from utils import get_output_dir
+
+
+# GLOBAL VARIABLES
+PROGRESS_FLAG = '--progress'
+# VBA passes fixed arguments: '1' / 'stdout' - progress lines on stdout, 'file' - PROGRESS_FNAME sidecar in program dir,
+# other value - sidecar file path. '' / '0' - off
+PROGRESS_ENV_VAR = 'INVENTORY_PROGRESS'
+PROGRESS_FNAME = 'progress.txt'
+# line: PROGRESS<tab>stage<tab>rows done<tab>rows total<tab>percent<tab>eta seconds (total, percent, eta empty if unknown)
+PROGRESS_PREFIX = 'PROGRESS'
+# minimum seconds between lines within stage (stage start and end lines are always written)
+PROGRESS_INTERVAL = 0.5
+# items between clock checks in iterated loops
+PROGRESS_CHECK_EVERY = 200
+
+
+class ProgressReporter():
+    '''Opt-in line protocol reporting pipeline stage progress to VBA caller (stdout) or sidecar file, so long runs
+    can be watched. Final VBA status strings are unaffected: progress lines start with PROGRESS_PREFIX.
+
+    Args:
+    - stream - text stream lines are written (and flushed) to. None: reporting is off, all methods return at once
+    - interval:float - minimum seconds between rate limited lines of stage
+
+    Usage:
+    with progress.stage('database', total=len(orders)):
+        for order in progress.iterate(orders):
+            ...'''
+
+    def __init__(self, stream=None, interval:float=PROGRESS_INTERVAL):
+        self.stream = stream
+        self.interval = interval
+        self.name = None
+        self.total = None
+        self.done = 0
+        self.start = self.last_line = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.stream is not None
+
+    @contextlib.contextmanager
+    def stage(self, name:str, total:int=None):
+        '''writes stage start line, rate limited update lines and end line (all rows done) if with block succeeds'''
+        if not self.enabled:
+            yield
+            return
+        self.name, self.total, self.done = name, total, 0
+        self.start = self.last_line = time.perf_counter()
+        self._write_line()
+        yield
+        if self.total is None:
+            self.total = self.done
+        self.done = self.total
+        self._write_line()
+
+    def update(self, done:int):
+        '''sets rows done in current stage, writes line if PROGRESS_INTERVAL passed since last one'''
+        if not self.enabled:
+            return
+        self.done = done
+        now = time.perf_counter()
+        if now - self.last_line >= self.interval:
+            self.last_line = now
+            self._write_line()
+
+    def iterate(self, items:list):
+        '''returns items (reporting off) or generator of items updating current stage progress every PROGRESS_CHECK_EVERY items'''
+        if not self.enabled:
+            return items
+        return self._iterate(items)
+
+    def _iterate(self, items:list):
+        for done, item in enumerate(items):
+            if not done % PROGRESS_CHECK_EVERY:
+                self.update(done)
+            yield item
+
+    def get_line(self) -> str:
+        '''returns protocol line of current stage state'''
+        total = percent = eta = ''
+        if self.total:
+            total = self.total
+            percent = f'{min(self.done / self.total, 1) * 100:.0f}'
+            if self.done:
+                elapsed = time.perf_counter() - self.start
+                eta = f'{elapsed / self.done * max(self.total - self.done, 0):.0f}'
+        elif self.total == 0:
+            total, percent, eta = 0, '100', '0'
+        return f'{PROGRESS_PREFIX}\t{self.name}\t{self.done}\t{total}\t{percent}\t{eta}'
+
+    def _write_line(self):
+        self.stream.write(self.get_line() + '\n')
+        self.stream.flush()
+
+    def close(self):
+        '''closes sidecar file (stdout is left open)'''
+        if self.stream is not None and self.stream is not sys.stdout:
+            self.stream.close()
+        self.stream = None
+
+    def __repr__(self) -> str:
+        return f'<ProgressReporter stream: {getattr(self.stream, "name", self.stream)}>'
+
+
+def progress_requested() -> str:
+    '''returns progress target: 'stdout' if PROGRESS_FLAG is in sys.argv (flag is removed from sys.argv),
+    otherwise PROGRESS_ENV_VAR value. None if reporting is off'''
+    if PROGRESS_FLAG in sys.argv:
+        sys.argv.remove(PROGRESS_FLAG)
+        return 'stdout'
+    target = os.environ.get(PROGRESS_ENV_VAR, '0').strip()
+    return None if target in ('', '0') else target
+
+def get_progress_reporter(target:str=None) -> ProgressReporter:
+    '''returns ProgressReporter writing to stdout ('1' / 'stdout'), PROGRESS_FNAME sidecar in program dir ('file')
+    or sidecar at target path (file is replaced). None target: reporting off'''
+    if not target:
+        return ProgressReporter()
+    if target in ('1', 'stdout'):
+        return ProgressReporter(sys.stdout)
+    fpath = os.path.join(get_output_dir(client_file=False), PROGRESS_FNAME) if target == 'file' else target
+    return ProgressReporter(open(fpath, 'w', encoding='utf-8'))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,175 @@
+import logging
+import shutil
+import time
+import os
+from datetime import datetime, timedelta
+from database import get_db_session, ENGINES, ProgramRun, RunSKUDelta, SKU, ListingComposition
+from pipeline import run_pipeline, PipelineOptions
+from output_sinks import XlsxSink
+from helper_file import read_helper_file_quantities
+from db_growth import SimulatedClock
+from utils import get_output_dir
+from constants import EXPORT_FILE
+
+
+# GLOBAL VARIABLES
+# scratch directory (inside program dir) receiving replay database, backups and helper file. Recreated by every replay
+REPLAY_DIR = 'replay'
+REPLAY_DATE_FORMAT = '%Y-%m-%d'
+# mismatching skus printed per run / for helper file
+MAX_PRINTED_MISMATCHES = 10
+
+
+def parse_replay_bound(value:str, last:bool=False):
+    '''returns run id (int) of digits value or datetime of YYYY-MM-DD value (last bound: end of that day)'''
+    if value.isdigit():
+        return int(value)
+    day = datetime.strptime(value, REPLAY_DATE_FORMAT)
+    return day + timedelta(days=1) - timedelta(microseconds=1) if last else day
+
+def get_replay_runs(session, first:str, last:str) -> list:
+    '''returns production ProgramRun rows between first and last (inclusive run ids or YYYY-MM-DD dates) in timestamp order'''
+    query = session.query(ProgramRun)
+    for bound, is_last in ((parse_replay_bound(first), False), (parse_replay_bound(last, last=True), True)):
+        column = ProgramRun.id if isinstance(bound, int) else ProgramRun.timestamp
+        query = query.filter(column <= bound if is_last else column >= bound)
+    return query.order_by(ProgramRun.timestamp, ProgramRun.id).all()
+
+def get_quantities_diff(expected:dict, actual:dict) -> dict:
+    '''returns {sku: (expected, actual)} of skus with different quantities (missing sku: 0)'''
+    return {sku: (expected.get(sku, 0), actual.get(sku, 0)) for sku in set(expected) | set(actual)
+            if expected.get(sku, 0) != actual.get(sku, 0)}
+
+
+class ReplayReport():
+    '''Outcome of replay_runs:
+
+    - scratch_dir:str - directory holding replay database, backups and helper file
+    - runs:list - per replayed run dicts: {'run', 'timestamp', 'sales_channel', 'fpath', 'result' (RunResult), 'seconds',
+    'deltas_diff' ({sku: (production, replay)} of run sku deltas)}
+    - skipped:list - production runs without source backup on disk (flushed, moved)
+    - expected_totals:dict - production run sku deltas summed over replayed runs
+    - helper_file_diff:dict - {sku: (production, replay)} of production and replay helper files. Empty diff is expected
+    only when replayed range covers whole helper file history (helper file is never reset otherwise)'''
+
+    def __init__(self, scratch_dir:str):
+        self.scratch_dir = scratch_dir
+        self.runs = []
+        self.skipped = []
+        self.expected_totals = {}
+        self.helper_file_diff = {}
+
+    @property
+    def seconds(self) -> float:
+        return sum(run['seconds'] for run in self.runs)
+
+    @property
+    def loaded_orders(self) -> int:
+        return sum(run['result'].loaded_orders for run in self.runs)
+
+    @property
+    def new_orders(self) -> int:
+        return sum(run['result'].new_orders for run in self.runs)
+
+    @property
+    def mismatched_runs(self) -> list:
+        return [run for run in self.runs if run['deltas_diff'] or run['result'].error]
+
+    def __repr__(self) -> str:
+        return (f'<ReplayReport runs: {len(self.runs)}, skipped: {len(self.skipped)}, orders: {self.loaded_orders}, '
+                f'seconds: {self.seconds:.2f}, mismatched runs: {len(self.mismatched_runs)}, helper file diff: {len(self.helper_file_diff)}>')
+
+
+def reset_scratch_dir(scratch_dir:str):
+    '''disposes cached engines of scratch databases, deletes and recreates scratch_dir'''
+    for db_path, read_only in list(ENGINES):
+        if os.path.abspath(db_path).startswith(os.path.abspath(scratch_dir) + os.sep):
+            ENGINES.pop((db_path, read_only)).dispose()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir)
+
+def copy_listing_compositions(session, scratch_dir:str) -> int:
+    '''copies learned listing compositions of production database to scratch database. Returns count of copied rows'''
+    compositions = session.query(ListingComposition).all()
+    scratch_session = get_db_session(scratch_dir)
+    try:
+        scratch_session.add_all([ListingComposition(sales_channel=row.sales_channel, skus=row.skus, items=row.items,
+                                multipliers=row.multipliers, timestamp=row.timestamp) for row in compositions])
+        scratch_session.commit()
+    finally:
+        scratch_session.close()
+    return len(compositions)
+
+def replay_runs(first:str, last:str, output_dir:str=None, inventory_file:str=None, parse_workers:int=None) -> ReplayReport:
+    '''feeds source backups of production runs between first and last (run ids or YYYY-MM-DD dates) in timestamp order
+    through pipeline into scratch database and helper file (REPLAY_DIR inside output_dir). Each run is replayed with its
+    original timestamp (partitions, flushing). Run sku deltas are checked against production ones, final scratch helper file
+    against production helper file. Production database, backups and helper file are only read
+
+    - output_dir:str - production database dir. Default: get_output_dir(client_file=False)
+    - inventory_file:str - production helper file. Default: EXPORT_FILE in get_output_dir(client_file=True)'''
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+    inventory_file = inventory_file if inventory_file else os.path.join(get_output_dir(client_file=True), EXPORT_FILE)
+    report = ReplayReport(os.path.join(output_dir, REPLAY_DIR))
+    reset_scratch_dir(report.scratch_dir)
+    scratch_inventory_file = os.path.join(report.scratch_dir, EXPORT_FILE)
+    session = get_db_session(output_dir)
+    try:
+        runs = get_replay_runs(session, first, last)
+        copy_listing_compositions(session, report.scratch_dir)
+        logging.info(f'Replaying {len(runs)} runs ({first} - {last}) into {report.scratch_dir}')
+        clock = SimulatedClock()
+        for run in runs:
+            if not os.path.exists(run.fpath):
+                logging.warning(f'Replay skips {run}: source backup not found')
+                report.skipped.append(run)
+                continue
+            # not testing mode: scratch database keeps its own source backups (flushing deletes them, never production ones)
+            clock.set(run.timestamp)
+            options = PipelineOptions(open_files=False, parse_workers=parse_workers, output_dir=report.scratch_dir, clock=clock,
+                                    sinks=[XlsxSink(scratch_inventory_file, open_files=False, backup_dir=report.scratch_dir)])
+            start = time.perf_counter()
+            result = run_pipeline(run.fpath, run.sales_channel, options)
+            seconds = time.perf_counter() - start
+            production_deltas = dict(session.query(SKU.code, RunSKUDelta.quantity).join(RunSKUDelta, RunSKUDelta.sku_id == SKU.id).\
+                                    filter(RunSKUDelta.run == run.id).all())
+            for sku, quantity in production_deltas.items():
+                report.expected_totals[sku] = report.expected_totals.get(sku, 0) + quantity
+            replay_deltas = dict(result.export_obj.items()) if result.export_obj else {}
+            report.runs.append({'run': run.id, 'timestamp': run.timestamp, 'sales_channel': run.sales_channel, 'fpath': run.fpath,
+                                'result': result, 'seconds': seconds, 'deltas_diff': get_quantities_diff(production_deltas, replay_deltas)})
+            logging.info(f'Replayed run {run.id} in {seconds:.2f}s: {result}')
+    finally:
+        session.close()
+    if os.path.exists(inventory_file) and os.path.exists(scratch_inventory_file):
+        report.helper_file_diff = get_quantities_diff(read_helper_file_quantities(inventory_file),
+                                                    read_helper_file_quantities(scratch_inventory_file))
+    logging.info(f'Replay finished: {report}')
+    return report
+
+def print_replay(first:str, last:str):
+    '''replays production runs first - last (run ids or YYYY-MM-DD dates) into scratch dir, prints tab separated
+    per run timings, throughput and sku totals checks'''
+    report = replay_runs(first, last)
+    print('run\ttimestamp\tsales_channel\tloaded\tnew\tadded to db\tseconds\torders/s\tdeltas diff\terror')
+    for run in report.runs:
+        result = run['result']
+        rate = result.loaded_orders / run['seconds'] if run['seconds'] else 0
+        print(f'{run["run"]}\t{run["timestamp"]:%Y-%m-%d %H:%M}\t{run["sales_channel"]}\t{result.loaded_orders}\t{result.new_orders}\t'
+            f'{result.added_to_db}\t{run["seconds"]:.2f}\t{rate:.0f}\t{len(run["deltas_diff"])}\t{result.error or ""}')
+        for sku, (production, replay) in list(run['deltas_diff'].items())[:MAX_PRINTED_MISMATCHES]:
+            print(f'\t{sku}: production {production}, replay {replay}')
+    for run in report.skipped:
+        print(f'{run.id}\t{run.timestamp:%Y-%m-%d %H:%M}\t{run.sales_channel}\tskipped: source backup not found: {run.fpath}')
+    rate = report.loaded_orders / report.seconds if report.seconds else 0
+    print(f'Replayed runs: {len(report.runs)}, skipped: {len(report.skipped)}, loaded orders: {report.loaded_orders}, '
+        f'new orders: {report.new_orders} in {report.seconds:.2f}s ({rate:.0f} orders/s)')
+    print(f'Runs with sku deltas different from production: {len(report.mismatched_runs)}')
+    print(f'Helper file skus different from production: {len(report.helper_file_diff)} (expected 0 only when range covers whole helper file history)')
+    for sku, (production, replay) in sorted(report.helper_file_diff.items())[:MAX_PRINTED_MISMATCHES]:
+        print(f'\t{sku}: production {production}, replay {replay}')
+    print(f'Scratch database and helper file: {report.scratch_dir}')
+
+
+if __name__ == "__main__":
+    pass
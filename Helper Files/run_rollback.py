@@ -0,0 +1,95 @@
+import logging
+import sys
+from database import SQLAlchemyOrdersDB, ProgramRun, get_db_session
+from output_sinks import get_output_sinks, get_applied_undo_sinks, add_applied_undo_sink, release_undo_key
+from exceptions import InventoryError, RunNotFoundError, HelperFileError
+from channels import get_channel
+from constants import VBA_ERROR_ALERT, VBA_OK
+
+
+class RunRollback():
+    '''Reverses single program run after wrong file / sales channel was loaded, keeping later runs intact.
+
+    Subtracts sku quantities recorded for run (run_sku_delta table) from helper file in single workbook pass
+    (and other configured output sinks, see output_sinks.py), then deletes run and its orders from database (cascade).
+    Helper file and database are backed up as on regular run.
+    Retry safe: sinks written are recorded under undo key (output_sinks.PENDING_UNDO_SINKS_NAME) until run is deleted from database,
+    repeated undo-run after later sink / database failure skips them (helper file is not subtracted twice).
+
+    Args:
+    - run_id:int - program_run table id of run to reverse
+    - sinks:list - optional OutputSink instances. Defaults to get_output_sinks
+
+    Main method: rollback() - raises InventoryError subclasses'''
+
+    def __init__(self, run_id:int, sinks:list=None):
+        self.run_id = run_id
+        self.sinks = sinks
+
+    def rollback(self):
+        '''reverses helper file quantities, deletes run from database'''
+        run = self._get_run()
+        run_channel = run.sales_channel
+        # run ids of deleted last runs are reused by sqlite: run timestamp keeps undo key unique
+        self.run_key = f'undo-run-{self.run_id}-{run.timestamp:%Y%m%d%H%M%S}'
+        db_client = SQLAlchemyOrdersDB([], None, run_channel, get_channel(run_channel).proxy_keys)
+        sku_deltas = db_client.get_run_sku_deltas(self.run_id)
+        logging.info(f'Reversing run {self.run_id} ({run_channel}). Sku deltas to subtract from helper file: {len(sku_deltas)}')
+        if sku_deltas:
+            self._subtract_from_helper_file(sku_deltas, db_client)
+        else:
+            logging.warning(f'No sku deltas recorded for run {self.run_id} (no valid orders or run predates deltas). Helper file left untouched')
+        deleted_orders_count = db_client.delete_run(self.run_id)
+        db_client.close()
+        release_undo_key(self.run_key)
+        logging.info(f'Run {self.run_id} reversed. Deleted orders: {deleted_orders_count}, skus updated in helper file: {len(sku_deltas)}')
+
+    def _get_run(self) -> ProgramRun:
+        '''returns (detached) run to reverse. Raises RunNotFoundError if run does not exist'''
+        session = get_db_session()
+        run = session.query(ProgramRun).filter_by(id=self.run_id).one_or_none()
+        session.close()
+        if run is None:
+            logging.critical(f'Run with id {self.run_id} not found in database. Nothing to reverse. Alerting VBA, terminating')
+            raise RunNotFoundError(f'Run with id {self.run_id} not found in database')
+        return run
+
+    def _subtract_from_helper_file(self, sku_deltas:dict, db_client:object):
+        '''subtracts sku_deltas from helper file and other output sinks. Raises (database untouched) if sink write fails'''
+        negated_deltas = {sku: -quantity for sku, quantity in sku_deltas.items()}
+        try:
+            sinks = self.sinks if self.sinks is not None else get_output_sinks(open_files=False)
+            applied_sinks = get_applied_undo_sinks(self.run_key)
+            for sink in sinks:
+                if repr(sink) in applied_sinks:
+                    logging.info(f'{sink} already reversed run {self.run_id} on previous undo attempt, skipping')
+                    continue
+                sink.write(negated_deltas, self.run_key, db_client.sales_channel, drop_empty=True)
+                add_applied_undo_sink(self.run_key, sink)
+        except Exception as e:
+            logging.exception(f'Unexpected error reversing run {self.run_id} quantities in helper file. Database left untouched. Last error: {e}')
+            db_client.close()
+            if isinstance(e, InventoryError):
+                raise
+            raise HelperFileError(f'Failed to reverse run {self.run_id} in helper file: {e}') from e
+
+
+def undo_run(run_id:str):
+    '''reverses program run run_id (passed as command argument), alerts VBA'''
+    try:
+        run_id = int(run_id)
+    except ValueError:
+        logging.critical(f'Run id has to be an integer. Got: {run_id}')
+        print(VBA_ERROR_ALERT)
+        sys.exit()
+    try:
+        RunRollback(run_id).rollback()
+    except InventoryError as e:
+        for message in e.vba_messages:
+            print(message)
+        sys.exit()
+    print(VBA_OK)
+
+
+if __name__ == "__main__":
+    pass
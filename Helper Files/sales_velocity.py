@@ -0,0 +1,105 @@
+import datetime
+import logging
+import csv
+import os
+from sqlalchemy import func, case, select
+from database import get_db_session, get_day_key, get_day_from_key, SKUDailySales, SKU, ORDERS_ARCHIVE_DAYS
+from utils import get_output_dir
+
+
+# GLOBAL VARIABLES
+# velocity windows in days (last day: today). Days of cover is based on last (longest) window
+VELOCITY_WINDOWS = [7, 28]
+# optional current stock levels: csv with 'sku' and 'stock' columns in output dir (next to helper file)
+STOCK_LEVELS_NAME = 'stock_levels.csv'
+
+
+def get_velocity_rows(session, today:datetime.date=None, sales_channel:str=None) -> list:
+    '''returns list of per sku dicts from sku_daily_sales buckets in single grouped query:
+    {'sku', 'units_7d', 'units_28d' (per VELOCITY_WINDOWS), 'units_total', 'orders_total', 'last_sale' (date), 'per_day_7d', 'per_day_28d'}.
+    Per day velocity is divided by days of sales history (first bucket day) when history is shorter than window'''
+    today = today if today else datetime.date.today()
+    window_starts = {window: get_day_key(today - datetime.timedelta(days=window - 1)) for window in VELOCITY_WINDOWS}
+    channel_filter = [SKUDailySales.sales_channel == sales_channel] if sales_channel else []
+    window_sums = [func.sum(case((SKUDailySales.day >= window_starts[window], SKUDailySales.quantity), else_=0)).label(f'units_{window}d')
+                    for window in VELOCITY_WINDOWS]
+    # buckets are grouped first (single ordered scan), sku codes are joined to grouped rows only
+    totals = select(SKUDailySales.sku_id, *window_sums, func.sum(SKUDailySales.quantity).label('units_total'),
+                    func.sum(SKUDailySales.orders_count).label('orders_total'), func.min(SKUDailySales.day).label('first_sale'),
+                    func.max(SKUDailySales.day).label('last_sale')).where(*channel_filter).group_by(SKUDailySales.sku_id).subquery()
+    query = select(SKU.code, *[column for column in totals.c if column.name != 'sku_id']).join(totals, SKU.id == totals.c.sku_id)
+    totals_rows = session.execute(query).all()
+    if not totals_rows:
+        return []
+    first_day = min(row.first_sale for row in totals_rows)
+    history_days = min((today - get_day_from_key(first_day)).days + 1, ORDERS_ARCHIVE_DAYS)
+    divisors = [max(min(window, history_days), 1) for window in VELOCITY_WINDOWS]
+    units_keys = [f'units_{window}d' for window in VELOCITY_WINDOWS]
+    per_day_keys = [f'per_day_{window}d' for window in VELOCITY_WINDOWS]
+    rows = []
+    for sku, *window_units, units_total, orders_total, _, last_sale in totals_rows:
+        row = {'sku': sku}
+        row.update(zip(units_keys, window_units))
+        row.update(zip(per_day_keys, [units / divisor for units, divisor in zip(window_units, divisors)]))
+        row.update({'units_total': units_total, 'orders_total': orders_total, 'last_sale': get_day_from_key(last_sale)})
+        rows.append(row)
+    return rows
+
+def read_stock_levels(fpath:str) -> dict:
+    '''returns {sku: stock} from csv with 'sku' and 'stock' columns. Empty dict if file is missing, unreadable rows skipped'''
+    if not os.path.exists(fpath):
+        return {}
+    stock_levels = {}
+    with open(fpath, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                stock_levels[row['sku'].strip()] = float(row['stock'])
+            except (KeyError, TypeError, ValueError, AttributeError):
+                logging.warning(f'Skipping unreadable stock levels row: {row}')
+    return stock_levels
+
+def add_days_cover(rows:list, stock_levels:dict) -> list:
+    '''adds 'stock' and 'days_cover' (stock / per day velocity of longest window) keys to rows. None when unknown / no sales'''
+    velocity_key = f'per_day_{VELOCITY_WINDOWS[-1]}d'
+    for row in rows:
+        stock = stock_levels.get(row['sku'])
+        row['stock'] = stock
+        row['days_cover'] = stock / row[velocity_key] if stock is not None and row[velocity_key] else None
+    return rows
+
+def sort_report_rows(rows:list, sort_key:str='days_cover') -> list:
+    '''sorts rows in place: 'days_cover' - least cover first (unknown cover last), 'velocity' - fastest sellers first'''
+    velocity_key = f'per_day_{VELOCITY_WINDOWS[-1]}d'
+    if sort_key == 'days_cover':
+        rows.sort(key=lambda row: (row['days_cover'] is None, row['days_cover'] or 0, -row[velocity_key]))
+    else:
+        rows.sort(key=lambda row: -row[velocity_key])
+    return rows
+
+def get_velocity_report(output_dir:str=None, today:datetime.date=None, sales_channel:str=None, sort_key:str='days_cover') -> list:
+    '''returns sorted velocity report rows with days of cover from stock levels csv (see STOCK_LEVELS_NAME).
+    output_dir holds both database and stock levels csv (default: database in systemic, csv in client output dir)'''
+    session = get_db_session(output_dir)
+    try:
+        rows = get_velocity_rows(session, today, sales_channel)
+    finally:
+        session.close()
+    stock_fpath = os.path.join(output_dir if output_dir else get_output_dir(), STOCK_LEVELS_NAME)
+    return sort_report_rows(add_days_cover(rows, read_stock_levels(stock_fpath)), sort_key)
+
+def print_velocity_report():
+    '''prints tab separated per sku velocity (units per day / week) and days of cover table'''
+    rows = get_velocity_report()
+    logging.info(f'Sales velocity report requested. SKUs with sales in last {ORDERS_ARCHIVE_DAYS} days: {len(rows)}')
+    window_headers = '\t'.join(f'units {window}d\tper day {window}d' for window in VELOCITY_WINDOWS)
+    print(f'sku\t{window_headers}\tper week {VELOCITY_WINDOWS[-1]}d\tunits total\torders total\tlast sale\tstock\tdays cover')
+    for row in rows:
+        windows = '\t'.join(f'{row[f"units_{window}d"]}\t{row[f"per_day_{window}d"]:.2f}' for window in VELOCITY_WINDOWS)
+        stock = '' if row['stock'] is None else f'{row["stock"]:g}'
+        days_cover = '' if row['days_cover'] is None else f'{row["days_cover"]:.1f}'
+        print(f'{row["sku"]}\t{windows}\t{row[f"per_day_{VELOCITY_WINDOWS[-1]}d"] * 7:.2f}\t{row["units_total"]}\t'
+            f'{row["orders_total"]}\t{row["last_sale"]}\t{stock}\t{days_cover}')
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,89 @@
+import random
+import csv
+from datetime import datetime, timedelta
+from constants import SALES_CHANNEL_PROXY_KEYS
+
+
+# GLOBAL VARIABLES
+SAMPLE_COUNTRIES = {'Etsy': ['Lithuania', 'Germany', 'France', 'United States', 'Italy', 'LT'],
+                    'Amazon': ['DE', 'FR', 'IT', 'ES', 'GB'],
+                    'Amazon Warehouse': ['DE', 'FR', 'IT', 'ES', 'GB']}
+SAMPLE_DELIMITERS = {'Amazon': '\t', 'Amazon Warehouse': ',', 'Etsy': ','}
+
+
+def get_sample_skus(count:int, seed:int=0) -> list:
+    '''returns list of count distinct sku codes resembling real codes: '1034630', 'T1147', 'CR2016 5BL 3V' '''
+    rnd = random.Random(seed)
+    skus = set()
+    while len(skus) < count:
+        shape = rnd.random()
+        if shape < 0.6:
+            skus.add(str(rnd.randint(1000000, 1099999)))
+        elif shape < 0.8:
+            skus.add(f'T{rnd.randint(1000, 9999)}')
+        else:
+            skus.add(f'CR{rnd.randint(1000, 3999)} {rnd.randint(1, 9)}BL {rnd.randint(1, 12)}V')
+    return sorted(skus)
+
+def get_export_headers(sales_channel:str) -> list:
+    '''returns source file headers for sales_channel (proxy keys values, excl. keys added during processing)'''
+    headers = []
+    for header in SALES_CHANNEL_PROXY_KEYS[sales_channel].values():
+        if header != 'sku_quantities' and header not in headers:
+            headers.append(header)
+    return headers
+
+def _get_sample_sku_field(rnd:random.Random, sales_channel:str, sku_pool:list) -> str:
+    '''returns raw sku field value with optional inner quantity prefix and multilisting / etsy comma separated skus'''
+    skus_count = 1 if rnd.random() < 0.85 else rnd.randint(2, 3)
+    skus = []
+    for _ in range(skus_count):
+        sku = rnd.choice(sku_pool)
+        inner_qty = 1 if rnd.random() < 0.7 else rnd.randint(2, 10)
+        if sales_channel == 'Etsy':
+            skus.append(f'{inner_qty} vnt. {sku}')
+        else:
+            skus.append(f'({inner_qty} vnt.) {sku}' if inner_qty > 1 else sku)
+    if sales_channel == 'Etsy' and len(skus) > 1 and rnd.random() < 0.5:
+        return ','.join(skus)
+    return ' + '.join(skus)
+
+def generate_orders(sales_channel:str, orders_count:int, sku_pool:list=None, start:datetime=None, days:int=1,
+                    seed:int=0, id_offset:int=0) -> list:
+    '''returns list of raw order dicts (as read from source file by csv.DictReader) for sales_channel.
+    Orders purchase dates are spread evenly over days, starting at start. Order ids are unique for id_offset + index'''
+    rnd = random.Random(seed)
+    proxy_keys = SALES_CHANNEL_PROXY_KEYS[sales_channel]
+    sku_pool = sku_pool if sku_pool else get_sample_skus(2000, seed)
+    start = start if start else datetime(2022, 8, 1)
+    headers = get_export_headers(sales_channel)
+    orders = []
+    for i in range(orders_count):
+        order_no = id_offset + i
+        order = {header: '' for header in headers}
+        purchase_date = start + timedelta(seconds=int(i * days * 86400 / max(orders_count, 1)))
+        cart_id = f'{order_no // 2:012d}'
+        if sales_channel == 'Etsy':
+            order[proxy_keys['order-id']] = str(2000000000 + order_no)
+            order[proxy_keys['purchase-date']] = purchase_date.strftime('%m/%d/%y')
+        else:
+            order[proxy_keys['order-id']] = f'{order_no:014d}'
+            order[proxy_keys['secondary-order-id']] = f'{cart_id[:3]}-{cart_id[3:]}'
+            order[proxy_keys['purchase-date']] = purchase_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        order[proxy_keys['buyer-name']] = f'Buyer {order_no // 2}'
+        order[proxy_keys['sku']] = _get_sample_sku_field(rnd, sales_channel, sku_pool)
+        order[proxy_keys['quantity-purchased']] = str(1 if rnd.random() < 0.8 else rnd.randint(2, 4))
+        order[proxy_keys['ship-country']] = rnd.choice(SAMPLE_COUNTRIES[sales_channel])
+        orders.append(order)
+    return orders
+
+def write_export(fpath:str, orders:list, sales_channel:str):
+    '''writes orders to source file formatted as sales_channel export (tab separated txt for Amazon, csv otherwise)'''
+    with open(fpath, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=get_export_headers(sales_channel), delimiter=SAMPLE_DELIMITERS[sales_channel])
+        writer.writeheader()
+        writer.writerows(orders)
+
+
+if __name__ == "__main__":
+    pass
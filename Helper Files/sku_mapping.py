@@ -1,16 +1,35 @@
 import logging
+import csv
+import os
+import re
 import openpyxl
-from utils import get_last_used_row_col, alert_VBA_duplicate_mapping_sku
+from utils import get_last_used_row_col, get_duplicate_mapping_sku_alert
+
+
+# GLOBAL VARIABLES
+# {sku_mapping_fpath: (workbook mtime, SKUMappingIndex, alerts)}. Keeps compiled mapping warm in long running process (watcher.py)
+MAPPING_CACHE = {}
+# inner quantity prefix of amazon sku in any spacing / case: '(2 vnt.) ', '(2vnt) ', '( 2 VNT. ) '
+QUANTITY_PREFIX_REGEX = re.compile(r'^\(\s*(\d+)\s*vnt\.?\s*\)\s*', re.IGNORECASE)
+# candidate custom labels suggested per unmapped sku (see SKUMappingIndex.get_candidates)
+MAX_CANDIDATES = 3
+# labels kept per trie node, ranked when node is the deepest match
+TRIE_NODE_SAMPLES = 8
+# shortest common prefix of unmapped sku and custom label to suggest label as candidate
+MIN_CANDIDATE_PREFIX = 3
 
 
 class SKUMapping():
     '''class reads excel file to output a sku_mapping dictionary.
     Main method: read_sku_mapping_to_dict
     
-    arg: SKU_mapping excel file abs path'''
+    arg: SKU_mapping excel file abs path
+
+    VBA alerts for duplicate skus found while reading are collected in self.alerts'''
 
     def __init__(self, sku_mapping_fpath):
         self.sku_mapping_fpath = sku_mapping_fpath
+        self.alerts = []
 
     def read_sku_mapping_to_dict(self) -> dict:
             '''reads mapping wb contents to dictionary. Output dict:
@@ -55,8 +74,8 @@ class SKUMapping():
             if sku not in sku_mapping.keys():
                 sku_mapping[sku] = custom_label
             else:
-                alert_VBA_duplicate_mapping_sku(sku)
-                logging.warning(f'Duplicate SKU code found in mapping xlsx. User has been warned. SKU code found at least twice: {sku}')
+                self.alerts.append(get_duplicate_mapping_sku_alert(sku))
+                logging.warning('Duplicate SKU code found in mapping xlsx. User has been warned. SKU code found at least twice: %s', sku)
         logging.info(f'Current sku mapping dict has {len(sku_mapping.keys())} entries')
         return sku_mapping
 
@@ -67,5 +86,184 @@ class SKUMapping():
         return sku, custom_label
 
 
+def split_canonical_sku(sku:str) -> tuple:
+    '''returns (inner quantity or None, canonical sku without prefix: whitespace collapsed, case folded) of raw sku'''
+    canonical = ' '.join(str(sku).split()).casefold()
+    prefix = QUANTITY_PREFIX_REGEX.match(canonical) if canonical.startswith('(') else None
+    return (int(prefix.group(1)), canonical[prefix.end():]) if prefix else (None, canonical)
+
+def get_canonical_sku(sku:str) -> str:
+    '''returns sku lookup key: whitespace collapsed, case folded, inner quantity prefix spelled as (N vnt.)'''
+    inner_qty, base_key = split_canonical_sku(sku)
+    return base_key if inner_qty is None else f'({inner_qty} vnt.) {base_key}'
+
+def split_quantity_prefix(canonical_sku:str) -> tuple:
+    '''returns (inner quantity or None, sku without prefix) of canonical sku'''
+    prefix = QUANTITY_PREFIX_REGEX.match(canonical_sku) if canonical_sku.startswith('(') else None
+    return (int(prefix.group(1)), canonical_sku[prefix.end():]) if prefix else (None, canonical_sku)
+
+
+def strip_quantity_prefix(sku:str) -> str:
+    '''returns raw sku without inner quantity prefix and surrounding whitespace: '(2 vnt.) ABC ' -> 'ABC' '''
+    sku = str(sku).strip()
+    prefix = QUANTITY_PREFIX_REGEX.match(sku) if sku.startswith('(') else None
+    return sku[prefix.end():] if prefix else sku
+
+
+class SKUMappingIndex():
+    '''Sku mapping compiled into normalized lookup index. Built once per mapping workbook version (see get_sku_mapping).
+
+    Lookup order in get(sku), each step O(1) / O(len(sku)):
+    1. exact workbook amazon sku;
+    2. canonical sku (case, whitespace, quantity prefix spelling differences, see get_canonical_sku);
+    3. sku with inner quantity prefix, which mapping lists without prefix: '(2 vnt.) abc' -> '(2 vnt.) <custom label of ABC>'
+    (only if custom label has no quantity prefix of its own).
+
+    Canonical keys mapping to different custom labels are ambiguous: left to exact lookup only (self.ambiguous).
+    Custom labels are kept in prefix trie: unmapped skus (neither mapped nor custom label themselves) get candidate labels
+    sharing longest prefix (get_candidates).
+
+    Arg: sku_mapping:dict - {amazon_sku: custom_label} as read from mapping workbook'''
+
+    def __init__(self, sku_mapping:dict=None):
+        self.mapping = {sku: label for sku, label in (sku_mapping or {}).items() if sku is not None and label is not None}
+        self.canonical = {}
+        self.ambiguous = {}
+        self.unprefixed = {}
+        self.labels = {}
+        self.trie = [{}, []]
+        self.__candidates_cache = {}
+        self.__compile()
+
+    def __compile(self):
+        for sku, label in self.mapping.items():
+            key = get_canonical_sku(sku)
+            if key in self.ambiguous:
+                self.ambiguous[key].append(sku)
+            elif key in self.canonical and get_canonical_sku(self.canonical[key]) != get_canonical_sku(label):
+                self.ambiguous[key] = [original for original in self.mapping if get_canonical_sku(original) == key]
+                del self.canonical[key]
+            else:
+                self.canonical.setdefault(key, label)
+        # canonical keys of labels without inner quantity prefix: prefixed sku of such key gets prefixed label (lookup step 3)
+        self.unprefixed = {key: label for key, label in self.canonical.items() if split_canonical_sku(label)[0] is None}
+        for label in sorted(set(map(str, self.mapping.values()))):
+            label_key = split_quantity_prefix(get_canonical_sku(label))[1]
+            if label_key not in self.labels:
+                self.labels[label_key] = label
+                self.__add_to_trie(label_key, label)
+        if self.ambiguous:
+            logging.warning(f'SKU mapping keys differing only in case / spacing map to different labels, matched exactly only: {list(self.ambiguous.values())}')
+        logging.debug(f'SKU mapping index compiled: {len(self.mapping)} skus, {len(self.canonical)} canonical keys, {len(self.labels)} custom labels')
+
+    def __add_to_trie(self, label_key:str, label:str):
+        '''adds label under path of label_key chars, every node on path keeps up to TRIE_NODE_SAMPLES labels'''
+        node = self.trie
+        for char in label_key:
+            node = node[0].setdefault(char, [{}, []])
+            if len(node[1]) < TRIE_NODE_SAMPLES:
+                node[1].append(label)
+
+    def _match(self, sku:str) -> tuple:
+        '''returns (custom label or None, canonical sku without quantity prefix - None on exact match)'''
+        label = self.mapping.get(sku)
+        if label is not None:
+            return label, None
+        # inlined split_canonical_sku: most skus have no prefix and are looked up by their canonical form directly
+        canonical = ' '.join(str(sku).split()).casefold()
+        label = self.canonical.get(canonical)
+        if label is not None:
+            return label, None
+        prefix = QUANTITY_PREFIX_REGEX.match(canonical) if canonical.startswith('(') else None
+        if prefix is None:
+            return None, canonical
+        inner_qty, base_key = int(prefix.group(1)), canonical[prefix.end():]
+        label = self.canonical.get(f'({inner_qty} vnt.) {base_key}')
+        if label is not None:
+            return label, None
+        label = self.unprefixed.get(base_key)
+        if label is not None:
+            return f'({inner_qty} vnt.) {label}', None
+        return None, base_key
+
+    def get(self, sku:str, default=None):
+        '''returns custom label (with inner quantity prefix of sku if only base sku is mapped) or default'''
+        label = self._match(sku)[0]
+        return default if label is None else label
+
+    def resolve(self, sku:str) -> tuple:
+        '''returns (custom label or None, canonical base sku if sku is unmapped else None). Single canonicalization per sku,
+        candidates are not ranked here (see get_unmapped_candidates)'''
+        label, base_key = self._match(sku)
+        if label is not None or base_key in self.labels:
+            return label, None
+        return None, base_key
+
+    def get_unmapped_candidates(self, base_key:str) -> list:
+        '''returns candidate labels of unmapped canonical base sku (as returned by resolve), cached per base sku'''
+        candidates = self.__candidates_cache.get(base_key)
+        if candidates is None:
+            candidates = self.__candidates_cache[base_key] = self.get_candidates(base_key)
+        return candidates
+
+    def __contains__(self, sku:str) -> bool:
+        return self.get(sku) is not None
+
+    def __getitem__(self, sku:str) -> str:
+        label = self.get(sku)
+        if label is None:
+            raise KeyError(sku)
+        return label
+
+    def __len__(self) -> int:
+        return len(self.mapping)
+
+    def is_unmapped(self, sku:str) -> bool:
+        '''True if sku is neither mapped nor (with or without quantity prefix) custom label itself'''
+        return self.resolve(sku)[1] is not None
+
+    def get_candidates(self, sku:str, limit:int=MAX_CANDIDATES) -> list:
+        '''returns up to limit custom labels closest to unmapped sku: label of mapped base sku (prefixed label, ambiguous keys),
+        then labels under deepest trie node sku shares at least MIN_CANDIDATE_PREFIX chars with, closest length first'''
+        base_key = split_quantity_prefix(get_canonical_sku(sku))[1]
+        candidates = [self.canonical[base_key]] if base_key in self.canonical else []
+        candidates.extend(self.mapping[original] for original in self.ambiguous.get(base_key, []))
+        node, depth = self.trie, 0
+        for char in base_key:
+            child = node[0].get(char)
+            if child is None:
+                break
+            node, depth = child, depth + 1
+        if depth >= MIN_CANDIDATE_PREFIX:
+            candidates.extend(sorted(node[1], key=lambda label: abs(len(label) - len(base_key))))
+        return list(dict.fromkeys(candidates))[:limit]
+
+
+def export_unmapped_skus(unmapped_skus:dict, fpath:str):
+    '''writes unmapped skus report: csv with sku and candidate custom labels columns, one row per sku'''
+    with open(fpath, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['sku'] + [f'candidate {i}' for i in range(1, MAX_CANDIDATES + 1)])
+        for sku in sorted(unmapped_skus):
+            writer.writerow([sku] + unmapped_skus[sku])
+    logging.info(f'Unmapped skus report ({len(unmapped_skus)} skus) exported at {fpath}')
+
+def get_sku_mapping(sku_mapping_fpath:str) -> tuple:
+    '''returns (SKUMappingIndex, VBA alerts list) of workbook at sku_mapping_fpath.
+    Workbook is re-read and index compiled only if it was modified since previous call'''
+    try:
+        mtime = os.path.getmtime(sku_mapping_fpath)
+    except OSError:
+        mtime = None
+    cached = MAPPING_CACHE.get(sku_mapping_fpath)
+    if cached and mtime is not None and cached[0] == mtime:
+        logging.debug(f'Using cached sku mapping of {os.path.basename(sku_mapping_fpath)}')
+        return cached[1], cached[2]
+    mapping_reader = SKUMapping(sku_mapping_fpath)
+    sku_mapping = SKUMappingIndex(mapping_reader.read_sku_mapping_to_dict())
+    MAPPING_CACHE[sku_mapping_fpath] = (mtime, sku_mapping, mapping_reader.alerts)
+    return sku_mapping, mapping_reader.alerts
+
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
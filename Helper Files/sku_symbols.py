@@ -0,0 +1,150 @@
+import itertools
+import array
+try:
+    # optional. Speeds up bulk accumulation and sorting of large batches
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SKUSymbolTable():
+    '''Interns sku codes to dense integer ids (0, 1, 2, ...) in order of first appearance.
+    Created per run (ChannelPlan.symbols) and passed on with run sku totals (SKUQuantities.symbols) to helper file update,
+    so ids are comparable within run and table does not grow across runs of long running process (watch mode)'''
+
+    def __init__(self):
+        self.ids = {}
+        self.codes = []
+
+    def intern(self, sku:str) -> int:
+        '''returns id of sku, assigning next free id to unseen sku'''
+        sku_id = self.ids.get(sku)
+        if sku_id is None:
+            sku_id = self.ids[sku] = len(self.codes)
+            self.codes.append(sku)
+        return sku_id
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+
+class SKUQuantities():
+    '''Counter-like sku quantities accumulator backed by array('q') (int64) indexed by interned sku id.
+    Sku codes are converted back to strings only on output (items, sorted_items, to_dict).
+
+    Args:
+    - symbols:SKUSymbolTable - optional symbol table of run, defaults to new (private) table'''
+
+    def __init__(self, symbols:SKUSymbolTable=None):
+        self.symbols = symbols if symbols is not None else SKUSymbolTable()
+        self.quantities = array.array('q')
+        # 1 for sku ids added to this accumulator (keeps skus, which quantities sum up to 0)
+        self.present = bytearray()
+
+    def _reserve(self, size:int):
+        '''grows buffers to hold size sku ids'''
+        missing = size - len(self.quantities)
+        if missing > 0:
+            # grow at least by current size to keep appends amortized O(1)
+            missing = max(missing, len(self.quantities))
+            self.quantities.extend(array.array('q', bytes(8 * missing)))
+            self.present.extend(bytes(missing))
+
+    def add(self, sku_id:int, quantity:int):
+        '''adds quantity to sku_id'''
+        if sku_id >= len(self.quantities):
+            self._reserve(sku_id + 1)
+        self.quantities[sku_id] += quantity
+        self.present[sku_id] = 1
+
+    def reserve_sku(self, sku:str) -> int:
+        '''interns sku, marks it present (quantity 0 unless added) and returns its id.
+        Callers holding the id may then accumulate directly: self.quantities[sku_id] += qty'''
+        sku_id = self.symbols.intern(sku)
+        if sku_id >= len(self.quantities):
+            self._reserve(sku_id + 1)
+        self.present[sku_id] = 1
+        return sku_id
+
+    def add_sku(self, sku:str, quantity:int):
+        '''adds quantity to sku code (interned on the fly)'''
+        self.add(self.symbols.intern(sku), quantity)
+
+    def add_many(self, sku_ids:array.array, quantities:array.array):
+        '''adds quantities to sku_ids (parallel int64 arrays) in bulk'''
+        if not sku_ids:
+            return
+        self._reserve(max(sku_ids) + 1)
+        if numpy is not None:
+            ids = numpy.frombuffer(sku_ids, dtype=numpy.int64)
+            buffer = numpy.frombuffer(self.quantities, dtype=numpy.int64)
+            numpy.add.at(buffer, ids, numpy.frombuffer(quantities, dtype=numpy.int64))
+            numpy.frombuffer(self.present, dtype=numpy.uint8)[ids] = 1
+            return
+        buffer, present = self.quantities, self.present
+        for sku_id, quantity in zip(sku_ids, quantities):
+            buffer[sku_id] += quantity
+            present[sku_id] = 1
+
+    def discard(self, sku:str):
+        '''removes sku from accumulator'''
+        sku_id = self.symbols.ids.get(sku)
+        if sku_id is not None and sku_id < len(self.present):
+            self.present[sku_id] = 0
+            self.quantities[sku_id] = 0
+
+    def sku_ids(self) -> list:
+        '''returns ids of skus present in accumulator, ascending'''
+        return list(itertools.compress(range(len(self.present)), self.present))
+
+    def get(self, sku:str, default=None):
+        sku_id = self.symbols.ids.get(sku)
+        if sku_id is None or sku_id >= len(self.present) or not self.present[sku_id]:
+            return default
+        return self.quantities[sku_id]
+
+    def __getitem__(self, sku:str) -> int:
+        quantity = self.get(sku)
+        if quantity is None:
+            raise KeyError(sku)
+        return quantity
+
+    def __contains__(self, sku:str) -> bool:
+        return self.get(sku) is not None
+
+    def __len__(self) -> int:
+        return self.present.count(1)
+
+    def __bool__(self) -> bool:
+        return 1 in self.present
+
+    def __iter__(self):
+        codes = self.symbols.codes
+        return (codes[sku_id] for sku_id in self.sku_ids())
+
+    def items(self) -> list:
+        '''returns [(sku, qty), ...] in sku id order'''
+        codes, quantities = self.symbols.codes, self.quantities
+        return [(codes[sku_id], quantities[sku_id]) for sku_id in self.sku_ids()]
+
+    def to_dict(self) -> dict:
+        '''returns export object: {'sku1': qty1, 'sku2': qty2, ...}'''
+        return dict(self.items())
+
+    def argsort(self) -> list:
+        '''returns present sku ids sorted by descending quantity (stable: ties keep sku id order)'''
+        sku_ids = self.sku_ids()
+        if numpy is not None and sku_ids:
+            ids = numpy.array(sku_ids, dtype=numpy.int64)
+            quantities = numpy.frombuffer(self.quantities, dtype=numpy.int64)[ids]
+            return ids[numpy.argsort(-quantities, kind='stable')].tolist()
+        return sorted(sku_ids, key=self.quantities.__getitem__, reverse=True)
+
+    def sorted_items(self) -> list:
+        '''same as utils.sort_by_quantity: [('sku1', qty_max), ('sku2', qty), ..., ('sku2', qty_min)]'''
+        codes, quantities = self.symbols.codes, self.quantities
+        return [(codes[sku_id], quantities[sku_id]) for sku_id in self.argsort()]
+
+
+if __name__ == "__main__":
+    pass
@@ -1,6 +1,8 @@
+import contextlib
 import logging
 import shutil
 import json
+import time
 import sys
 import csv
 import os
@@ -8,7 +10,8 @@ import re
 from datetime import datetime
 import charset_normalizer
 from openpyxl.utils import get_column_letter
-from constants import VBA_ERROR_ALERT, COUNTRY_CODES, VBA_KEYERROR_ALERT, EXPORT_FILE
+from constants import COUNTRY_CODES, EXPORT_FILE
+from exceptions import SourceDataError
 
 
 def get_level_up_abspath(absdir_path):
@@ -47,9 +50,9 @@ def alert_vba_date_count(filter_date, orders_count):
     print(f'FILTER_DATE_USED: {filter_date}')
     print(f'SKIPPING_ORDERS_COUNT: {orders_count}')
 
-def alert_VBA_duplicate_mapping_sku(sku_code:str):
-    '''duplicate SKU code found when reading mapping xlsx, alert VBA'''
-    print(f'DUPLICATE SKU IN MAPPING: {sku_code}')
+def get_duplicate_mapping_sku_alert(sku_code:str) -> str:
+    '''returns VBA alert for duplicate SKU code found when reading mapping xlsx'''
+    return f'DUPLICATE SKU IN MAPPING: {sku_code}'
 
 def get_datetime_obj(date_str):
     '''returns tz-naive datetime obj from date string. Designed to work with str format: 2020-04-16T10:07:16+00:00'''
@@ -63,8 +66,7 @@ def get_datetime_obj(date_str):
             return datetime.fromisoformat(date_str_split)
         except ValueError:
             logging.critical(f'Unable to create datetime from date string: {date_str}. Terminating.')
-            print(VBA_ERROR_ALERT)
-            sys.exit()
+            raise SourceDataError(f'Unable to create datetime from date string: {date_str}')
 
 def simplify_date(date_str : str) -> str:
     '''returns a simplified date format: YYYY-MM-DD from rawformat 2020-04-16T06:53:44+00:00'''
@@ -117,10 +119,12 @@ def read_json_to_obj(json_file_path:str):
     return orders
 
 def sort_by_quantity(sku_qties:dict) -> list:
-    '''sorts {'sku1': qty1, 'sku2': qty2, ...} dict
+    '''sorts {'sku1': qty1, 'sku2': qty2, ...} dict (or SKUQuantities via argsort of its buffer)
     by descending quantities. Returns list of tuples:
     
     [('sku1', qty_max), ('sku2', qty), ..., ('sku2', qty_min)]'''
+    if hasattr(sku_qties, 'sorted_items'):
+        return sku_qties.sorted_items()
     return sorted(sku_qties.items(), key=lambda x: x[1], reverse=True)
 
 def get_country_code(country:str) -> str:
@@ -133,8 +137,7 @@ def get_country_code(country:str) -> str:
             return country
     except KeyError as e:
         logging.critical(f'Failed to get country code for: {country}. Err:{e}. Alerting VBA, terminating immediately')
-        print(VBA_ERROR_ALERT)
-        sys.exit()
+        raise SourceDataError(f'Failed to get country code for: {country}') from e
 
 def split_sku(split_sku:str, sales_channel:str) -> list:
     '''splits sku string on ',' and ' + ' into list of skus for Etsy.
@@ -148,26 +151,26 @@ def split_sku(split_sku:str, sales_channel:str) -> list:
     else:
         return split_sku.split(' + ')
 
-def create_src_file_backup(target_file_abs_path:str, backup_fname_prefix:str) -> str:
-    '''returns abspath of created file backup'''
-    src_files_folder = get_src_files_folder()
+def create_src_file_backup(target_file_abs_path:str, backup_fname_prefix:str, output_dir:str=None, timestamp:datetime=None) -> str:
+    '''returns abspath of created file backup. Optional output_dir, timestamp override defaults (get_output_dir, now)'''
+    src_files_folder = get_src_files_folder(output_dir)
     _, backup_ext = os.path.splitext(target_file_abs_path)
-    backup_abspath = get_backup_f_abspath(src_files_folder, backup_fname_prefix, backup_ext)
+    backup_abspath = get_backup_f_abspath(src_files_folder, backup_fname_prefix, backup_ext, timestamp)
     shutil.copy(src=target_file_abs_path, dst=backup_abspath)
     logging.info(f'Backup created at: {backup_abspath}')
     return backup_abspath
 
-def get_src_files_folder():
-    output_dir = get_output_dir(client_file=False)
+def get_src_files_folder(output_dir:str=None):
+    output_dir = output_dir if output_dir else get_output_dir(client_file=False)
     target_dir = os.path.join(output_dir, 'src files')
     if not os.path.exists(target_dir):
         os.mkdir(target_dir)
         logging.debug(f'src files directory inside Helper files has been recreated: {target_dir}')
     return target_dir
 
-def get_backup_f_abspath(src_files_folder:str, backup_fname_prefix:str, ext:str) -> str:
+def get_backup_f_abspath(src_files_folder:str, backup_fname_prefix:str, ext:str, timestamp:datetime=None) -> str:
     '''returns abs path for backup file. fname format: backup_fname_prefix-YY-MM-DD-HH-MM.ext'''
-    timestamp = datetime.now().strftime('%y-%m-%d %H-%M')
+    timestamp = (timestamp if timestamp else datetime.now()).strftime('%y-%m-%d %H-%M')
     backup_fname = f'{backup_fname_prefix} {timestamp}{ext}'
     return os.path.join(src_files_folder, backup_fname)
 
@@ -176,21 +179,20 @@ def delete_file(file_abspath:str):
     try:
         os.remove(file_abspath)
     except FileNotFoundError:
-        logging.warning(f'Tried deleting file: {file_abspath}, but apparently human has taken care of it first. (File not found)')
+        logging.warning('Tried deleting file: %s, but apparently human has taken care of it first. (File not found)', file_abspath)
     except Exception as e:
         logging.warning(f'Unexpected err: {e} while flushing db old records, deleting file: {file_abspath}')
 
 def get_order_quantity(order:dict, proxy_keys:dict) -> int:
-    '''returns 'quantity-purchased' order key value as integer'''
+    '''returns 'quantity-purchased' order key value as integer. Returns 1 if value is missing or not a number
+    (ChannelPlan additionally reports these as VBA alerts)'''
     try:
         return int(order[proxy_keys['quantity-purchased']])
     except KeyError:
-        logging.critical(f'Failed to retrieve order quantity for order: {order}. Proxy keys: {proxy_keys}. Returning 1')
-        print(VBA_KEYERROR_ALERT)
+        logging.critical('Failed to retrieve order quantity (column: %s) for order: %s. Returning 1', proxy_keys.get('quantity-purchased'), order.get(proxy_keys['order-id']))
         return 1
     except ValueError:
-        logging.critical(f'Failed to convert order quantity for order: {order}. Proxy keys: {proxy_keys}. Returning 1')
-        print(VBA_ERROR_ALERT)
+        logging.critical('Failed to convert order quantity: %r for order: %s. Returning 1', order[proxy_keys['quantity-purchased']], order.get(proxy_keys['order-id']))
         return 1
 
 def get_inner_qty_sku(original_code:str, quantity_pattern:str):
@@ -229,6 +231,22 @@ def adjust_col_widths(ws:object, col_widths:dict):
         adjusted_width = col_widths[col_letter] + 4
         ws.column_dimensions[col_letter].width = adjusted_width
 
+@contextlib.contextmanager
+def timed_stage(timings:dict, stage:str):
+    '''adds wall time of with block (seconds) to timings[stage]'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+def get_raw_orders(source_file:str, encoding:str, delimiter:str) -> list:
+    '''returns raw orders as list of dicts for each order in txt source_file'''
+    with open(source_file, 'r', encoding=encoding) as f:
+        source_contents = csv.DictReader(f, delimiter=delimiter)
+        raw_orders = [{header : value for header, value in row.items()} for row in source_contents]
+    return raw_orders
+
 def get_file_encoding_delimiter(fpath:str) -> tuple:
     '''returns tuple of file encoding and delimiter'''
     with open(fpath, mode='rb') as f_as_bytes:
@@ -0,0 +1,231 @@
+import threading
+import logging
+import shutil
+import queue
+import time
+import json
+import os
+from datetime import datetime
+from pipeline import run_pipeline, PipelineOptions
+from utils import get_output_dir, get_file_encoding_delimiter
+from channels import CHANNELS, detect_channel, read_headers
+from constants import VBA_ERROR_ALERT, VBA_KEYERROR_ALERT, VBA_ALREADY_OPEN_ERROR
+
+
+# GLOBAL VARIABLES
+WATCH_CONFIG_NAME = 'watch_config.json'
+WATCH_STATUS_NAME = 'watcher_status.json'
+# VBA (or user) creates this file in output dir to stop watcher
+WATCH_STOP_NAME = 'watcher.stop'
+DEFAULT_WATCH_CONFIG = {
+    # inbox folder (abs or relative to output dir): sales channel or null to detect channel from source file headers
+    'inboxes': {'inbox': None},
+    'poll_seconds': 2,
+    # file size and modification time have to be unchanged this long before file is processed
+    'settle_seconds': 5,
+    }
+WATCHED_EXTENSIONS = ('.txt', '.csv', '.tsv')
+PROCESSED_FOLDER = 'processed'
+FAILED_FOLDER = 'failed'
+STATUS_HISTORY = 50
+VBA_ERROR_MESSAGES = [VBA_ERROR_ALERT, VBA_KEYERROR_ALERT, VBA_ALREADY_OPEN_ERROR]
+
+
+def read_watch_config(output_dir:str) -> dict:
+    '''returns watcher config from WATCH_CONFIG_NAME json in output_dir. Creates default config file if missing'''
+    config_path = os.path.join(output_dir, WATCH_CONFIG_NAME)
+    if not os.path.exists(config_path):
+        with open(config_path, 'w', encoding='utf-8') as f:
+            json.dump(DEFAULT_WATCH_CONFIG, f, indent=4)
+        logging.info(f'Default watcher config created at {config_path}')
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = {**DEFAULT_WATCH_CONFIG, **json.load(f)}
+    for sales_channel in config['inboxes'].values():
+        assert sales_channel is None or sales_channel in CHANNELS, f'Unexpected sales channel in {config_path}: {sales_channel}'
+    return config
+
+def detect_sales_channel(fpath:str):
+    '''returns registered sales channel detected from source file header row (see channels.detect_channel), None if no channel matches'''
+    encoding, delimiter = get_file_encoding_delimiter(fpath)
+    return detect_channel(read_headers(fpath, encoding, delimiter))
+
+def get_run_status(messages:list) -> str:
+    '''returns single status of processed export from printed VBA messages: first error alert, else last message'''
+    for message in messages:
+        if message in VBA_ERROR_MESSAGES:
+            return message
+    return messages[-1] if messages else VBA_ERROR_ALERT
+
+
+class ExportWatcher():
+    '''Polls configured inbox folders for new source exports, processes them one by one on single worker thread.
+
+    Files are queued once their size and modification time did not change for settle_seconds (partially written downloads
+    are skipped). Worker reuses cached database engine and sku mapping (re-read only when mapping workbook changes).
+    Processed exports are moved to inbox PROCESSED_FOLDER / FAILED_FOLDER subfolders.
+
+    Results are written to WATCH_STATUS_NAME json in output dir for VBA polling:
+    {'state': 'running' / 'stopped', 'heartbeat': ..., 'queued': n, 'processing': fpath, 'results': [...]}
+
+    Args:
+    - output_dir:str - optional, defaults to get_output_dir(client_file=False)
+
+    Main method:
+    - run() - watches until WATCH_STOP_NAME file appears in output dir or KeyboardInterrupt'''
+
+    def __init__(self, output_dir:str=None):
+        self.output_dir = output_dir if output_dir else get_output_dir(client_file=False)
+        self.config = read_watch_config(self.output_dir)
+        self.inboxes = self.__get_inboxes()
+        self.status_path = os.path.join(self.output_dir, WATCH_STATUS_NAME)
+        self.stop_path = os.path.join(self.output_dir, WATCH_STOP_NAME)
+        self.queue = queue.Queue()
+        self.status_lock = threading.Lock()
+        # {fpath: (size, mtime_ns, monotonic time of last change)} of files not yet queued
+        self.pending = {}
+        self.queued = set()
+        self.status = {'pid': os.getpid(), 'started': self._now(), 'state': 'running', 'heartbeat': None,
+                        'queued': 0, 'processing': None, 'results': []}
+
+    def __get_inboxes(self) -> dict:
+        '''returns {inbox abspath: sales channel or None}, creates missing inbox folders'''
+        inboxes = {}
+        for folder, sales_channel in self.config['inboxes'].items():
+            inbox = os.path.join(self.output_dir, folder)
+            os.makedirs(inbox, exist_ok=True)
+            inboxes[os.path.abspath(inbox)] = sales_channel
+        return inboxes
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def run(self):
+        '''polls inboxes, queues settled files for worker thread until stop file appears'''
+        if os.path.exists(self.stop_path):
+            os.remove(self.stop_path)
+        worker = threading.Thread(target=self._work, name='export-worker', daemon=True)
+        worker.start()
+        logging.info(f'Watcher started. Inboxes: {self.inboxes}')
+        try:
+            while not os.path.exists(self.stop_path):
+                self.poll()
+                self._write_status(heartbeat=self._now(), queued=self.queue.qsize())
+                time.sleep(self.config['poll_seconds'])
+        except KeyboardInterrupt:
+            logging.info('Watcher interrupted')
+        finally:
+            # worker finishes current and already queued files
+            self.queue.put(None)
+            worker.join()
+            if os.path.exists(self.stop_path):
+                os.remove(self.stop_path)
+            self._write_status(state='stopped', heartbeat=self._now(), queued=0)
+            logging.info('Watcher stopped')
+
+    def poll(self):
+        '''updates size / mtime of inbox files, queues files that settled'''
+        now = time.monotonic()
+        seen = set()
+        for inbox, sales_channel in self.inboxes.items():
+            for entry in os.scandir(inbox):
+                if not entry.is_file() or not entry.name.lower().endswith(WATCHED_EXTENSIONS) or entry.name.startswith(('~$', '.')):
+                    continue
+                fpath = entry.path
+                seen.add(fpath)
+                if fpath in self.queued:
+                    continue
+                stat = entry.stat()
+                size, mtime_ns, changed = self.pending.get(fpath, (None, None, now))
+                if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                    self.pending[fpath] = (stat.st_size, stat.st_mtime_ns, now)
+                    continue
+                if now - changed >= self.config['settle_seconds'] and self._is_readable(fpath):
+                    del self.pending[fpath]
+                    self.queued.add(fpath)
+                    self.queue.put((fpath, sales_channel))
+                    logging.info(f'Watcher queued {fpath} (sales channel: {sales_channel or "detect"})')
+        # forget files removed from inboxes before settling
+        for fpath in set(self.pending) - seen:
+            del self.pending[fpath]
+
+    @staticmethod
+    def _is_readable(fpath:str) -> bool:
+        '''file is not locked by writing process'''
+        try:
+            with open(fpath, 'rb'):
+                return True
+        except OSError:
+            return False
+
+    def _work(self):
+        '''worker thread: processes queued files one at a time'''
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            fpath, sales_channel = item
+            self._write_status(processing=fpath, queued=self.queue.qsize())
+            result = self.process_file(fpath, sales_channel)
+            self._move_processed(fpath, result['status'] not in VBA_ERROR_MESSAGES)
+            self.queued.discard(fpath)
+            with self.status_lock:
+                self.status['results'] = (self.status['results'] + [result])[-STATUS_HISTORY:]
+            self._write_status(processing=None, queued=self.queue.qsize())
+
+    def process_file(self, fpath:str, sales_channel:str=None) -> dict:
+        '''processes single export, returns status file result entry'''
+        result = {'file': os.path.basename(fpath), 'sales_channel': sales_channel, 'started': self._now()}
+        start = time.perf_counter()
+        try:
+            result['sales_channel'] = sales_channel if sales_channel else detect_sales_channel(fpath)
+        except Exception as e:
+            logging.warning(f'Watcher failed reading headers of {fpath}. Err: {e}')
+        if result['sales_channel'] is None:
+            logging.warning(f'Watcher could not detect sales channel of {fpath} from headers')
+            messages = [VBA_KEYERROR_ALERT]
+        else:
+            run_result = run_pipeline(fpath, result['sales_channel'], PipelineOptions(open_files=False))
+            messages = run_result.vba_messages
+            result.update({'loaded_orders': run_result.loaded_orders, 'new_orders': run_result.new_orders,
+                        'valid_orders': len(run_result.valid_orders), 'invalid_orders': len(run_result.invalid_orders),
+                        'added_to_db': run_result.added_to_db, 'error': str(run_result.error) if run_result.error else None})
+        result.update({'finished': self._now(), 'seconds': round(time.perf_counter() - start, 2),
+                    'status': get_run_status(messages), 'messages': messages})
+        logging.info(f'Watcher processed {fpath}: {result["status"]} in {result["seconds"]}s')
+        return result
+
+    def _move_processed(self, fpath:str, succeeded:bool):
+        '''moves processed file to PROCESSED_FOLDER / FAILED_FOLDER subfolder of its inbox'''
+        target_dir = os.path.join(os.path.dirname(fpath), PROCESSED_FOLDER if succeeded else FAILED_FOLDER)
+        os.makedirs(target_dir, exist_ok=True)
+        target_path = os.path.join(target_dir, os.path.basename(fpath))
+        if os.path.exists(target_path):
+            name, ext = os.path.splitext(os.path.basename(fpath))
+            target_path = os.path.join(target_dir, f'{name} {datetime.now().strftime("%Y.%m.%d %H.%M.%S")}{ext}')
+        try:
+            shutil.move(fpath, target_path)
+        except Exception as e:
+            logging.warning(f'Watcher failed to move {fpath} to {target_dir}. Err: {e}')
+
+    def _write_status(self, **updates):
+        '''updates status and atomically rewrites status json file'''
+        with self.status_lock:
+            self.status.update(updates)
+            tmp_path = f'{self.status_path}.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.status, f, indent=2)
+                os.replace(tmp_path, self.status_path)
+            except OSError as e:
+                # VBA may be reading status file at the moment (windows file lock), next write will catch up
+                logging.debug(f'Watcher status file write failed: {e}')
+
+
+def watch():
+    '''command: watches configured inbox folders, processes exports as they land'''
+    ExportWatcher().run()
+
+
+if __name__ == "__main__":
+    pass